@@ -111,6 +111,10 @@ class ConfigLoaderTest(unittest.TestCase):
                            'remove_nonexistent_users': False,
                            'after_mapping_hook': None,
                            'extended_attributes': None,
+                           'prefetch_dashboard_users': False,
+                           'accessor_workers': 1,
+                           'query_mapped_groups_only': False,
+                           'query_mapped_groups_max_lookups': 100,
                            },
                           'rule options are returned')
 
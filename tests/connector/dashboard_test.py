@@ -1,6 +1,13 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
+import umapi_client
 
 import user_sync
 import tests.helper
@@ -38,3 +45,382 @@ class ActionManagerTest(unittest.TestCase):
         self.assertEquals(self.action_man.has_work(), True, "An action was added, therefore hasWork is true")
         self.assertEquals(mock_execute.call_count, 1)
 
+
+class MockAction(object):
+    def __init__(self, user = None, command_count = 1):
+        self.frame = {'user': user}
+        self.commands = [{'add': {'product': ['group %d' % index]}} for index in range(0, command_count)]
+
+    def wire_dict(self):
+        return {}
+
+    def execution_errors(self):
+        return []
+
+class MockConnection(object):
+    def __init__(self):
+        self.batch_sizes = []
+
+    def execute_multiple(self, actions):
+        self.batch_sizes.append(len(actions))
+        return 0, len(actions), len(actions)
+
+class ActionManagerBatchTest(unittest.TestCase):
+    def test_batched_actions(self):
+        connection = MockConnection()
+        action_man = user_sync.connector.dashboard.ActionManager(connection, "test org id", tests.helper.create_logger(), 4)
+
+        called_back = []
+        for index in range(0, 10):
+            action_man.add_action(MockAction(), lambda result, index=index: called_back.append((index, result['is_success'])))
+        self.assertEquals(connection.batch_sizes, [4, 4])
+        self.assertEquals(action_man.has_work(), True)
+
+        action_man.flush()
+        self.assertEquals(connection.batch_sizes, [4, 4, 2])
+        self.assertEquals(called_back, [(index, True) for index in range(0, 10)])
+        self.assertEquals(action_man.has_work(), False)
+
+    def test_request_ids_across_threads(self):
+        action_mans = [user_sync.connector.dashboard.ActionManager(MockConnection(), "test org id %d" % index, tests.helper.create_logger()) for index in range(4)]
+        request_ids = []
+        def create_request_ids(action_man):
+            request_ids.extend([action_man.get_next_request_id() for _index in range(1000)])
+        threads = [threading.Thread(target=create_request_ids, args=(action_man,)) for action_man in action_mans]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(request_ids)), 4000)
+
+    def test_concurrent_batches(self):
+        lock = threading.Lock()
+        in_flight_users = []
+        overlaps = []
+        max_in_flight = [0]
+        class ConcurrentConnection(object):
+            def execute_multiple(self, actions):
+                users = [action.frame['user'] for action in actions]
+                with lock:
+                    overlaps.extend(user for user in users if user in in_flight_users)
+                    in_flight_users.extend(users)
+                    max_in_flight[0] = max(max_in_flight[0], len(in_flight_users))
+                time.sleep(random.random() * 0.01)
+                with lock:
+                    for user in users:
+                        in_flight_users.remove(user)
+                return 0, len(actions), len(actions)
+
+        action_man = user_sync.connector.dashboard.ActionManager(ConcurrentConnection(), "test org id", tests.helper.create_logger(), 2, 3, create_connection = ConcurrentConnection)
+
+        added = []
+        called_back = []
+        def add_action(index, user):
+            added.append(index)
+            action_man.add_action(MockAction(user), lambda result: callback(index))
+        def callback(index):
+            called_back.append(index)
+            # a follow-up action on the same user, as when a created user is then added to groups
+            if (index < 20):
+                add_action(index + 100, 'user%d' % (index % 7))
+        for index in range(0, 20):
+            add_action(index, 'user%d' % (index % 7))
+        while action_man.has_work():
+            action_man.flush()
+
+        self.assertEquals(called_back, added)
+        self.assertEquals(sorted(called_back), range(0, 20) + range(100, 120))
+        self.assertEquals(overlaps, [])
+        self.assertTrue(max_in_flight[0] <= 6)
+
+    def test_split_actions_on_thread_connections(self):
+        lock = threading.Lock()
+        connections = []
+        calls = []
+        class ThreadConnection(object):
+            def __init__(self):
+                self.threads = set()
+                self.action_queue = []
+                with lock:
+                    connections.append(self)
+
+            def execute_multiple(self, actions):
+                self.threads.add(threading.current_thread())
+                self.action_queue.append('left by a failed call')
+                split_count = sum((len(action.commands) + 9) // 10 for action in actions)
+                with lock:
+                    calls.append((actions, split_count))
+                time.sleep(random.random() * 0.01)
+                return 0, len(actions), len(actions)
+
+        shared_connection = ThreadConnection()
+        action_man = user_sync.connector.dashboard.ActionManager(shared_connection, "test org id", tests.helper.create_logger(), 10, 3, create_connection = ThreadConnection)
+        actions = []
+        for index in range(0, 30):
+            # every seventh action has more commands than the connection sends in one action
+            action = MockAction('user%d' % index, 25 if index % 7 == 0 else 1)
+            actions.append(action)
+            action_man.add_action(action)
+        action_man.flush()
+
+        self.assertEquals(sorted(id(action) for call_actions, _ in calls for action in call_actions), sorted(id(action) for action in actions))
+        self.assertTrue(all(split_count <= 10 for _, split_count in calls))
+        self.assertEquals(shared_connection.threads, set())
+        for connection in connections[1:]:
+            self.assertEquals(len(connection.threads), 1)
+            self.assertNotIn(threading.current_thread(), connection.threads)
+        self.assertTrue(1 < len(connections) <= 4)
+
+    def test_shared_connection_calls(self):
+        lock = threading.Lock()
+        in_flight = [0]
+        max_in_flight = [0]
+        class SharedConnection(object):
+            def execute_multiple(self, actions):
+                with lock:
+                    in_flight[0] += 1
+                    max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+                time.sleep(0.005)
+                with lock:
+                    in_flight[0] -= 1
+                return 0, len(actions), len(actions)
+
+        action_man = user_sync.connector.dashboard.ActionManager(SharedConnection(), "test org id", tests.helper.create_logger(), 2, 3)
+        for index in range(0, 20):
+            action_man.add_action(MockAction('user%d' % index))
+        action_man.flush()
+        self.assertEquals(max_in_flight[0], 1)
+
+class RateLimiterTest(unittest.TestCase):
+    def test_throttled_calls(self):
+        rate_limiter = user_sync.connector.dashboard.RateLimiter('test host')
+        rate_limiter.set_max_concurrency(4)
+        self.assertEquals(rate_limiter.get_concurrency(), 4)
+
+        class MockResult(object):
+            headers = {'Retry-After': '0'}
+        calls = []
+        def throttled_call(value):
+            calls.append(value)
+            if (len(calls) <= 2):
+                raise umapi_client.UnavailableError(1, 0, MockResult())
+            return value
+
+        logger = tests.helper.create_logger()
+        self.assertEquals(rate_limiter.call(throttled_call, ('value',), 4, 15, logger), 'value')
+        self.assertEquals(calls, ['value'] * 3)
+        self.assertEquals(rate_limiter.throttle_count, 2)
+        self.assertEquals(rate_limiter.call_count, 3)
+        # halved twice, then raised by the call that succeeded
+        self.assertEquals(rate_limiter.get_concurrency(), 2)
+        self.assertEquals(rate_limiter.get_batch_size(), 2)
+
+        # the limits grow back as calls succeed
+        for _ in range(0, 50):
+            rate_limiter.call(lambda: None, (), 4, 15, logger)
+        self.assertEquals(rate_limiter.get_concurrency(), 4)
+        self.assertEquals(rate_limiter.get_batch_size(), user_sync.connector.dashboard.ActionManager.max_batch_size)
+
+        # the last try is not retried
+        calls[:] = []
+        self.assertRaises(umapi_client.UnavailableError, rate_limiter.call, throttled_call, ('value',), 2, 15, logger)
+        self.assertEquals(len(calls), 2)
+
+    def test_retry_after(self):
+        get_retry_after = user_sync.connector.dashboard.RateLimiter.get_retry_after
+        class MockResult(object):
+            def __init__(self, headers):
+                self.headers = headers
+        self.assertEquals(get_retry_after(umapi_client.UnavailableError(1, 0, MockResult({'Retry-After': '7'})), 1, 15), 7)
+        delay = get_retry_after(umapi_client.UnavailableError(1, 0, MockResult({})), 3, 15)
+        self.assertTrue(60 <= delay < 75)
+
+class DashboardConnectorTest(unittest.TestCase):
+    def test_prefetched_user_pages(self):
+        page_count = 7
+        fetched_pages = []
+        class MockConnection(object):
+            def query_multiple(self, object_type, page):
+                fetched_pages.append(page)
+                time.sleep(random.random() * 0.01)
+                # the first user of each page is also the last one of the previous page
+                page_users = [{'email': 'user_%d_%d@example.com' % (page, index)} for index in range(0, 3)]
+                if (page > 0):
+                    page_users[0] = {'email': 'user_%d_2@example.com' % (page - 1)}
+                return page_users, page >= page_count - 1
+
+        for prefetch_pages in [1, 3]:
+            connector = user_sync.connector.dashboard.DashboardConnector.__new__(user_sync.connector.dashboard.DashboardConnector)
+            connector.options = {'server': {'retry_max_attempts': 1, 'retry_first_delay': 0, 'users_prefetch_pages': prefetch_pages}}
+            connector.logger = tests.helper.create_logger()
+            connector.connection = MockConnection()
+            connector.spare_connections = user_sync.connector.dashboard.SpareConnections(MockConnection)
+            connector.rate_limiter = user_sync.connector.dashboard.RateLimiter('test host')
+            connector.rate_limiter.set_max_concurrency(prefetch_pages)
+            connector.snapshot = None
+
+            del fetched_pages[:]
+            emails = [user['email'] for user in connector.iter_users()]
+            if (prefetch_pages > 1):
+                # each prefetching thread has a connection of its own
+                self.assertTrue(len(connector.spare_connections.connections) <= prefetch_pages)
+                self.assertEquals(len(set(id(connection) for connection in connector.spare_connections.connections)), len(connector.spare_connections.connections))
+
+            expected_emails = ['user_0_0@example.com'] + ['user_%d_%d@example.com' % (page, index) for page in range(0, page_count) for index in [1, 2]]
+            self.assertEquals(emails, expected_emails)
+            self.assertTrue(set(range(0, page_count)).issubset(fetched_pages))
+
+    @mock.patch('umapi_client.Connection')
+    def test_prefetch_concurrency(self, mock_connection):
+        enterprise_options = {'org_id': 'test org id', 'api_key': 'key', 'client_secret': 'secret', 'tech_acct': 'account', 'priv_key_path': 'private.key'}
+        connector = user_sync.connector.dashboard.DashboardConnector('test', {'server': {'host': 'prefetch test host', 'users_prefetch_pages': 4}, 'enterprise': enterprise_options})
+        # the pages are read 4 at a time even though the batches of actions are sent one at a time
+        self.assertEquals(connector.get_rate_limiter().get_concurrency(), 4)
+        self.assertEquals(connector.get_action_manager().max_in_flight_batches, 1)
+
+    def test_colliding_email_hashes(self):
+        class CollidingEmail(str):
+            def __hash__(self):
+                return 1
+
+        class MockConnection(object):
+            def query_multiple(self, object_type, page):
+                return [{'email': CollidingEmail('user1@example.com')}, {'email': CollidingEmail('user2@example.com')}, {'email': CollidingEmail('USER1@example.com')}], True
+
+        connector = user_sync.connector.dashboard.DashboardConnector.__new__(user_sync.connector.dashboard.DashboardConnector)
+        connector.options = {'server': {'retry_max_attempts': 1, 'retry_first_delay': 0, 'users_prefetch_pages': 1}}
+        connector.logger = tests.helper.create_logger()
+        connector.connection = MockConnection()
+        connector.rate_limiter = user_sync.connector.dashboard.RateLimiter('test host')
+        connector.snapshot = None
+        emails = [user['email'] for user in connector.iter_users()]
+        self.assertEquals(emails, ['user1@example.com', 'user2@example.com'])
+
+    def test_group_users(self):
+        queries = []
+        class MockConnection(object):
+            def query_multiple(self, object_type, page, url_params):
+                queries.append((page, url_params))
+                group_name = url_params[0]
+                page_users = [{'email': 'user_%d@example.com' % (page + index)} for index in range(0, 2)]
+                return page_users, page >= (1 if group_name == 'group 1' else 0)
+
+            def query_single(self, object_type, url_params):
+                return {'email': url_params[0]} if url_params[0] == 'user_0@example.com' else {}
+
+        connector = user_sync.connector.dashboard.DashboardConnector.__new__(user_sync.connector.dashboard.DashboardConnector)
+        connector.options = {'server': {'retry_max_attempts': 1, 'retry_first_delay': 0, 'users_prefetch_pages': 1}}
+        connector.logger = tests.helper.create_logger()
+        connector.connection = MockConnection()
+        connector.rate_limiter = user_sync.connector.dashboard.RateLimiter('test host')
+
+        emails = [user['email'] for user in connector.iter_group_users(['group 1', 'group 2'])]
+        self.assertEquals(emails, ['user_0@example.com', 'user_1@example.com', 'user_2@example.com'])
+        self.assertEquals(queries, [(0, ['group 1']), (1, ['group 1']), (0, ['group 2'])])
+        self.assertEquals(connector.get_user('user_0@example.com'), {'email': 'user_0@example.com'})
+        self.assertEquals(connector.get_user('user_9@example.com'), None)
+
+class MockIdentityType(object):
+    def __init__(self, name):
+        self.name = name
+
+class MockUserAction(object):
+    def __init__(self, user, commands, domain = None, identity_type = 'federatedID'):
+        self.frame = {'user': user}
+        if (domain != None):
+            self.frame['domain'] = domain
+        self.commands = commands
+        self.id_type = MockIdentityType(identity_type)
+
+class UserSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.temp_dir, 'users.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_snapshot(self, max_age_hours = 24, read_only = False):
+        return user_sync.connector.dashboard.UserSnapshot(self.snapshot_path, 'test org id', max_age_hours, read_only, tests.helper.create_logger())
+
+    def refresh_snapshot(self, snapshot, users):
+        snapshot.start_refresh()
+        for user in users:
+            snapshot.add_user(user)
+        snapshot.end_refresh()
+
+    def get_users_by_email(self, snapshot):
+        return dict((user['email'], user) for user in snapshot.iter_users())
+
+    def test_applied_actions(self):
+        snapshot = self.create_snapshot()
+        self.assertFalse(snapshot.load())
+        snapshot.start_refresh()
+        snapshot.add_user({'email': 'user1@example.com', 'username': 'user1@example.com', 'domain': 'example.com', 'type': 'federatedID', 'groups': ['Group 1']})
+        snapshot.add_user({'email': 'user2@example.com', 'username': 'user2', 'domain': 'example.com', 'type': 'federatedID', 'groups': ['Group 1']})
+        # an action done while the users are downloaded is applied once they all are
+        snapshot.apply_action(MockUserAction('user1@example.com', [{'add': {'product': ['group 1', 'Group 2']}}]), True)
+        snapshot.add_user({'email': 'user3@example.com', 'username': 'user3@example.com', 'domain': 'example.com', 'type': 'federatedID', 'groups': []})
+        snapshot.end_refresh()
+
+        snapshot.apply_action(MockUserAction('user2', [{'update': {'firstname': 'Two'}}, {'remove': {'usergroup': ['GROUP 1']}}], domain = 'example.com'), True)
+        snapshot.apply_action(MockUserAction('user3@example.com', [{'removeFromOrg': {}}]), True)
+        snapshot.apply_action(MockUserAction('user4@example.com', [{'createFederatedID': {'email': 'user4@example.com', 'country': 'CA', 'option': 'ignoreIfAlreadyExists'}}, {'add': {'product': ['Group 2']}}]), True)
+        snapshot.apply_action(MockUserAction('user5@example.com', [{'add': {'usergroup': ['Group 3']}}], identity_type = 'enterpriseID'), True)
+        snapshot.save()
+
+        snapshot = self.create_snapshot()
+        self.assertTrue(snapshot.load())
+        users_by_email = self.get_users_by_email(snapshot)
+        self.assertEquals(sorted(users_by_email.iterkeys()), ['user1@example.com', 'user2@example.com', 'user4@example.com', 'user5@example.com'])
+        self.assertEquals(users_by_email['user1@example.com']['groups'], ['Group 1', 'Group 2'])
+        self.assertEquals(users_by_email['user2@example.com']['groups'], [])
+        self.assertEquals(users_by_email['user2@example.com']['firstname'], 'Two')
+        self.assertEquals(users_by_email['user4@example.com']['country'], 'CA')
+        self.assertEquals(users_by_email['user4@example.com']['type'], 'federatedID')
+        self.assertEquals(users_by_email['user4@example.com']['groups'], ['Group 2'])
+        self.assertEquals(users_by_email['user5@example.com']['type'], 'enterpriseID')
+        self.assertEquals(users_by_email['user5@example.com']['groups'], ['Group 3'])
+
+    def test_failed_action(self):
+        snapshot = self.create_snapshot()
+        self.refresh_snapshot(snapshot, [{'email': 'user1@example.com', 'groups': []}])
+        snapshot.save()
+        snapshot = self.create_snapshot()
+        self.assertTrue(snapshot.load())
+        snapshot.apply_action(MockUserAction('user1@example.com', [{'add': {'product': ['Group 1']}}]), False)
+        snapshot.save()
+        self.assertFalse(self.create_snapshot().load())
+
+    def test_unfinished_run(self):
+        snapshot = self.create_snapshot()
+        self.refresh_snapshot(snapshot, [{'email': 'user1@example.com', 'groups': []}])
+        snapshot.save()
+        # a run that stops before saving leaves the snapshot it loaded
+        snapshot = self.create_snapshot()
+        self.assertTrue(snapshot.load())
+        snapshot.apply_action(MockUserAction('user2@example.com', [{'createFederatedID': {'email': 'user2@example.com'}}]), True)
+        snapshot = self.create_snapshot()
+        self.assertTrue(snapshot.load())
+        self.assertEquals(self.get_users_by_email(snapshot).keys(), ['user1@example.com'])
+
+    def test_max_age(self):
+        snapshot = self.create_snapshot()
+        self.refresh_snapshot(snapshot, [{'email': 'user1@example.com', 'groups': []}])
+        snapshot.refresh_time -= 25 * 3600
+        snapshot.save()
+        self.assertFalse(self.create_snapshot().load())
+        self.assertTrue(self.create_snapshot(48, True).load())
+
+    def test_read_only(self):
+        snapshot = self.create_snapshot()
+        self.refresh_snapshot(snapshot, [{'email': 'user1@example.com', 'groups': []}])
+        snapshot.save()
+
+        snapshot = self.create_snapshot(read_only = True)
+        self.assertTrue(snapshot.load())
+        snapshot.apply_action(MockUserAction('user1@example.com', [{'removeFromOrg': {}}]), True)
+        snapshot.save()
+        snapshot = self.create_snapshot()
+        self.assertTrue(snapshot.load())
+        self.assertEquals(self.get_users_by_email(snapshot).keys(), ['user1@example.com'])
@@ -1,39 +1,310 @@
+import bz2
+import gzip
+import os
+import shutil
 import string
+import sys
 import tempfile
 import unittest
 
 import user_sync.connector.directory
 import user_sync.connector.directory_csv
+import user_sync.helper
 import tests.helper
 
 class CSVDirectoryTest(unittest.TestCase):
 
-    def test_normal(self):
-        _, file_path = tempfile.mkstemp(".csv")
-        
-        field_names = ['firstname', 'lastname', 'email', 'country', 'groups']
-        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
-        user2 = tests.helper.create_test_user([])
-        
-        all_users = [user1, user2]
+    field_names = ['firstname', 'lastname', 'email', 'country', 'groups']
+
+    def create_temp_file(self, suffix):
+        '''
+        Creates an empty file that is removed when the test is done.
+        :type suffix: str
+        :rtype str
+        '''
+        handle, file_path = tempfile.mkstemp(suffix)
+        os.close(handle)
+        self.addCleanup(remove_file, file_path)
+        return file_path
+
+    def create_temp_dir(self):
+        '''
+        :rtype str
+        '''
+        dir_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir_path, True)
+        return dir_path
+
+    def write_users_file(self, file_path, all_users):
+        '''
+        Writes a row for each user, with the groups of the user joined in one column.  Returns all the groups.
+        :type file_path: str
+        :type all_users: list(dict)
+        :rtype set(str)
+        '''
         all_groups = set()
         csv_users = []
         for user in all_users:
-            csv_user = user.copy();
+            csv_user = user.copy()
             user_groups = user['groups']
             all_groups.update(user_groups)
             csv_user['groups'] = string.join(user_groups, ',')
             csv_users.append(csv_user)
-        tests.helper.write_to_separated_value_file(field_names, ',', csv_users, file_path);
-        
+        tests.helper.write_to_separated_value_file(self.field_names, ',', csv_users, file_path)
+        return all_groups
+
+    def create_connector(self, options):
+        '''
+        :type options: dict
+        :rtype user_sync.connector.directory.DirectoryConnector
+        '''
         directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_csv)
-        options = {
-            'file_path': file_path
-        }
         directory_connector.initialize(options)
-        
+        return directory_connector
+
+    def test_normal(self):
+        file_path = self.create_temp_file(".csv")
+
+        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user2 = tests.helper.create_test_user([])
+        all_users = [user1, user2]
+        all_groups = self.write_users_file(file_path, all_users)
+
+        directory_connector = self.create_connector({
+            'file_path': file_path
+        })
+
         all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups)
-                
+
+        self.assertTrue(all_loaded)
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+
+    def test_streaming(self):
+        file_path = self.create_temp_file(".csv")
+
+        all_users = [tests.helper.create_test_user(['Acrobat1', 'Acrobat2']) for _ in range(0, 4)]
+        all_users.append(tests.helper.create_test_user([]))
+        all_groups = set(['Acrobat1', 'Acrobat2'])
+
+        # one row per group of each user, so that a user is merged from several rows
+        grouped_rows = []
+        for user in all_users:
+            for group in user['groups'] or ['']:
+                csv_user = user.copy()
+                csv_user['groups'] = group
+                grouped_rows.append(csv_user)
+        unsorted_rows = grouped_rows[0::2] + grouped_rows[1::2]
+
+        for input_grouped_by_email, csv_rows in [(True, grouped_rows), (False, unsorted_rows)]:
+            tests.helper.write_to_separated_value_file(self.field_names, ',', csv_rows, file_path)
+
+            directory_connector = self.create_connector({
+                'file_path': file_path,
+                'streaming': True,
+                'input_grouped_by_email': input_grouped_by_email
+            })
+            # force the rows to be spilled to more than one sorted run
+            directory_connector.state.spill_run_length = 3
+
+            all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups)
+            actual_users = list(actual_users)
+
+            self.assertTrue(all_loaded)
+            self.assertEqual(len(all_users), len(actual_users))
+            tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_parallel_parse(self):
+        file_path = self.create_temp_file(".csv")
+
+        field_names = self.field_names + ['notes']
+        all_users = [tests.helper.create_test_user(['Acrobat1', 'Acrobat2']) for _ in range(0, 20)]
+        all_groups = set(['Acrobat1', 'Acrobat2'])
+
+        # each user has a row per group, far apart in the file, and values with quoted line breaks
+        csv_rows = []
+        for group in all_groups:
+            for user in all_users:
+                csv_user = user.copy()
+                csv_user['groups'] = group
+                csv_user['notes'] = 'first line\n"second" line\n'
+                csv_rows.append(csv_user)
+        tests.helper.write_to_separated_value_file(field_names, ',', csv_rows, file_path)
+
+        directory_connector = self.create_connector({
+            'file_path': file_path,
+            'parse_processes': 2
+        })
+        directory_connector.state.parse_min_range_size = 256
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups, ['notes'])
+        actual_users = list(actual_users)
+
         self.assertTrue(all_loaded)
         tests.helper.assert_equal_users(self, all_users, actual_users)
+        for actual_user in actual_users:
+            self.assertEqual('first line\n"second" line\n', actual_user['source_attributes']['notes'])
+
+    def test_parallel_parse_without_source_attributes(self):
+        file_path = self.create_temp_file(".csv")
+
+        all_users = [tests.helper.create_test_user(['Acrobat1', 'Acrobat2']) for _ in range(0, 20)]
+        all_groups = set(['Acrobat1', 'Acrobat2'])
+
+        # the rows of each user are in both halves of the file, so in different ranges
+        csv_rows = []
+        for group in sorted(all_groups):
+            for user in all_users:
+                csv_user = user.copy()
+                csv_user['groups'] = group
+                csv_rows.append(csv_user)
+        tests.helper.write_to_separated_value_file(self.field_names, ',', csv_rows, file_path)
+
+        directory_connector = self.create_connector({
+            'file_path': file_path,
+            'parse_processes': 2
+        })
+        directory_connector.state.parse_min_range_size = 256
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups, [], need_source_attributes=False)
+        actual_users = list(actual_users)
+
+        self.assertTrue(all_loaded)
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_compressed(self):
+        plain_file_path = self.create_temp_file(".csv")
+
+        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user2 = tests.helper.create_test_user([])
+        all_users = [user1, user2]
+        all_groups = self.write_users_file(plain_file_path, all_users)
+
+        # one found by the extension, one by the content
+        gzip_file_path = plain_file_path + '.gz'
+        bz2_file_path = plain_file_path + '.bz2.csv'
+        self.addCleanup(remove_file, gzip_file_path)
+        self.addCleanup(remove_file, bz2_file_path)
+        with open(plain_file_path, 'rb') as plain_file:
+            content = plain_file.read()
+        with gzip.GzipFile(gzip_file_path, 'wb') as output_file:
+            output_file.write(content)
+        with bz2.BZ2File(bz2_file_path, 'w') as output_file:
+            output_file.write(content)
+
+        for file_path in [gzip_file_path, bz2_file_path]:
+            directory_connector = self.create_connector({
+                'file_path': file_path,
+                'parse_processes': 2
+            })
+
+            all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups)
+
+            self.assertTrue(all_loaded)
+            tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_compressed_by_extension_or_content(self):
+        dir_path = self.create_temp_dir()
+        plain_users = [tests.helper.create_test_user(['Acrobat1'])]
+        gzip_users = [tests.helper.create_test_user(['Acrobat2'])]
+        all_groups = set(['Acrobat1', 'Acrobat2'])
+
+        # users.csv is plain and users.csv.gz compressed, and users.gz.csv is compressed without the extension
+        plain_file_path = os.path.join(dir_path, 'users.csv')
+        gzip_file_path = plain_file_path + '.gz'
+        unnamed_gzip_file_path = os.path.join(dir_path, 'users.gz.csv')
+        self.write_users_file(plain_file_path, plain_users)
+        source_file_path = os.path.join(dir_path, 'source.csv')
+        self.write_users_file(source_file_path, gzip_users)
+        with open(source_file_path, 'rb') as source_file:
+            content = source_file.read()
+        for file_path in [gzip_file_path, unnamed_gzip_file_path]:
+            with gzip.GzipFile(file_path, 'wb') as output_file:
+                output_file.write(content)
+
+        self.assertEqual(None, user_sync.helper.get_file_compression(plain_file_path))
+        self.assertEqual('gzip', user_sync.helper.get_file_compression(gzip_file_path, check_content = False))
+        self.assertEqual(None, user_sync.helper.get_file_compression(unnamed_gzip_file_path, check_content = False))
+        self.assertEqual('gzip', user_sync.helper.get_file_compression(unnamed_gzip_file_path))
+        for file_path, expected_users in [(plain_file_path, plain_users), (gzip_file_path, gzip_users), (unnamed_gzip_file_path, gzip_users)]:
+            directory_connector = self.create_connector({
+                'file_path': file_path
+            })
+
+            all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups)
+
+            self.assertTrue(all_loaded)
+            tests.helper.assert_equal_users(self, expected_users, actual_users)
+
+    def test_cache(self):
+        file_path = self.create_temp_file(".csv")
+        cache_path = self.create_temp_file(".cache")
+
+        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user2 = tests.helper.create_test_user([])
+        all_users = [user1, user2]
+        all_groups = self.write_users_file(file_path, all_users)
+
+        def load_users(options, expect_cached):
+            directory_connector = self.create_connector(dict(options, file_path=file_path, cache_path=cache_path))
+            read_users = directory_connector.state.read_users
+            read_count = []
+            def counting_read_users(*args, **kwargs):
+                read_count.append(1)
+                return read_users(*args, **kwargs)
+            directory_connector.state.read_users = counting_read_users
+
+            all_loaded, actual_users = directory_connector.load_users_and_groups(all_groups)
+            actual_users = list(actual_users)
+
+            self.assertTrue(all_loaded)
+            self.assertEqual(0 if expect_cached else 1, len(read_count))
+            return actual_users
+
+        tests.helper.assert_equal_users(self, all_users, load_users({}, False))
+        tests.helper.assert_equal_users(self, all_users, load_users({}, True))
+
+        # a change to the column mapping misses the cache
+        actual_users = load_users({'first_name_column_name': 'lastname'}, False)
+        self.assertEqual(set(['Test']), set(user['firstname'] for user in actual_users))
+        load_users({'first_name_column_name': 'lastname'}, True)
+
+        # as does a change to the file
+        user2['lastname'] = 'Changed'
+        self.write_users_file(file_path, all_users)
+        tests.helper.assert_equal_users(self, all_users, load_users({}, False))
+        tests.helper.assert_equal_users(self, all_users, load_users({}, True))
+
+        # even one that keeps the size and modification time
+        os.utime(file_path, (1500000000, 1500000000))
+        tests.helper.assert_equal_users(self, all_users, load_users({}, False))
+        file_size = os.path.getsize(file_path)
+        user2['lastname'] = 'Changes'
+        self.write_users_file(file_path, all_users)
+        os.utime(file_path, (1500000000, 1500000000))
+        self.assertEqual(file_size, os.path.getsize(file_path))
+        tests.helper.assert_equal_users(self, all_users, load_users({}, False))
+
+    def test_worker_processes_on_windows(self):
+        main_module = sys.modules['__main__']
+        main_path = getattr(main_module, '__file__', None)
+        real_os_name = os.name
+        os.name = 'nt'
+        try:
+            main_module.__file__ = os.path.join(self.create_temp_dir(), 'user-sync.pex', '__main__.py')
+            self.assertFalse(user_sync.connector.directory_csv.can_start_worker_processes())
+            main_module.__file__ = user_sync.connector.directory_csv.__file__
+            self.assertTrue(user_sync.connector.directory_csv.can_start_worker_processes())
+        finally:
+            os.name = real_os_name
+            if (main_path == None):
+                del main_module.__file__
+            else:
+                main_module.__file__ = main_path
 
+def remove_file(file_path):
+    '''
+    :type file_path: str
+    '''
+    if (os.path.exists(file_path)):
+        os.remove(file_path)
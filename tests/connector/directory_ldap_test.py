@@ -1,5 +1,7 @@
 import mock.mock
+import os
 import re
+import tempfile
 import unittest
 
 import user_sync.connector.directory
@@ -41,7 +43,7 @@ class LDAPDirectoryTest(unittest.TestCase):
             self.assertEqual(ldap_options['password'], args[1])
         
         def mock_search_s(*args, **kwargs):
-            search_result = re.search('cn=(.*?)\)', kwargs['filterstr'])            
+            search_result = re.search(r'cn=(.*?)\)', kwargs['filterstr'])            
             group_name = search_result.group(1)
             users = users_by_group.get(group_name, [])
             return [(group_name, {
@@ -86,3 +88,558 @@ class LDAPDirectoryTest(unittest.TestCase):
 
         self.assertTrue(all_loaded)
         tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_pipelined_group_resolution(self):
+        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user2 = tests.helper.create_test_user(['Acrobat1'])
+        user3 = tests.helper.create_test_user([])
+        all_users = [user1, user2, user3]
+
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'group_search_max_in_flight': 4
+        }
+
+        import ldap.ldapobject        
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+        responses = {}
+        msgids = []
+
+        def mock_search_ext(*args, **kwargs):
+            msgids.append(len(msgids) + 1)
+            msgid = msgids[-1]
+            if 'serverctrls' in kwargs:
+                responses[msgid] = [(user['firstname'], {
+                    'givenName': [user['firstname']],
+                    'sn': [user['lastname']],
+                    'c': [user['country']],
+                    'mail': [user['email']],
+                }) for user in all_users]
+            elif args[0] == 'test_base_dn':
+                group_name = re.search(r'cn=(.*?)\)', kwargs['filterstr']).group(1)
+                members = [user['firstname'] for user in all_users if group_name in user['groups']]
+                # the first member comes back with the group, the rest in a second range
+                responses[msgid] = [(group_name, {
+                    'member;range=0-0': members[:1]
+                } if len(members) > 1 else {
+                    'member': members
+                })]
+            else:
+                members = [user['firstname'] for user in all_users if args[0] in user['groups']]
+                responses[msgid] = [(args[0], {'member;range=1-*': members[1:]})]
+            return msgid
+
+        def mock_result3(*args, **kwargs):
+            msgid = min(responses.iterkeys())
+            return ldap.RES_SEARCH_RESULT, responses.pop(msgid), msgid, []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+        directory_connector.initialize(ldap_options)
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1', 'Acrobat2'])
+
+        self.assertTrue(all_loaded)
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_batched_group_lookup(self):
+        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user2 = tests.helper.create_test_user(['Acrobat1'])
+        user3 = tests.helper.create_test_user([])
+        all_users = [user1, user2, user3]
+
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'group_search_batch_size': 10
+        }
+
+        import ldap.ldapobject        
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+        responses = {}
+        group_filters = []
+
+        def mock_search_ext(*args, **kwargs):
+            msgid = len(group_filters) + 1
+            filter_string = kwargs['filterstr']
+            if filter_string.startswith('(|'):
+                group_filters.append(filter_string)
+                group_names = re.findall(r'cn=(.*?)\)', filter_string)
+                responses[msgid] = [('cn=%s' % group_name, {
+                    'cn': [group_name.upper()],
+                    'member': [user['firstname'] for user in all_users if group_name in user['groups']]
+                }) for group_name in group_names if group_name != 'Acrobat3']
+            else:
+                group_filters.append(None)
+                responses[msgid] = [(user['firstname'], {
+                    'givenName': [user['firstname']],
+                    'sn': [user['lastname']],
+                    'c': [user['country']],
+                    'mail': [user['email']],
+                }) for user in all_users]
+            return msgid
+
+        def mock_result3(*args, **kwargs):
+            return ldap.RES_SEARCH_RESULT, responses.pop(args[0]), args[0], []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+        directory_connector.initialize(ldap_options)
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1', 'Acrobat2', 'Acrobat3'])
+
+        self.assertTrue(all_loaded)
+        self.assertEqual(1, len([f for f in group_filters if f is not None]))
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_member_of_membership(self):
+        user1 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user2 = tests.helper.create_test_user(['Acrobat1'])
+        user3 = tests.helper.create_test_user([])
+        all_users = [user1, user2, user3]
+
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'user_group_membership_attribute': 'memberOf'
+        }
+
+        import ldap.ldapobject        
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+
+        def mock_search_s(*args, **kwargs):
+            group_name = re.search(r'cn=(.*?)\)', kwargs['filterstr']).group(1)
+            return [('CN=%s,OU=Groups' % group_name, {})]
+
+        def mock_search_ext(*args, **kwargs):
+            self.assertIn('memberOf', kwargs['attrlist'])
+            return 1
+
+        def mock_result3(*args, **kwargs):
+            rdata = [(user['firstname'], {
+                'givenName': [user['firstname']],
+                'sn': [user['lastname']],
+                'c': [user['country']],
+                'mail': [user['email']],
+                'memberOf': ['cn=%s, ou=groups' % group for group in user['groups']] + ['cn=Unmapped,ou=Groups'],
+            }) for user in all_users]
+            return ldap.RES_SEARCH_RESULT, rdata, 1, []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_s = mock_search_s
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+        directory_connector.initialize(ldap_options)
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1', 'Acrobat2'])
+
+        self.assertTrue(all_loaded)
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_group_filter_push_down(self):
+        user1 = tests.helper.create_test_user(['Acrobat1'])
+        all_users = [user1]
+
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'user_group_filter_attribute': 'memberOf',
+            'user_group_filter_in_chain': True,
+        }
+
+        import ldap.ldapobject        
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+        users_filters = []
+
+        def mock_search_s(*args, **kwargs):
+            group_name = re.search(r'cn=(.*?)\)', kwargs['filterstr']).group(1)
+            if group_name == 'Acrobat1':
+                return [('CN=Acrobat1,OU=Groups', {'member': [user1['firstname']]})]
+            return []
+
+        def mock_search_ext(*args, **kwargs):
+            users_filters.append(kwargs['filterstr'])
+            return 1
+
+        def mock_result3(*args, **kwargs):
+            rdata = [(user['firstname'], {
+                'givenName': [user['firstname']],
+                'sn': [user['lastname']],
+                'c': [user['country']],
+                'mail': [user['email']],
+            }) for user in all_users]
+            return ldap.RES_SEARCH_RESULT, rdata, 1, []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_s = mock_search_s
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+        directory_connector.initialize(ldap_options)
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1', 'Acrobat2'], [], set(['Acrobat1', 'Acrobat2']))
+
+        self.assertTrue(all_loaded)
+        self.assertEqual(1, len(users_filters))
+        self.assertTrue(users_filters[0].endswith('(memberOf:1.2.840.113556.1.4.1941:=cn=acrobat1,ou=groups))'))
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_partitioned_user_search(self):
+        user1 = tests.helper.create_test_user(['Acrobat1'])
+        user2 = tests.helper.create_test_user(['Acrobat1'])
+        user3 = tests.helper.create_test_user([])
+        all_users = [user1, user2, user3]
+        users_by_base = {
+            'test_base_dn': [user1],
+            'ou=a,test_base_dn': [user2],
+            'ou=b,test_base_dn': [user3],
+        }
+
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'search_split_base_dn': True,
+        }
+
+        import ldap.ldapobject        
+        import threading
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+        lock = threading.Lock()
+        responses = {}
+        searches = []
+
+        def mock_search_s(*args, **kwargs):
+            group_name = re.search(r'cn=(.*?)\)', kwargs['filterstr']).group(1)
+            return [(group_name, {'member': [user['firstname'] for user in all_users if group_name in user['groups']]})]
+
+        def mock_search_ext(*args, **kwargs):
+            with lock:
+                msgid = len(searches) + 1
+                searches.append((args[0], args[1]))
+                if kwargs['filterstr'].startswith('(!'):
+                    responses[msgid] = [('ou=a,test_base_dn', {}), ('ou=b,test_base_dn', {})]
+                else:
+                    responses[msgid] = [(user['firstname'], {
+                        'givenName': [user['firstname']],
+                        'sn': [user['lastname']],
+                        'c': [user['country']],
+                        'mail': [user['email']],
+                    }) for user in users_by_base[args[0]]]
+                return msgid
+
+        def mock_result3(*args, **kwargs):
+            with lock:
+                return ldap.RES_SEARCH_RESULT, responses.pop(args[0]), args[0], []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_s = mock_search_s
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+        directory_connector.initialize(ldap_options)
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1'])
+
+        self.assertTrue(all_loaded)
+        self.assertIn(('test_base_dn', ldap.SCOPE_ONELEVEL), searches)
+        self.assertIn(('ou=a,test_base_dn', ldap.SCOPE_SUBTREE), searches)
+        self.assertIn(('ou=b,test_base_dn', ldap.SCOPE_SUBTREE), searches)
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+
+    def test_search_failover(self):
+        ldap_options = {
+            'host': ['test_host1', 'test_host2'], 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+        }
+
+        import ldap.controls.libldap
+        import ldap.ldapobject
+        pages = [[('dn%d' % i, {}) for i in range(j * 2, j * 2 + 2)] for j in range(3)]
+        connections = {}
+
+        def create_connection(host):
+            connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+            cookies = []
+
+            def mock_search_ext(*args, **kwargs):
+                cookies.append(kwargs['serverctrls'][0].cookie)
+                return len(cookies)
+
+            def mock_result3(*args, **kwargs):
+                page_index = int(cookies[-1] or 0)
+                if (host == 'test_host1' and page_index == 2):
+                    raise ldap.SERVER_DOWN()
+                control = ldap.controls.libldap.SimplePagedResultsControl(True, size=2, cookie=str(page_index + 1) if page_index < 2 else '')
+                return ldap.RES_SEARCH_RESULT, pages[page_index], args[0], [control]
+
+            connection.search_ext = mock_search_ext
+            connection.result3 = mock_result3
+            connections[host] = connection
+            return connection
+
+        ldap.initialize = create_connection
+
+        connector = user_sync.connector.directory_ldap.LDAPDirectoryConnector(ldap_options)
+        dns = [dn for dn, _record in connector.iter_search_result('test_base_dn', ldap.SCOPE_SUBTREE, '(objectClass=user)', ['mail'])]
+
+        self.assertEqual(['dn0', 'dn1', 'dn2', 'dn3', 'dn4', 'dn5'], dns)
+        self.assertIs(connections['test_host2'], connector.connection)
+
+    def test_page_latency_with_slow_consumer(self):
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+        }
+
+        import ldap.controls.libldap
+        import ldap.ldapobject
+        pages = [[('dn%d' % i, {}) for i in range(j * 2, j * 2 + 2)] for j in range(3)]
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+        cookies = []
+
+        class MockClock(object):
+            now = 0.0
+            def time(self):
+                return self.now
+        clock = MockClock()
+
+        def mock_search_ext(*args, **kwargs):
+            cookies.append(kwargs['serverctrls'][0].cookie)
+            return len(cookies)
+
+        def mock_result3(*args, **kwargs):
+            # each page takes the server a second.
+            clock.now += 1
+            page_index = int(cookies[args[0] - 1] or 0)
+            control = ldap.controls.libldap.SimplePagedResultsControl(True, size=2, cookie=str(page_index + 1) if page_index < 2 else '')
+            return ldap.RES_SEARCH_RESULT, pages[page_index], args[0], [control]
+
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+        ldap.initialize = lambda *args, **kwargs: connection
+
+        connector = user_sync.connector.directory_ldap.LDAPDirectoryConnector(ldap_options)
+        real_time = user_sync.connector.directory_ldap.time
+        user_sync.connector.directory_ldap.time = clock
+        try:
+            dns = []
+            for dn, _record in connector.iter_search_result('test_base_dn', ldap.SCOPE_SUBTREE, '(objectClass=user)', ['mail']):
+                # the caller takes ten seconds over each entry.
+                clock.now += 10
+                dns.append(dn)
+        finally:
+            user_sync.connector.directory_ldap.time = real_time
+
+        self.assertEqual(['dn0', 'dn1', 'dn2', 'dn3', 'dn4', 'dn5'], dns)
+        page_statistics = connector.page_statistics
+        self.assertEqual(3, page_statistics.total_pages)
+        self.assertEqual(3.0, page_statistics.total_latency)
+        self.assertEqual(1.0, page_statistics.max_latency)
+
+    def test_delta_sync_ignores_member_of(self):
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'user_group_membership_attribute': 'memberOf',
+            'user_group_filter_attribute': 'memberOf',
+            'delta_sync_state_path': 'ldap-users-snapshot.dat',
+        }
+
+        import ldap.ldapobject
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+        ldap.initialize = lambda *args, **kwargs: connection
+
+        connector = user_sync.connector.directory_ldap.LDAPDirectoryConnector(ldap_options)
+        self.assertIsNone(connector.options['user_group_membership_attribute'])
+        self.assertIsNone(connector.options['user_group_filter_attribute'])
+
+        del ldap_options['delta_sync_state_path']
+        connector = user_sync.connector.directory_ldap.LDAPDirectoryConnector(ldap_options)
+        self.assertEqual('memberOf', connector.options['user_group_membership_attribute'])
+        self.assertEqual('memberOf', connector.options['user_group_filter_attribute'])
+
+    def test_value_formatter(self):
+        record = {'mail': ['user@example.com'], 'givenName': ['User'], 'sn': ['Test']}
+        LDAPValueFormatter = user_sync.connector.directory_ldap.LDAPValueFormatter
+
+        self.assertEqual(('user@example.com', 'mail'), LDAPValueFormatter('{mail}').generate_value(record))
+        self.assertEqual(('User.Test@example.com', 'sn'), LDAPValueFormatter('{givenName}.{sn}@example.com').generate_value(record))
+        self.assertEqual(('100%User', 'givenName'), LDAPValueFormatter('100%{givenName}').generate_value(record))
+        self.assertEqual(('        User', 'givenName'), LDAPValueFormatter('{givenName:>12}').generate_value(record))
+        self.assertEqual((None, 'uid'), LDAPValueFormatter('{uid}@example.com').generate_value(record))
+        self.assertEqual((None, None), LDAPValueFormatter(None).generate_value(record))
+        self.assertEqual([('user@example.com', 'mail'), (None, 'mail')], LDAPValueFormatter('{mail}').generate_values([record, {'mail': []}]))
+
+    def test_adaptive_page_size(self):
+        page_sizer = user_sync.connector.directory_ldap.LDAPPageSizer({
+            'search_page_size': 200,
+            'search_page_size_adaptive': True,
+            'search_page_size_min': 50,
+            'search_page_size_max': 1000,
+        })
+        # the server returns at most 500 entries a page, and larger pages are no faster
+        for _i in range(20):
+            requested_page_size = page_sizer.page_size
+            total_entries = min(requested_page_size, 500)
+            page_sizer.add_page(requested_page_size, total_entries, 0.1 + total_entries * 0.001, True)
+        self.assertEqual(500, page_sizer.max_page_size)
+        self.assertTrue(50 <= page_sizer.page_size <= 500)
+
+    def test_nested_group_expansion(self):
+        user1 = tests.helper.create_test_user(['Acrobat1'])
+        user2 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        user3 = tests.helper.create_test_user(['Acrobat1', 'Acrobat2'])
+        all_users = [user1, user2, user3]
+
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'group_nesting': 'expand',
+        }
+
+        # Acrobat1 has user1 and Nested1; Nested1 has user2, Nested2 and (a cycle) Acrobat1;
+        # Acrobat2 and Nested2 both have Shared, which has user3.
+        members_by_group_dn = {
+            'cn=Acrobat1': [user1['firstname'], 'cn=Nested1'],
+            'cn=Acrobat2': [user2['firstname'], 'cn=Shared'],
+            'cn=Nested1': [user2['firstname'], 'cn=Nested2', 'cn=Acrobat1'],
+            'cn=Nested2': ['cn=Shared'],
+            'cn=Shared': [user3['firstname']],
+        }
+        base_searches = []
+
+        import ldap.ldapobject        
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+
+        def mock_search_s(*args, **kwargs):
+            if (args[1] == ldap.SCOPE_BASE):
+                base_searches.append(args[0])
+                group_dn = args[0]
+            else:
+                group_dn = 'cn=%s' % re.search(r'cn=(.*?)\)', kwargs['filterstr']).group(1)
+            if (group_dn not in members_by_group_dn):
+                return []
+            return [(group_dn, {'member': members_by_group_dn[group_dn]})]
+
+        def mock_search_ext(*args, **kwargs):
+            return 1
+
+        def mock_result3(*args, **kwargs):
+            rdata = [(user['firstname'], {
+                'givenName': [user['firstname']],
+                'sn': [user['lastname']],
+                'c': [user['country']],
+                'mail': [user['email']],
+            }) for user in all_users]
+            return ldap.RES_SEARCH_RESULT, rdata, 1, []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_s = mock_search_s
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+        directory_connector.initialize(ldap_options)
+
+        all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1', 'Acrobat2'])
+
+        self.assertTrue(all_loaded)
+        tests.helper.assert_equal_users(self, all_users, actual_users)
+        self.assertEqual(1, base_searches.count('cn=Shared'))
+
+    def test_nested_group_lookup_errors(self):
+        user1 = tests.helper.create_test_user(['Acrobat1'])
+        all_users = [user1]
+
+        _, cache_path = tempfile.mkstemp(".cache")
+        ldap_options = {
+            'host': 'test_host', 
+            'username': 'test_user',
+            'password': 'xxx',
+            'base_dn': 'test_base_dn',
+            'group_nesting': 'expand',
+            'nested_group_cache_path': cache_path,
+        }
+
+        # besides user1, Acrobat1 has a disabled user that isn't loaded, a member in another domain
+        # and a member that can't be read; none of them is a group.
+        members_by_group_dn = {
+            'cn=Acrobat1': [user1['firstname'], 'cn=Disabled', 'cn=Referred', 'cn=Hidden'],
+        }
+        base_searches = []
+
+        import ldap.ldapobject        
+        connection = mock.mock.create_autospec(ldap.ldapobject.LDAPObject)
+
+        def mock_search_s(*args, **kwargs):
+            if (args[1] == ldap.SCOPE_BASE):
+                base_searches.append(args[0])
+                group_dn = args[0]
+                if (group_dn == 'cn=Referred'):
+                    raise ldap.REFERRAL()
+                if (group_dn == 'cn=Hidden'):
+                    raise ldap.INSUFFICIENT_ACCESS()
+            else:
+                group_dn = 'cn=%s' % re.search(r'cn=(.*?)\)', kwargs['filterstr']).group(1)
+            if (group_dn not in members_by_group_dn):
+                return []
+            return [(group_dn, {'member': members_by_group_dn[group_dn]})]
+
+        def mock_search_ext(*args, **kwargs):
+            return 1
+
+        def mock_result3(*args, **kwargs):
+            rdata = [(user['firstname'], {
+                'givenName': [user['firstname']],
+                'sn': [user['lastname']],
+                'c': [user['country']],
+                'mail': [user['email']],
+            }) for user in all_users]
+            return ldap.RES_SEARCH_RESULT, rdata, 1, []
+
+        ldap.initialize = lambda *args, **kwargs: connection
+        connection.search_s = mock_search_s
+        connection.search_ext = mock_search_ext
+        connection.result3 = mock_result3
+
+        try:
+            for _run in range(2):
+                directory_connector = user_sync.connector.directory.DirectoryConnector(user_sync.connector.directory_ldap)
+                directory_connector.initialize(ldap_options)
+                all_loaded, actual_users = directory_connector.load_users_and_groups(['Acrobat1'])
+                self.assertTrue(all_loaded)
+                tests.helper.assert_equal_users(self, all_users, actual_users)
+        finally:
+            os.remove(cache_path)
+
+        # the members that the server answered for are only looked up on the first run.
+        self.assertEqual(['cn=Disabled', 'cn=Referred', 'cn=Hidden', 'cn=Hidden'], base_searches)
@@ -0,0 +1,40 @@
+import cPickle
+import unittest
+
+import user_sync.connector.helper
+
+class DirectoryUserTest(unittest.TestCase):
+
+    def test_mapping_access(self):
+        user = user_sync.connector.helper.create_blank_user()
+        user['email'] = 'user@example.com'
+        user['groups'].append('Acrobat1')
+        user['groups'].extend(['Acrobat1', 'Acrobat2'])
+        layout = user_sync.connector.helper.SourceAttributeLayout(['email'], ['c'], lambda record, name: record[name][0])
+        user['source_attributes'] = user_sync.connector.helper.SourceAttributes(layout, {'c': ['US']}, ('user@example.com',))
+
+        self.assertEqual('user@example.com', user['email'])
+        self.assertEqual(set(['Acrobat1', 'Acrobat2']), user['groups'])
+        self.assertEqual({'email': 'user@example.com', 'c': 'US'}, user['source_attributes'])
+        self.assertEqual('US', user['source_attributes'].get('c'))
+        self.assertIsNone(user['source_attributes'].get('uid'))
+        self.assertIsNone(user.get('uid'))
+        self.assertRaises(KeyError, lambda: user['uid'])
+        self.assertNotIn('uid', user)
+
+        user.update({'uid': 'user', 'department': 'Sales'})
+        self.assertEqual('user', user['uid'])
+        self.assertEqual('Sales', user['department'])
+        self.assertIn('department', user.keys())
+
+    def test_pickle(self):
+        user = user_sync.connector.helper.create_blank_user()
+        user['email'] = 'user@example.com'
+        user['groups'].append('Acrobat1')
+        layout = user_sync.connector.helper.SourceAttributeLayout([], ['mail'], lambda record, name: record[name][0])
+        user['source_attributes'] = user_sync.connector.helper.SourceAttributes(layout, {'mail': ['user@example.com']})
+
+        loaded_user = cPickle.loads(cPickle.dumps(user, cPickle.HIGHEST_PROTOCOL))
+
+        self.assertEqual(user, loaded_user)
+        self.assertEqual({'mail': 'user@example.com'}, loaded_user['source_attributes'])
@@ -90,6 +90,9 @@ class MockGetString():
     def get_int(self,test1):
         return 1
 
+    def get_bool(self,test1,test2):
+        return None
+
     def iter_dict_configs(self):
         return iter([])
 
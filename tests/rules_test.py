@@ -18,7 +18,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import logging
 import mock.mock
+import threading
 import unittest
 
 import user_sync.connector.dashboard
@@ -53,7 +55,7 @@ class RulesTest(unittest.TestCase):
         owning_user_1['groups'] = [owning_group_11]
         owning_users.append(owning_user_1)
         
-        def mock_load_users_and_groups(groups, extended_attributes=None):
+        def mock_load_users_and_groups(groups, extended_attributes=None, directory_group_filter=None, need_source_attributes=True):
             return (True, list(all_users))
         mock_directory_connector = mock.mock.create_autospec(user_sync.connector.directory.DirectoryConnector)
         mock_directory_connector.load_users_and_groups = mock_load_users_and_groups
@@ -200,3 +202,157 @@ class RulesTest(unittest.TestCase):
         mock_connector.get_action_manager = lambda: action_manager
         return mock_connector
 
+
+class DashboardUserPrefetchTest(unittest.TestCase):
+    def test_prefetch(self):
+        dashboard_users = [{'email': 'user_%d@example.com' % index} for index in range(0, 2500)]
+        class MockConnector(object):
+            def iter_users(self):
+                return iter(dashboard_users)
+
+        prefetch = user_sync.rules.DashboardUserPrefetch(MockConnector())
+        self.assertEquals(list(prefetch.iter_users()), dashboard_users)
+
+    def test_prefetch_error(self):
+        class MockConnector(object):
+            def iter_users(self):
+                yield {'email': 'user@example.com'}
+                raise ValueError('download failed')
+
+        prefetch = user_sync.rules.DashboardUserPrefetch(MockConnector())
+        self.assertRaises(ValueError, list, prefetch.iter_users())
+
+class AccessorWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.log_records = []
+        self.log_handler = user_sync.rules.LogRecordBuffer(self.log_records)
+        logger = logging.getLogger('processor')
+        logger.addHandler(self.log_handler)
+        self.previous_level = logger.level
+        logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        logger = logging.getLogger('processor')
+        logger.removeHandler(self.log_handler)
+        logger.setLevel(self.previous_level)
+
+    def create_dashboard_connectors(self, organization_names):
+        class MockDashboardConnectors(object):
+            def get_accessor_connectors(self):
+                return dict((organization_name, 'connector ' + organization_name) for organization_name in organization_names)
+        return MockDashboardConnectors()
+
+    def test_concurrent_accessors(self):
+        organization_names = ['org%d' % index for index in range(0, 6)]
+        dashboard_connectors = self.create_dashboard_connectors(organization_names)
+        rule_processor = user_sync.rules.RuleProcessor({'accessor_workers': 3})
+        threads_by_organization_name = {}
+        def sync_accessor(organization_name, dashboard_connector):
+            self.assertEquals(dashboard_connector, 'connector ' + organization_name)
+            threads_by_organization_name[organization_name] = threading.current_thread()
+            rule_processor.logger.info('Syncing accessor %s...', organization_name)
+            rule_processor.logger.debug('Not logged: %s', organization_name)
+            rule_processor.logger.info('Synced accessor %s', organization_name)
+
+        rule_processor.for_each_accessor_connector(dashboard_connectors, sync_accessor)
+        self.assertEquals(set(threads_by_organization_name.iterkeys()), set(organization_names))
+        self.assertNotIn(threading.current_thread(), threads_by_organization_name.values())
+
+        # the messages of each organization are logged together, in organization order
+        expected_messages = []
+        for organization_name in dashboard_connectors.get_accessor_connectors().iterkeys():
+            expected_messages.append('Syncing accessor %s...' % organization_name)
+            expected_messages.append('Synced accessor %s' % organization_name)
+        self.assertEquals([log_record.getMessage() for log_record in self.log_records], expected_messages)
+        self.assertIs(rule_processor.logger, logging.getLogger('processor'))
+
+    def test_accessor_error(self):
+        dashboard_connectors = self.create_dashboard_connectors(['org1', 'org2'])
+        rule_processor = user_sync.rules.RuleProcessor({'accessor_workers': 2})
+        def sync_accessor(organization_name, dashboard_connector):
+            rule_processor.logger.info('Syncing accessor %s...', organization_name)
+            if (organization_name == 'org2'):
+                raise ValueError('sync failed')
+
+        self.assertRaises(ValueError, rule_processor.for_each_accessor_connector, dashboard_connectors, sync_accessor)
+        # the messages of all the organizations are logged before the error is raised
+        self.assertEquals(sorted(log_record.getMessage() for log_record in self.log_records), ['Syncing accessor org1...', 'Syncing accessor org2...'])
+
+class QueryMappedGroupsOnlyTest(unittest.TestCase):
+    def create_user(self, name, groups = None):
+        email = name + '@example.com'
+        return {'email': email, 'username': email, 'domain': 'example.com', 'type': 'federatedID', 'identitytype': 'federatedID',
+                'firstname': name, 'lastname': 'User', 'country': 'US', 'groups': groups if groups != None else []}
+
+    def sync_owning_users(self, options, queries, sent_commands):
+        '''
+        Syncs directory users member and outside, in Group 1, and new, in no group, with dashboard users
+        member and former, in Group 1, and outside, in no group.
+        :type options: dict
+        :type queries: list
+        :type sent_commands: list
+        :rtype (RuleProcessor, OrganizationInfo, dict)
+        '''
+        dashboard_users = {
+            'member@example.com': self.create_user('member', ['Group 1']),
+            'former@example.com': self.create_user('former', ['Group 1']),
+            'outside@example.com': self.create_user('outside'),
+        }
+        class MockConnector(object):
+            def iter_users(self):
+                queries.append(('all',))
+                return dashboard_users.itervalues()
+
+            def iter_group_users(self, group_names):
+                queries.append(('group', group_names))
+                return (user for user in dashboard_users.itervalues() if 'Group 1' in user['groups'])
+
+            def get_user(self, email):
+                queries.append(('user', email))
+                return dashboard_users.get(email)
+
+            def send_commands(self, commands, callback = None):
+                if (len(commands) > 0):
+                    sent_commands.append(commands)
+
+        rule_processor = user_sync.rules.RuleProcessor(options)
+        organization_info = rule_processor.get_organization_info(user_sync.rules.OWNING_ORGANIZATION_NAME)
+        group_1 = user_sync.rules.TargetGroup('Group 1', user_sync.rules.DESIGNATION_GROUP)
+        organization_info.add_mapped_group(group_1)
+        for name, groups in [('member', [group_1]), ('outside', [group_1]), ('new', [])]:
+            directory_user = self.create_user(name)
+            user_key = rule_processor.get_directory_user_key(directory_user)
+            rule_processor.directory_user_by_user_key[user_key] = rule_processor.filtered_directory_user_by_user_key[user_key] = directory_user
+            organization_info.add_desired_group_for(user_key, None)
+            for group in groups:
+                organization_info.add_desired_group_for(user_key, group)
+
+        unprocessed_groups_by_user_key = rule_processor.update_dashboard_users_for_connector(organization_info, MockConnector())
+        return (rule_processor, organization_info, unprocessed_groups_by_user_key)
+
+    def test_owning_users(self):
+        queries = []
+        sent_commands = []
+        _rule_processor, organization_info, unprocessed_groups_by_user_key = self.sync_owning_users({'query_mapped_groups_only': True, 'update_user_info': False}, queries, sent_commands)
+        self.assertEquals(unprocessed_groups_by_user_key.keys(), ['federatedID,new@example.com,'])
+        self.assertEquals(queries[0], ('group', ['group 1']))
+        self.assertEquals(sorted(queries[1:]), [('user', 'new@example.com'), ('user', 'outside@example.com')])
+        self.assertFalse(organization_info.is_dashboard_users_loaded())
+        self.assertEquals(sorted(commands.username for commands in sent_commands), ['former@example.com', 'outside@example.com'])
+
+    def test_too_many_lookups(self):
+        queries = []
+        sent_commands = []
+        options = {'query_mapped_groups_only': True, 'query_mapped_groups_max_lookups': 1, 'update_user_info': False}
+        _rule_processor, organization_info, unprocessed_groups_by_user_key = self.sync_owning_users(options, queries, sent_commands)
+        # the two users not in Group 1 are found by reading all the users rather than looking each up
+        self.assertEquals(unprocessed_groups_by_user_key.keys(), ['federatedID,new@example.com,'])
+        self.assertEquals(queries, [('group', ['group 1']), ('all',)])
+        self.assertFalse(organization_info.is_dashboard_users_loaded())
+        self.assertEquals(sorted(commands.username for commands in sent_commands), ['former@example.com', 'outside@example.com'])
+
+    def test_ignored_with_orphans(self):
+        rule_processor = user_sync.rules.RuleProcessor({'query_mapped_groups_only': True, 'remove_nonexistent_users': True})
+        self.assertFalse(rule_processor.query_mapped_groups_only)
+        organization_info = rule_processor.get_organization_info(user_sync.rules.OWNING_ORGANIZATION_NAME)
+        self.assertEquals(rule_processor.get_query_group_names(organization_info), None)
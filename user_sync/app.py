@@ -22,6 +22,7 @@ import argparse
 import config
 import datetime
 import logging
+import multiprocessing
 import os
 import re
 import sys
@@ -137,6 +138,7 @@ def begin_work(config_loader):
     directory_groups = config_loader.get_directory_groups()
     owning_dashboard_config = config_loader.get_dashboard_options_for_owning()
     accessor_dashboard_configs = config_loader.get_dashboard_options_for_accessors()
+    check_snapshot_paths(owning_dashboard_config, accessor_dashboard_configs)
     rule_config = config_loader.get_rule_options()
 
     # process mapped configuration after the directory groups have been loaded, as mapped setting depends on this.
@@ -179,6 +181,25 @@ def begin_work(config_loader):
         logger.warn('no groups mapped in config file')
     rule_processor.run(directory_groups, directory_connector, dashboard_connectors)
     
+def check_snapshot_paths(owning_dashboard_config, accessor_dashboard_configs):
+    '''
+    Each organization needs a snapshot file of its own, as the snapshot of one would replace that of another.
+    :type owning_dashboard_config: dict
+    :type accessor_dashboard_configs: dict(str, dict)
+    '''
+    dashboard_configs = [('owning', owning_dashboard_config)]
+    dashboard_configs.extend(('accessor.%s' % organization_name, dashboard_config) for organization_name, dashboard_config in sorted(accessor_dashboard_configs.iteritems()))
+    dashboard_name_by_path = {}
+    for dashboard_name, dashboard_config in dashboard_configs:
+        snapshot_config = dashboard_config.get('snapshot')
+        snapshot_path = snapshot_config.get('path') if isinstance(snapshot_config, dict) else None
+        if (snapshot_path == None):
+            continue
+        normalized_path = os.path.normcase(os.path.abspath(snapshot_path))
+        if (normalized_path in dashboard_name_by_path):
+            raise user_sync.error.AssertionException('Dashboards %s and %s have the same snapshot path: %s' % (dashboard_name_by_path[normalized_path], dashboard_name, snapshot_path))
+        dashboard_name_by_path[normalized_path] = dashboard_name
+
 def create_config_loader(args):
     config_bootstrap_options = {
         'config_directory': args.config_path,
@@ -253,6 +274,8 @@ def create_config_loader_options(args):
     return config_options
 
 def main():
+    # in a frozen program on Windows, runs the worker processes of parse_processes instead of another sync.
+    multiprocessing.freeze_support()
     run_stats = None 
     try:
         try:
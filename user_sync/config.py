@@ -324,6 +324,23 @@ class ConfigLoader(object):
                                      user_sync.identity_type.FEDERATED_IDENTITY_TYPE]
             self.logger.info("Using default for managed_identity_types: %s", managed_identity_types)
 
+        prefetch_dashboard_users = False
+        accessor_workers = 1
+        query_mapped_groups_only = False
+        query_mapped_groups_max_lookups = 100
+        dashboard_config = self.main_config.get_dict_config('dashboard', True)
+        if (dashboard_config != None):
+            prefetch_dashboard_users = dashboard_config.get_bool('prefetch_users', True) or False
+            accessor_workers = dashboard_config.get_int('accessor_workers', True) or 1
+            if (accessor_workers < 1):
+                raise user_sync.error.AssertionException('accessor_workers must be at least 1')
+            query_mapped_groups_only = dashboard_config.get_bool('query_mapped_groups_only', True) or False
+            query_mapped_groups_max_lookups = dashboard_config.get_int('query_mapped_groups_max_lookups', True)
+            if (query_mapped_groups_max_lookups == None):
+                query_mapped_groups_max_lookups = 100
+            elif (query_mapped_groups_max_lookups < 0):
+                raise user_sync.error.AssertionException('query_mapped_groups_max_lookups must not be negative')
+
         limits_config = self.main_config.get_dict_config('limits')
         max_deletions_per_run = limits_config.get_int('max_deletions_per_run')
         max_missing_users = limits_config.get_int('max_missing_users')
@@ -377,6 +394,10 @@ class ConfigLoader(object):
             'max_missing_users': max_missing_users,
             'after_mapping_hook': after_mapping_hook,
             'extended_attributes': extended_attributes,
+            'prefetch_dashboard_users': prefetch_dashboard_users,
+            'accessor_workers': accessor_workers,
+            'query_mapped_groups_only': query_mapped_groups_only,
+            'query_mapped_groups_max_lookups': query_mapped_groups_max_lookups,
         }
         return result
 
@@ -634,6 +655,17 @@ class OptionsBuilder(object):
         '''
         self.set_value(key, dict, default_value)
     
+    def set_list_value(self, key, default_value):
+        '''
+        :type key: str
+        :type default_value: list
+        '''
+        value = default_value
+        config = self.default_config
+        if (config != None and config.has_key(key)):
+            value = config.get_list(key, False)
+        self.options[key] = value
+
     def set_value(self, key, allowed_types, default_value):
         '''
         :type key: str
@@ -18,8 +18,17 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import cPickle
+import email.utils
+import hashlib
 import json
 import logging
+import multiprocessing.pool
+import os
+import random
+import threading
+import time
 
 import jwt
 import umapi_client
@@ -55,7 +64,25 @@ class DashboardConnector(object):
         server_builder.set_string_value('endpoint', '/v2/usermanagement')
         server_builder.set_string_value('ims_host', 'ims-na1.adobelogin.com')
         server_builder.set_string_value('ims_endpoint_jwt', '/ims/exchange/jwt')
+        server_builder.set_int_value('action_batch_size', 10)
+        server_builder.set_int_value('max_in_flight_batches', 1)
+        server_builder.set_int_value('retry_max_attempts', 4)
+        server_builder.set_int_value('retry_first_delay', 15)
+        server_builder.set_int_value('users_prefetch_pages', 1)
         options['server'] = server_options = server_builder.get_options() 
+
+        snapshot_config = caller_config.get_dict_config('snapshot', True)
+        snapshot_builder = user_sync.config.OptionsBuilder(snapshot_config)
+        snapshot_builder.set_string_value('path', None)
+        snapshot_builder.set_int_value('max_age_hours', 24)
+        options['snapshot'] = snapshot_options = snapshot_builder.get_options()
+
+        action_batch_size = server_options['action_batch_size']
+        if (action_batch_size < 1 or action_batch_size > ActionManager.max_batch_size):
+            raise user_sync.error.AssertionException('"action_batch_size" must be from 1 to %d' % ActionManager.max_batch_size)
+        max_in_flight_batches = server_options['max_in_flight_batches']
+        if (max_in_flight_batches < 1):
+            raise user_sync.error.AssertionException('"max_in_flight_batches" must be at least 1')
         
         enterprise_config = caller_config.get_dict_config('enterprise')
         enterprise_builder = user_sync.config.OptionsBuilder(enterprise_config)
@@ -84,32 +111,157 @@ class DashboardConnector(object):
             "client_secret": enterprise_options['client_secret'],
             "private_key_file": private_key_file_path
         }
-        self.connection = connection = umapi_client.Connection(
-            org_id=org_id, 
-            auth_dict=auth_dict, 
-            ims_host=ims_host,
-            ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
-            user_management_endpoint=um_endpoint,
-            test_mode=options['test_mode'],
-            user_agent="user-sync/" + APP_VERSION
-        )
+        def create_connection():
+            return umapi_client.Connection(
+                org_id=org_id, 
+                auth_dict=auth_dict, 
+                ims_host=ims_host,
+                ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
+                user_management_endpoint=um_endpoint,
+                test_mode=options['test_mode'],
+                throttle_actions=action_batch_size,
+                throttle_commands=ActionManager.max_commands_per_action,
+                # calls are retried by call_server, through the rate limiter shared by the connections to the host
+                retry_max_attempts=1,
+                user_agent="user-sync/" + APP_VERSION
+            )
+        self.connection = connection = create_connection()
+        self.spare_connections = SpareConnections(create_connection)
         logger.info('API initialized on: %s', um_endpoint)
         
-        self.action_manager = ActionManager(connection, org_id, logger)
+        self.rate_limiter = rate_limiter = RateLimiter.get_rate_limiter(server_options['host'])
+        # the calls for the actions and for the pages of users each keep to their own limit, so the host can take
+        # as many calls at a time as the larger of the two
+        rate_limiter.set_max_concurrency(max(max_in_flight_batches, server_options['users_prefetch_pages']))
+
+        self.snapshot = snapshot = None
+        if (snapshot_options['path'] != None):
+            self.snapshot = snapshot = UserSnapshot(snapshot_options['path'], org_id, snapshot_options['max_age_hours'], options['test_mode'], logger)
+        self.action_manager = ActionManager(connection, org_id, logger, action_batch_size, max_in_flight_batches, self.call_server, rate_limiter, snapshot, create_connection)
     
     def get_users(self):
         return list(self.iter_users())
 
     def iter_users(self):
-        users = {}
-        for u in umapi_client.UsersQuery(self.connection):
-            email = u['email']
-            if not (email in users):
-                users[email] = u
+        '''
+        With a snapshot configured, the users are read from the snapshot while it is younger than its max age.
+        Otherwise they are downloaded, and the snapshot is refreshed with them once they have all been read.
+        :rtype iterable(dict)
+        '''
+        snapshot = self.snapshot
+        if (snapshot != None and snapshot.load()):
+            for u in snapshot.iter_users():
                 yield u
+            return
+        if (snapshot != None):
+            snapshot.start_refresh()
+        email_digests = set()
+        for page_users in self.iter_user_pages(self.options['server']['users_prefetch_pages']):
+            for u in page_users:
+                email_digest = self.get_email_digest(u['email'])
+                if not (email_digest in email_digests):
+                    email_digests.add(email_digest)
+                    if (snapshot != None):
+                        snapshot.add_user(u)
+                    yield u
+        if (snapshot != None):
+            snapshot.end_refresh()
+
+    def iter_group_users(self, group_names):
+        '''
+        Yields the users that are members of any of the groups, each once.  The snapshot is not used, as it holds
+        all the users.
+        :type group_names: iterable(str)
+        :rtype iterable(dict)
+        '''
+        email_digests = set()
+        for group_name in group_names:
+            for page_users in self.iter_user_pages(self.options['server']['users_prefetch_pages'], group_name):
+                for u in page_users:
+                    email_digest = self.get_email_digest(u['email'])
+                    if not (email_digest in email_digests):
+                        email_digests.add(email_digest)
+                        yield u
+
+    @staticmethod
+    def get_email_digest(email):
+        '''
+        Users are told apart by a digest of their email, which takes much less memory than the users themselves.
+        The digest is 128 bits wide, unlike hash() which is only 32 bits on some platforms, so that different
+        emails do not collide.
+        :type email: str
+        :rtype str
+        '''
+        email = email.lower()
+        if (isinstance(email, unicode)):
+            email = email.encode('utf-8')
+        return hashlib.sha1(email).digest()[:16]
+
+    def get_user(self, email):
+        '''
+        Looks up a single user by email.
+        :type email: str
+        :rtype dict, or None if there is no such user in the organization
+        '''
+        user = self.call_server(self.connection.query_single, 'user', [email])
+        return user if user else None
+
+    def iter_user_pages(self, prefetch_pages = 1, group_name = None):
+        '''
+        Yields the list of users of each page, in page order.  With prefetch_pages greater than 1, that many pages
+        are fetched at the same time, ahead of the page being yielded.  With group_name, only the members of that
+        group are listed.
+        :type prefetch_pages: int
+        :type group_name: str
+        :rtype iterable(list(dict))
+        '''
+        query_multiple = self.connection.query_multiple
+        group_args = ([group_name],) if group_name != None else ()
+        if (prefetch_pages <= 1):
+            page = 0
+            while True:
+                page_users, is_last_page = self.call_server(query_multiple, 'user', page, *group_args)
+                yield page_users
+                if (is_last_page):
+                    return
+                page += 1
+
+        pool = multiprocessing.pool.ThreadPool(prefetch_pages)
+        try:
+            page_results = collections.deque()
+            next_page = 0
+            while True:
+                while (len(page_results) < prefetch_pages):
+                    page_results.append(pool.apply_async(self.call_server, (self.spare_connections.query_multiple, 'user', next_page) + group_args))
+                    next_page += 1
+                page_users, is_last_page = page_results.popleft().get()
+                yield page_users
+                if (is_last_page):
+                    # any pages fetched past the last one are dropped
+                    return
+        finally:
+            pool.terminate()
+
+    def call_server(self, function, *args):
+        '''
+        Calls function, a method of the connection, with args, through the rate limiter of the host.
+        :type function: callable
+        '''
+        server_options = self.options['server']
+        return self.rate_limiter.call(function, args, server_options['retry_max_attempts'], server_options['retry_first_delay'], self.logger)
+
+    def get_rate_limiter(self):
+        return self.rate_limiter
     
     def get_action_manager(self):
         return self.action_manager
+
+    def save_snapshot(self):
+        '''
+        Saves the snapshot of the users, if there is one and it is up to date.  Call once the actions are done.
+        '''
+        if (self.snapshot != None):
+            self.snapshot.save()
     
     def send_commands(self, commands, callback = None):
         '''
@@ -121,6 +273,411 @@ class DashboardConnector(object):
             action = action_manager.create_action(commands)
             action_manager.add_action(action, callback)
 
+class SpareConnections(object):
+    '''
+    Connections for the calls made on other threads, as a connection is not safe to use from several threads.
+    A connection is taken for each call and kept for the next once the call is done, so that only as many
+    connections are made, each with its own access token, as there are calls at a time.
+    '''
+    def __init__(self, create_connection):
+        '''
+        :type create_connection: callable() -> umapi_client.Connection
+        '''
+        self.create_connection = create_connection
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def query_multiple(self, *args):
+        with self.lock:
+            connection = self.connections.pop() if len(self.connections) > 0 else None
+        if (connection == None):
+            connection = self.create_connection()
+        try:
+            return connection.query_multiple(*args)
+        finally:
+            with self.lock:
+                self.connections.append(connection)
+
+class UserSnapshot(object):
+    '''
+    A copy of the users of an organization, kept in a file from one run to the next so that the users need not be
+    downloaded on every run.  The copy is refreshed by downloading the users once it is older than max_age_hours,
+    which picks up the changes made outside of user sync, and in between it is kept up to date by applying to it
+    the actions that succeed.  When an action fails, or does something the snapshot cannot follow, what the user
+    now looks like is not known, so the snapshot is dropped and the next run downloads the users again.
+    The file is kept while a run uses it, and is only replaced once the actions are done, so a run that stops
+    early leaves the previous snapshot; the next run then sends again the actions that were done, which leave
+    the users as they are, or fail and drop the snapshot.
+    '''
+    format_version = 1
+    type_by_create_command = {
+        'addAdobeID': user_sync.identity_type.ADOBEID_IDENTITY_TYPE,
+        'createEnterpriseID': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
+        'createFederatedID': user_sync.identity_type.FEDERATED_IDENTITY_TYPE,
+    }
+    update_attributes = ['email', 'username', 'firstname', 'lastname', 'country']
+
+    def __init__(self, file_path, org_id, max_age_hours, read_only, logger):
+        '''
+        :type file_path: str
+        :type org_id: str
+        :type max_age_hours: int
+        :type read_only: bool, True to leave the file as it is, as in test mode
+        :type logger: logging.Logger
+        '''
+        self.file_path = file_path
+        self.org_id = org_id
+        self.max_age_hours = max_age_hours
+        self.read_only = read_only
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.user_by_key = None
+        self.refresh_time = None
+        self.is_valid = False
+        # the actions done while the users are downloaded, applied once they all are
+        self.pending_actions = None
+
+    def load(self):
+        '''
+        Reads the snapshot file, if there is one for this organization that is younger than max_age_hours.
+        :rtype bool
+        '''
+        with self.lock:
+            if (self.is_valid):
+                return True
+            file_path = self.file_path
+            if (not os.path.isfile(file_path)):
+                return False
+            try:
+                with user_sync.helper.open_file(file_path, 'rb') as input_file:
+                    snapshot = cPickle.load(input_file)
+            except Exception as e:
+                self.logger.warning('Ignoring unreadable snapshot: %s reason: %s', file_path, e)
+                return False
+            if (snapshot.get('format_version') != UserSnapshot.format_version or snapshot.get('org_id') != self.org_id):
+                self.logger.info('Snapshot is not for this organization: %s', file_path)
+                return False
+            age_hours = (time.time() - snapshot['refresh_time']) / 3600
+            if (age_hours >= self.max_age_hours):
+                self.logger.info('Snapshot is %.1f hours old, downloading users: %s', age_hours, file_path)
+                return False
+            users = snapshot['users']
+            self.user_by_key = dict((self.get_user_key(user), user) for user in users)
+            self.refresh_time = snapshot['refresh_time']
+            self.is_valid = True
+            self.logger.info('Read %d users from snapshot: %s', len(users), file_path)
+            return True
+
+    def iter_users(self):
+        '''
+        Yields copies of the users, which the actions applied later leave as they are.
+        :rtype iterable(dict)
+        '''
+        with self.lock:
+            users = self.user_by_key.values()
+        for user in users:
+            user = dict(user)
+            user['groups'] = list(user.get('groups') or [])
+            yield user
+
+    def start_refresh(self):
+        with self.lock:
+            self.user_by_key = {}
+            self.refresh_time = time.time()
+            self.is_valid = False
+            self.pending_actions = []
+
+    def add_user(self, user):
+        '''
+        :type user: dict
+        '''
+        user = dict(user)
+        user['groups'] = list(user.get('groups') or [])
+        with self.lock:
+            self.user_by_key[self.get_user_key(user)] = user
+
+    def end_refresh(self):
+        with self.lock:
+            pending_actions = self.pending_actions
+            self.pending_actions = None
+            self.is_valid = True
+            # an action done while the users were downloaded may or may not show in them; the actions are
+            # applied again, which leaves the users the same if they did
+            for action, is_success in pending_actions:
+                self._apply_action(action, is_success)
+
+    def apply_action(self, action, is_success):
+        '''
+        :type action: umapi_client.UserAction
+        :type is_success: bool
+        '''
+        with self.lock:
+            if (self.pending_actions != None):
+                self.pending_actions.append((action, is_success))
+            elif (self.is_valid):
+                self._apply_action(action, is_success)
+
+    def _apply_action(self, action, is_success):
+        if (not is_success):
+            self.drop('an action failed for user: %s' % action.frame.get('user'))
+            return
+        user_by_key = self.user_by_key
+        frame = action.frame
+        domain = frame.get('domain')
+        key = (frame['user'].lower(), domain.lower() if domain != None else None)
+        user = user_by_key.get(key)
+        for command in action.commands:
+            for command_name, command_value in command.iteritems():
+                identity_type = UserSnapshot.type_by_create_command.get(command_name)
+                if (identity_type != None):
+                    if (user == None):
+                        user_by_key[key] = user = self.create_user(frame, identity_type, command_value['email'])
+                    elif (command_value.get('option') != 'updateIfAlreadyExists'):
+                        continue
+                    for attribute in UserSnapshot.update_attributes:
+                        if (attribute in command_value):
+                            user[attribute] = command_value[attribute]
+                elif (command_name in ('removeFromOrg', 'removeFromDomain')):
+                    user_by_key.pop(key, None)
+                    user = None
+                elif (command_name in ('addRoles', 'removeRoles')):
+                    pass
+                elif (command_name == 'add' and command_value != 'all'):
+                    if (user == None):
+                        # a user of another organization that is added to a group of this one joins it
+                        id_type = getattr(action, 'id_type', None)
+                        if (id_type == None or domain != None):
+                            self.drop('cannot add unknown user: %s' % frame['user'])
+                            return
+                        user_by_key[key] = user = self.create_user(frame, id_type.name, frame['user'])
+                    normalized_groups = set(user_sync.helper.normalize_string(group) for group in user['groups'])
+                    for groups in command_value.itervalues():
+                        for group in groups:
+                            normalized_group = user_sync.helper.normalize_string(group)
+                            if (normalized_group not in normalized_groups):
+                                user['groups'].append(group)
+                                normalized_groups.add(normalized_group)
+                elif (command_name == 'remove' and user != None):
+                    if (command_value == 'all'):
+                        user['groups'] = []
+                    else:
+                        removed_groups = set(user_sync.helper.normalize_string(group) for groups in command_value.itervalues() for group in groups)
+                        user['groups'] = [group for group in user['groups'] if user_sync.helper.normalize_string(group) not in removed_groups]
+                elif (command_name == 'update' and user != None):
+                    user.update(command_value)
+                    del user_by_key[key]
+                    key = self.get_user_key(user)
+                    user_by_key[key] = user
+                else:
+                    self.drop('cannot apply %s for user: %s' % (command_name, frame['user']))
+                    return
+
+    @staticmethod
+    def create_user(frame, identity_type, email):
+        '''
+        :type frame: dict
+        :type identity_type: str
+        :type email: str
+        :rtype dict
+        '''
+        domain = frame.get('domain')
+        return {
+            'email': email,
+            'username': frame['user'] if domain != None else email,
+            'domain': domain if domain != None else email[email.index('@') + 1:],
+            'type': identity_type,
+            'groups': [],
+        }
+
+    def drop(self, reason):
+        '''
+        :type reason: str
+        '''
+        if (self.is_valid or self.pending_actions != None):
+            self.logger.warning('Dropping snapshot, users will be downloaded on the next run: %s', reason)
+            if (not self.read_only and os.path.isfile(self.file_path)):
+                os.remove(self.file_path)
+        self.is_valid = False
+        self.pending_actions = None
+        self.user_by_key = None
+
+    def save(self):
+        with self.lock:
+            if (not self.is_valid or self.read_only):
+                return
+            users = self.user_by_key.values()
+            snapshot_writer = user_sync.helper.AtomicFileWriter(self.file_path)
+            try:
+                cPickle.dump({
+                    'format_version': UserSnapshot.format_version,
+                    'org_id': self.org_id,
+                    'refresh_time': self.refresh_time,
+                    'users': users,
+                }, snapshot_writer.file, cPickle.HIGHEST_PROTOCOL)
+                snapshot_writer.commit()
+            finally:
+                snapshot_writer.discard()
+            self.logger.info('Saved %d users to snapshot: %s', len(users), self.file_path)
+
+    @staticmethod
+    def get_user_key(user):
+        '''
+        Returns the key of the user, which is the same as that of the actions on the user: the username and domain
+        for a user whose username is not the email, and otherwise the email.
+        :type user: dict
+        :rtype tuple(str, str)
+        '''
+        email = user.get('email') or ''
+        username = user.get('username')
+        if (username and username.lower() != email.lower()):
+            return (username.lower(), (user.get('domain') or '').lower())
+        return (email.lower(), None)
+
+class RateLimiter(object):
+    '''
+    Limits the calls made to a UMAPI host by all the connectors to it.  At most get_concurrency() calls are made at
+    a time, and a call is held back while the server has asked for calls to stop.  When the server is unavailable
+    or throttles a call, the number of concurrent calls and the action batch size are halved, and the call is
+    retried after the time in the Retry-After header or else after a growing delay.  Each call that succeeds adds
+    to the number of concurrent calls and the batch size again, by a little at a time.
+    '''
+    rate_limiters_by_host = {}
+    rate_limiters_lock = threading.Lock()
+
+    @staticmethod
+    def get_rate_limiter(host):
+        '''
+        :type host: str
+        :rtype RateLimiter
+        '''
+        with RateLimiter.rate_limiters_lock:
+            rate_limiter = RateLimiter.rate_limiters_by_host.get(host)
+            if (rate_limiter == None):
+                RateLimiter.rate_limiters_by_host[host] = rate_limiter = RateLimiter(host)
+            return rate_limiter
+
+    def __init__(self, host):
+        '''
+        :type host: str
+        '''
+        self.host = host
+        self.condition = threading.Condition()
+        self.max_concurrency = 1
+        self.concurrency = 1.0
+        self.batch_size = float(ActionManager.max_batch_size)
+        self.in_flight = 0
+        self.resume_time = 0
+        self.call_count = 0
+        self.throttle_count = 0
+        self.wait_seconds = 0.0
+        self.logger = logging.getLogger('dashboard')
+
+    def set_max_concurrency(self, max_concurrency):
+        '''
+        Raises the limit on the number of concurrent calls, which starts at that limit.
+        :type max_concurrency: int
+        '''
+        with self.condition:
+            if (max_concurrency > self.max_concurrency):
+                self.concurrency += max_concurrency - self.max_concurrency
+                self.max_concurrency = max_concurrency
+
+    def get_concurrency(self):
+        return int(self.concurrency)
+
+    def get_batch_size(self):
+        return int(self.batch_size)
+
+    def acquire(self):
+        '''
+        Waits until a call can be made.
+        '''
+        with self.condition:
+            wait_start_time = None
+            while True:
+                delay = self.resume_time - time.time()
+                if (delay <= 0 and self.in_flight < int(self.concurrency)):
+                    break
+                if (wait_start_time == None):
+                    wait_start_time = time.time()
+                self.condition.wait(delay if delay > 0 else None)
+            if (wait_start_time != None):
+                self.wait_seconds += time.time() - wait_start_time
+            self.in_flight += 1
+            self.call_count += 1
+
+    def release(self, retry_after = None):
+        '''
+        Records the end of a call.  retry_after is the number of seconds to wait after a call that was throttled,
+        or None for one that was not.
+        :type retry_after: float
+        '''
+        with self.condition:
+            self.in_flight -= 1
+            if (retry_after != None):
+                self.throttle_count += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.batch_size = max(1.0, self.batch_size / 2)
+                self.resume_time = max(self.resume_time, time.time() + retry_after)
+            else:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1.0 / self.concurrency)
+                self.batch_size = min(float(ActionManager.max_batch_size), self.batch_size + 1.0 / self.batch_size)
+            self.condition.notify_all()
+
+    def call(self, function, args, max_attempts, first_delay, logger):
+        '''
+        Calls function with args, retrying it up to max_attempts times in all while the server is unavailable.
+        :type function: callable
+        :type args: tuple
+        :type max_attempts: int
+        :type first_delay: int
+        :type logger: logging.Logger
+        '''
+        attempt = 0
+        while True:
+            attempt += 1
+            self.acquire()
+            try:
+                result = function(*args)
+            except (umapi_client.UnavailableError, umapi_client.ServerError) as e:
+                retry_after = self.get_retry_after(e, attempt, first_delay)
+                self.release(retry_after)
+                if (attempt >= max_attempts):
+                    raise
+                logger.warning('Server unavailable on try %d of %d, retrying in %d seconds: %s', attempt, max_attempts, retry_after, e)
+                continue
+            except:
+                self.release()
+                raise
+            self.release()
+            return result
+
+    @staticmethod
+    def get_retry_after(error, attempt, first_delay):
+        '''
+        Returns the number of seconds the server asked for in a Retry-After header, either as a number or as a date,
+        or else first_delay doubled for each attempt after the first, with some randomness.
+        :type error: Exception
+        :type attempt: int
+        :type first_delay: int
+        :rtype float
+        '''
+        result = getattr(error, 'result', None)
+        headers = getattr(result, 'headers', None)
+        retry_after = headers.get('Retry-After') if headers != None else None
+        if (retry_after != None):
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                retry_date = email.utils.parsedate_tz(retry_after)
+                if (retry_date != None):
+                    return max(0.0, email.utils.mktime_tz(retry_date) - time.time())
+        return first_delay * (2 ** (attempt - 1)) + random.random() * first_delay
+
+    def log_statistics(self):
+        with self.condition:
+            self.logger.info('Calls to %s: %d throttled: %d time waited: %.1f seconds', self.host, self.call_count, self.throttle_count, self.wait_seconds)
+
 class Commands(object):
     def __init__(self, identity_type = None, email = None, username = None, domain = None):
         '''
@@ -219,21 +776,50 @@ class Commands(object):
     
 class ActionManager(object):
     next_request_id = 1
+    next_request_id_lock = threading.Lock()
+    max_batch_size = 10
+    max_commands_per_action = 10
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, batch_size = max_batch_size, max_in_flight_batches = 1, call_server = None, rate_limiter = None, snapshot = None, create_connection = None):
         '''
+        With max_in_flight_batches greater than 1, batches are sent on a pool of that many threads.  Their callbacks
+        are still made on the calling thread, in the order the actions were added, and a batch waits for any earlier
+        batch with an action on the same user to complete before it is sent.  A connection is not safe to use from
+        several threads, so each thread of the pool sends on a connection of its own, made by create_connection;
+        without create_connection, the batches are sent one at a time on connection, and only their waits for the
+        rate limiter overlap.
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type batch_size: int
+        :type max_in_flight_batches: int
+        :type call_server: callable(callable, ...)
+        :type rate_limiter: RateLimiter
+        :type snapshot: UserSnapshot
+        :type create_connection: callable() -> umapi_client.Connection
         '''
-        self.items = []
+        self.items = collections.deque()
+        self.call_server = call_server if call_server != None else lambda function, *args: function(*args)
+        self.rate_limiter = rate_limiter
+        self.snapshot = snapshot
+        self.batch_size = batch_size
+        self.max_in_flight_batches = max_in_flight_batches
+        self.in_flight_batches = collections.deque()
+        self.in_flight_user_counts = collections.Counter()
+        self.pool = None
+        self.sending = False
         self.connection = connection
+        self.create_connection = create_connection
+        self.thread_state = threading.local()
+        self.connection_lock = threading.Lock()
         self.org_id = org_id
         self.logger = logger.getChild('action')
         
     def get_next_request_id(self):
-        request_id = 'action_%d' % ActionManager.next_request_id
-        ActionManager.next_request_id += 1
+        # the accessor organizations may create their actions on several threads at once.
+        with ActionManager.next_request_id_lock:
+            request_id = 'action_%d' % ActionManager.next_request_id
+            ActionManager.next_request_id += 1
         return request_id
 
     def create_action(self, commands):
@@ -275,38 +861,158 @@ class ActionManager(object):
         self._execute_action(action)
     
     def has_work(self):
-        return len(self.items) > 0  
+        return len(self.items) > 0 or len(self.in_flight_batches) > 0
     
     def _execute_action(self, action):      
         '''
+        Sends the queued actions once there are batch_size of them.
         :type action: umapi_client.UserAction
         '''
-        _, sent, _ = self.connection.execute_single(action)
-        self.process_sent_items(sent)
-
-    def process_sent_items(self, total_sent):
-        if (total_sent > 0):
-            sent_items = self.items[0:total_sent]
-            self.items = self.items[total_sent:]        
-            for sent_item in sent_items:
-                action = sent_item['action']
-                action_errors = action.execution_errors()
-                is_success = not action_errors or len(action_errors) == 0
-                
-                if (not is_success):
-                    for error in action_errors:
-                        self.logger.error('Error requestID: %s code: "%s" message: "%s"', action.frame.get("requestID"), error.get('errorCode'), error.get('message'));
-                
-                item_callback = sent_item['callback']
-                if (callable(item_callback)):
-                    item_callback({
-                        "action": action, 
-                        "is_success": is_success, 
-                        "errors": action_errors
-                    })
+        if (len(self.items) >= self.batch_size and not self.sending):
+            self._send_items(self.batch_size)
 
-    def flush(self):
-        _, sent, _ = self.connection.execute_queued()
-        self.process_sent_items(sent)
-        
+    def _send_items(self, min_batch_size):
+        '''
+        Sends the queued items in batches, while there are at least min_batch_size of them.  Actions added by the
+        callbacks made meanwhile are only queued, and are sent by this loop in turn.
+        :type min_batch_size: int
+        '''
+        self.sending = True
+        try:
+            items = self.items
+            while (len(items) > 0 and len(items) >= min_batch_size):
+                self._send_batch(self.pop_batch_items(self.get_batch_size()))
+        finally:
+            self.sending = False
 
+    def pop_batch_items(self, batch_size):
+        '''
+        Pops the items for a batch of at most batch_size actions, as the connection counts them once it has split
+        the actions with more than max_commands_per_action commands.  A batch that the connection had to send in
+        several calls would be left partly queued on it by a call that fails, and then sent again with the next.
+        A single action that is split into more than batch_size actions still makes a batch of its own.
+        :type batch_size: int
+        :rtype list(dict)
+        '''
+        items = self.items
+        batch_items = [items.popleft()]
+        split_count = self.get_split_action_count(batch_items[0]['action'])
+        while (len(items) > 0):
+            split_count += self.get_split_action_count(items[0]['action'])
+            if (split_count > batch_size):
+                break
+            batch_items.append(items.popleft())
+        return batch_items
+
+    @staticmethod
+    def get_split_action_count(action):
+        '''
+        :type action: umapi_client.UserAction
+        :rtype int
+        '''
+        command_count = len(getattr(action, 'commands', ()))
+        return max(1, (command_count + ActionManager.max_commands_per_action - 1) // ActionManager.max_commands_per_action)
+
+    def get_batch_size(self):
+        '''
+        Returns batch_size, or less if the rate limiter has cut the batch size.
+        :rtype int
+        '''
+        if (self.rate_limiter == None):
+            return self.batch_size
+        return min(self.batch_size, self.rate_limiter.get_batch_size())
+
+    def _send_batch(self, batch_items):
+        actions = [item['action'] for item in batch_items]
+        if (self.max_in_flight_batches <= 1):
+            self.call_server(self.execute_actions, self.connection, actions)
+            self.process_sent_items(batch_items)
+            return
+
+        user_keys = [self.get_action_user_key(action) for action in actions]
+        while (len(self.in_flight_batches) >= self.max_in_flight_batches or 
+               any(self.in_flight_user_counts[user_key] > 0 for user_key in user_keys)):
+            self._complete_oldest_batch()
+        if (self.pool == None):
+            self.pool = multiprocessing.pool.ThreadPool(self.max_in_flight_batches)
+        self.in_flight_user_counts.update(user_keys)
+        result = self.pool.apply_async(self.call_server, (self.execute_actions_on_thread, actions))
+        self.in_flight_batches.append((batch_items, user_keys, result))
+
+    def execute_actions_on_thread(self, actions):
+        '''
+        Executes actions on the connection of the calling thread of the pool, or else on the shared connection, one
+        call at a time.
+        :type actions: list(umapi_client.UserAction)
+        '''
+        if (self.create_connection == None):
+            with self.connection_lock:
+                return self.execute_actions(self.connection, actions)
+        connection = getattr(self.thread_state, 'connection', None)
+        if (connection == None):
+            self.thread_state.connection = connection = self.create_connection()
+        return self.execute_actions(connection, actions)
+
+    @staticmethod
+    def execute_actions(connection, actions):
+        '''
+        :type connection: umapi_client.Connection
+        :type actions: list(umapi_client.UserAction)
+        '''
+        # a call that failed part way leaves the rest of its actions queued on the connection; they are sent again by
+        # the retry of that call, if any, so they must not also go out with the next call
+        connection.action_queue = []
+        return connection.execute_multiple(actions)
+
+    def _complete_oldest_batch(self):
+        batch_items, user_keys, result = self.in_flight_batches.popleft()
+        self.in_flight_user_counts.subtract(user_keys)
+        result.get()
+        self.process_sent_items(batch_items)
+
+    @staticmethod
+    def get_action_user_key(action):
+        '''
+        :type action: umapi_client.UserAction
+        '''
+        frame = action.frame
+        return (frame.get('user'), frame.get('domain'))
+
+    def process_sent_items(self, sent_items):
+        '''
+        :type sent_items: list(dict)
+        '''
+        for sent_item in sent_items:
+            action = sent_item['action']
+            action_errors = action.execution_errors()
+            is_success = not action_errors or len(action_errors) == 0
+            
+            if (not is_success):
+                for error in action_errors:
+                    self.logger.error('Error requestID: %s code: "%s" message: "%s"', action.frame.get("requestID"), error.get('errorCode'), error.get('message'));
+
+            if (self.snapshot != None):
+                self.snapshot.apply_action(action, is_success)
+            
+            item_callback = sent_item['callback']
+            if (callable(item_callback)):
+                item_callback({
+                    "action": action, 
+                    "is_success": is_success, 
+                    "errors": action_errors
+                })
+
+    def flush(self):
+        '''
+        Sends all the queued actions, and waits for them to complete.  Actions added by their callbacks may be left
+        queued, which has_work reports.
+        '''
+        if (self.sending):
+            return
+        self._send_items(1)
+        self.sending = True
+        try:
+            while (len(self.in_flight_batches) > 0):
+                self._complete_oldest_batch()
+        finally:
+            self.sending = False
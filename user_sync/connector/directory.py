@@ -18,9 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import cPickle
+import hashlib
+import logging
+import mmap
+import os
+
 import user_sync.error
+import user_sync.helper
 
 class DirectoryConnector(object):    
+    cache_format_version = 1
+
     def __init__(self, implementation):
         self.implementation = implementation
         
@@ -38,15 +47,119 @@ class DirectoryConnector(object):
         '''
         :type options: dict
         '''
+        options = dict(options)
+        self.cache_path = options.pop('cache_path', None)
+        self.logger = logging.getLogger('directory')
         self.state = self.implementation.connector_initialize(options)
         
-    def load_users_and_groups(self, groups, extended_attributes=None):
+    def load_users_and_groups(self, groups, extended_attributes=None, directory_group_filter=None, need_source_attributes=True):
         '''
+        If cache_path is set, and the connector can give a fingerprint of its input, the users are read back
+        from the cache written by a previous run with the same fingerprint and arguments, instead of from the
+        connector.
         :type groups: list(str)
         :type extended_attributes: list(str)
+        :type directory_group_filter: set(str)
+        :type need_source_attributes: bool
         :rtype (bool, iterable(dict))
         '''
         if extended_attributes is None:
             extended_attributes = []
-        return self.implementation.connector_load_users_and_groups(self.state, groups, extended_attributes)
+        cache_key = self.get_cache_key(groups, extended_attributes, directory_group_filter, need_source_attributes)
+        if (cache_key != None):
+            users = self.read_cache(cache_key)
+            if (users != None):
+                return (True, users)
+        all_loaded, users = self.implementation.connector_load_users_and_groups(self.state, groups, extended_attributes, directory_group_filter, need_source_attributes)
+        if (cache_key != None and all_loaded):
+            users = self.iter_users_writing_cache(users, cache_key)
+        return (all_loaded, users)
 
+    def get_cache_key(self, groups, extended_attributes, directory_group_filter, need_source_attributes):
+        '''
+        Returns the key that identifies the cached users, or None if they should not be cached.  The key combines the
+        fingerprint of the connector's input, which also covers its options that affect the users read, with the
+        arguments of load_users_and_groups.
+        :rtype str
+        '''
+        if (self.cache_path == None):
+            return None
+        get_input_fingerprint = getattr(self.implementation, 'connector_get_input_fingerprint', None)
+        if (get_input_fingerprint == None):
+            self.logger.warn('Ignoring cache_path: the %s connector does not support caching', self.name)
+            return None
+        fingerprint = get_input_fingerprint(self.state, groups, extended_attributes, directory_group_filter, need_source_attributes)
+        if (fingerprint == None):
+            return None
+        key_values = (DirectoryConnector.cache_format_version,
+                      self.name,
+                      fingerprint,
+                      sorted(groups),
+                      list(extended_attributes),
+                      sorted(directory_group_filter) if directory_group_filter != None else None,
+                      need_source_attributes)
+        return hashlib.sha1(repr(key_values)).hexdigest()
+
+    def read_cache(self, cache_key):
+        '''
+        Returns an iterator of the cached users if the cache file was written with cache_key, otherwise None.  The
+        cache file is memory mapped, and the users are unpickled from it as they are iterated.
+        :type cache_key: str
+        :rtype iterable(dict)
+        '''
+        cache_path = self.cache_path
+        if (not os.path.isfile(cache_path) or os.path.getsize(cache_path) == 0):
+            return None
+        with user_sync.helper.open_file(cache_path, 'rb') as input_file:
+            cache_map = mmap.mmap(input_file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            cached_key = cPickle.load(cache_map)
+        except Exception as e:
+            self.logger.warning('Ignoring unreadable cache file: %s reason: %s', cache_path, e)
+            cached_key = None
+        if (cached_key != cache_key):
+            cache_map.close()
+            self.logger.info('Cached users are out of date: %s', cache_path)
+            return None
+        self.logger.info('Reading cached users from: %s', cache_path)
+        return self.iter_cached_users(cache_map)
+
+    def iter_cached_users(self, cache_map):
+        '''
+        :type cache_map: mmap.mmap
+        :rtype iterable(dict)
+        '''
+        try:
+            user_count = 0
+            while True:
+                user = cPickle.load(cache_map)
+                if (user == None):
+                    break
+                user_count += 1
+                yield user
+            self.logger.info('Number of cached users read: %d', user_count)
+        finally:
+            cache_map.close()
+
+    def iter_users_writing_cache(self, users, cache_key):
+        '''
+        Yields users, while writing them to the cache file.  The cache file is only replaced once all the users have
+        been written.
+        :type users: iterable(dict)
+        :type cache_key: str
+        :rtype iterable(dict)
+        '''
+        cache_writer = user_sync.helper.AtomicFileWriter(self.cache_path)
+        try:
+            pickler = cPickle.Pickler(cache_writer.file, cPickle.HIGHEST_PROTOCOL)
+            pickler.dump(cache_key)
+            for user in users:
+                pickler.dump(user)
+                # the memo would otherwise keep every user written
+                pickler.clear_memo()
+                yield user
+            pickler.dump(None)
+            cache_writer.commit()
+            self.logger.info('Saved users to cache: %s', self.cache_path)
+        finally:
+            cache_writer.discard()
@@ -18,6 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import cPickle
+import cStringIO
+import csv
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import operator
+import os
+import sys
+import tempfile
+
 import user_sync.config
 import user_sync.connector.helper
 import user_sync.error
@@ -37,20 +49,34 @@ def connector_initialize(options):
     state = CSVDirectoryConnector(options)
     return state
 
-def connector_load_users_and_groups(state, groups, extended_attributes):
+def connector_load_users_and_groups(state, groups, extended_attributes, directory_group_filter=None, need_source_attributes=True):
     '''
     :type state: CSVDirectoryConnector
     :type groups: list(str)
     :type extended_attributes: list(str)
+    :type directory_group_filter: set(str)
+    :type need_source_attributes: bool
     :rtype (bool, iterable(dict))
     '''
 
     # CSV supports arbitrary aka "extended" attrs by default, so the value of extended_attributes has no impact on this particular connector
+    # All rows are read anyway, so the directory group filter is left to the rule processor
 
-    return state.load_users_and_groups(groups, extended_attributes)
+    return state.load_users_and_groups(groups, extended_attributes, need_source_attributes)
+
+def connector_get_input_fingerprint(state, groups, extended_attributes, directory_group_filter=None, need_source_attributes=True):
+    '''
+    :type state: CSVDirectoryConnector
+    :rtype tuple
+    '''
+    return state.get_input_fingerprint()
 
 class CSVDirectoryConnector(object):
     name = 'csv'
+    spill_run_length = 100000
+    parse_ranges_per_process = 4
+    parse_min_range_size = 1024 * 1024
+    fingerprint_block_size = 1024 * 1024
     
     def __init__(self, caller_options):
         caller_config = user_sync.config.DictConfig('"%s options"' % CSVDirectoryConnector.name, caller_options)
@@ -64,6 +90,10 @@ class CSVDirectoryConnector(object):
         builder.set_string_value('username_column_name', 'user')
         builder.set_string_value('domain_column_name', 'domain')
         builder.set_string_value('identity_type_column_name', 'type')
+        builder.set_bool_value('streaming', False)
+        builder.set_bool_value('input_grouped_by_email', False)
+        builder.set_int_value('read_buffer_size', 1024 * 1024)
+        builder.set_int_value('parse_processes', 1)
         builder.set_string_value('logger_name', 'connector.' + CSVDirectoryConnector.name)
         builder.require_string_value('file_path')
         options = builder.get_options()        
@@ -74,119 +104,433 @@ class CSVDirectoryConnector(object):
 
         logger.debug('Initialized with options: %s', options)            
 
-    def load_users_and_groups(self, groups, extended_attributes):
+    def get_input_fingerprint(self):
+        '''
+        Identifies the content of the file, by its size, modification time and a hash of its first and last
+        fingerprint_block_size bytes (all of it, if it is no larger than that), together with the options that
+        affect how its rows are mapped onto users.  The hash catches a file rewritten with the same size and
+        modification time, as by copies that keep the time, without reading all of a large file on every run.
+        :rtype tuple
+        '''
+        options = self.options
+        file_path = options['file_path']
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        block_size = self.fingerprint_block_size
+        content_hash = hashlib.sha1()
+        with user_sync.helper.open_file(file_path, 'rb', 0) as input_file:
+            content_hash.update(input_file.read(block_size))
+            if (file_stat.st_size > block_size):
+                input_file.seek(max(block_size, file_stat.st_size - block_size))
+                content_hash.update(input_file.read(block_size))
+        mapping_options = sorted((key, value) for key, value in options.iteritems() if key == 'delimiter' or key.endswith('_column_name'))
+        return (os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime, content_hash.hexdigest(), mapping_options)
+
+    def load_users_and_groups(self, groups, extended_attributes, need_source_attributes=True):
         '''
         :type groups: list(str)
+        :type need_source_attributes: bool
         :rtype (bool, iterable(dict))
         '''        
         options = self.options
         file_path = options['file_path']
         self.logger.info('Reading from: %s', file_path)
-        self.users = users = self.read_users(file_path, extended_attributes)
+        if (options['streaming']):
+            return (True, self.iter_users(file_path, extended_attributes, need_source_attributes))
+        self.users = users = self.read_users(file_path, extended_attributes, need_source_attributes)
         self.logger.info('Number of users loaded: %d', len(users))
         return (True, users.itervalues())
 
-    def read_users(self, file_path, extended_attributes):
+    def read_users(self, file_path, extended_attributes, need_source_attributes=True):
         '''
         :type file_path
+        :type need_source_attributes: bool
         :rtype dict
         '''
+        if (self.options['parse_processes'] > 1):
+            users = self.read_users_in_parallel(file_path, extended_attributes, need_source_attributes)
+            if (users != None):
+                return users
+
         users = {}
-        
+        row_mapper = CSVUserRowMapper(self.options, self.logger, extended_attributes, need_source_attributes)
+        for email, _line_read, row in self.iter_email_rows(file_path, row_mapper):
+            user = users.get(email)
+            if user is None:
+                user = row_mapper.create_user(email)
+                users[email] = user
+            row_mapper.update_user(user, row)
+        return users
+
+    def read_users_in_parallel(self, file_path, extended_attributes, need_source_attributes=True):
+        '''
+        Reads the users of the file with parse_processes worker processes, each parsing a range of the file's
+        bytes that starts and ends on a row boundary.  The users parsed from each range are merged in file order,
+        so the result is the same as that of reading the file from start to end.  Returns None if the file is too
+        small to be worth splitting, or compressed.
+        :type file_path
+        :type need_source_attributes: bool
+        :rtype dict
+        '''
         options = self.options
         logger = self.logger
-        
-        recognized_column_names = []
+        processes = options['parse_processes']
+        if (user_sync.helper.get_file_compression(file_path) != None):
+            logger.info('Reading compressed file with a single process: %s', file_path)
+            return None
+        if (not can_start_worker_processes()):
+            logger.info('Reading with a single process: worker processes cannot be started from this program')
+            return None
+        delimiter = options['delimiter']
+        if (delimiter == None):
+            delimiter = user_sync.helper.guess_delimiter_from_filename(file_path)
 
-        def get_column_name(key):
-            column_name = options[key]
-            recognized_column_names.append(column_name)
-            return column_name
+        with user_sync.helper.open_file(file_path, 'rb', options['read_buffer_size']) as input_file:
+            # read the header row with readline, so that tell() is the offset of the first data row
+            header_reader = csv.reader(iter(input_file.readline, ''), delimiter = delimiter)
+            try:
+                fieldnames = header_reader.next()
+            except StopIteration:
+                return None
+            data_offset = input_file.tell()
+            input_file.seek(0, os.SEEK_END)
+            file_size = input_file.tell()
+            range_count = min(processes * self.parse_ranges_per_process, (file_size - data_offset) / self.parse_min_range_size)
+            if (range_count < 2):
+                return None
+            boundaries = find_row_boundaries(input_file, data_offset, file_size, range_count)
 
-        email_column_name = get_column_name('email_column_name')
-        first_name_column_name = get_column_name('first_name_column_name')
-        last_name_column_name = get_column_name('last_name_column_name')
-        country_column_name = get_column_name('country_column_name')
-        groups_column_name = get_column_name('groups_column_name')
-        identity_type_column_name = get_column_name('identity_type_column_name')
-        username_column_name = get_column_name('username_column_name')
-        domain_column_name = get_column_name('domain_column_name')
+        row_mapper = CSVUserRowMapper(options, logger, extended_attributes, need_source_attributes)
+        user_sync.helper.warn_unrecognized_column_names(fieldnames, row_mapper.recognized_column_names, logger)
+        logger.debug('Parsing %d ranges of %s with %d processes', len(boundaries) - 1, file_path, processes)
 
-        # extended attributes appear after the standard ones (if no header row)
-        recognized_column_names += extended_attributes
-        
+        tasks = [(options, extended_attributes, need_source_attributes, file_path, fieldnames, delimiter, start, end) 
+                 for start, end in itertools.izip(boundaries, boundaries[1:])]
+        users = {}
         line_read = 0
+        pool = multiprocessing.Pool(processes)
+        try:
+            for range_users, row_count, invalid_row_indexes in pool.imap(parse_users_in_range, tasks):
+                for row_index in invalid_row_indexes:
+                    logger.warning('Missing or invalid email at row: %d; skipping', line_read + row_index + 1)
+                line_read += row_count
+                for email, range_user in range_users.iteritems():
+                    user = users.get(email)
+                    if (user is None):
+                        users[email] = range_user
+                    else:
+                        merge_user(user, range_user)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return users
+
+    def iter_users(self, file_path, extended_attributes, need_source_attributes=True):
+        '''
+        Yields the users of the file one at a time, each merged from all of its rows.  If input_grouped_by_email
+        is set, the rows of a user are expected to be next to each other, so only the rows of one user are held
+        at a time.  Otherwise the rows are first sorted by email, in runs of spill_run_length rows written to
+        temporary files that are then merged.
+        :type file_path
+        :type need_source_attributes: bool
+        :rtype iterable(dict)
+        '''
+        options = self.options
+        row_mapper = CSVUserRowMapper(self.options, self.logger, extended_attributes, need_source_attributes)
+        email_rows = self.iter_email_rows(file_path, row_mapper)
+        if (not options['input_grouped_by_email']):
+            email_rows = iter_sorted_email_rows(email_rows, self.spill_run_length, self.logger)
+
+        user_count = 0
+        for email, rows in itertools.groupby(email_rows, operator.itemgetter(0)):
+            user = row_mapper.create_user(email)
+            for _email, _line_read, row in rows:
+                row_mapper.update_user(user, row)
+            user_count += 1
+            yield user
+        self.logger.info('Number of users loaded: %d', user_count)
+
+    def iter_email_rows(self, file_path, row_mapper):
+        '''
+        Yields (email, line number, row) for each row of the file that has a valid email.
+        :type file_path
+        :type row_mapper: CSVUserRowMapper
+        :rtype iterable(tuple)
+        '''
+        options = self.options
+        logger = self.logger
         rows = user_sync.helper.iter_csv_rows(file_path, 
                                                 delimiter = options['delimiter'], 
-                                                recognized_column_names = recognized_column_names, 
-                                                logger = logger)
+                                                recognized_column_names = row_mapper.recognized_column_names, 
+                                                logger = logger,
+                                                buffering = options['read_buffer_size'])
+        line_read = 0
         for row in rows:
             line_read += 1
-            email = self.get_column_value(row, email_column_name)
+            email = self.get_column_value(row, row_mapper.email_column_name)
             if email is None or email.find('@') < 0:
                 logger.warning('Missing or invalid email at row: %d; skipping', line_read)
                 continue;
-            
-            user = users.get(email)
-            if user is None:
-                user = user_sync.connector.helper.create_blank_user()
-                user['email'] = email
-                users[email] = user
-            
-            first_name = self.get_column_value(row, first_name_column_name)
-            if first_name is not None:
-                user['firstname'] = first_name
-            else:
-                logger.debug('No value firstname for: %s', email)
-                
-            last_name = self.get_column_value(row, last_name_column_name)
-            if last_name is not None:    
-                user['lastname'] = last_name
-            else:
-                logger.debug('No value lastname for: %s', email)
-    
-            country = self.get_column_value(row, country_column_name)
-            if country is not None:    
-                user['country'] = country
-                
-            groups = self.get_column_value(row, groups_column_name)
-            if groups is not None:
-                user['groups'].extend(groups.split(','))
-                
-            username = self.get_column_value(row, username_column_name)
-            if username is None:
-                username = email
-            user['username'] = username
-                
-            identity_type = self.get_column_value(row, identity_type_column_name)
-            if identity_type is not None:
-                try:
-                    user['identitytype'] = user_sync.identity_type.parse_identity_type(identity_type) 
-                except user_sync.error.AssertionException as e:
-                    logger.error('%s for user: %s', e.message, username)
-                    e.set_reported()
-                    raise e
-
-            domain = self.get_column_value(row, domain_column_name)
-            if domain:
-                user['domain'] = domain
-            elif username != email:
-                user['domain'] = email[email.find('@')+1:]
-
-            sa = {}
-            for col in recognized_column_names:
-                sa[col] = self.get_column_value(row, col)
-            user['source_attributes'] = sa
+            yield (email, line_read, row)
 
-        return users
-    
     def get_column_value(self, row, column_name):
         '''
         :type row: dict
         :type column_name: str
         '''
-        value = row.get(column_name)
-        if (value == ''):
-            value = None
-        return value
-    
+        return get_column_value(row, column_name)
+
+class CSVUserRowMapper(object):
+    '''
+    Maps the columns of the rows of a users file onto the fields of a directory user.
+    '''
+    def __init__(self, options, logger, extended_attributes, need_source_attributes=True):
+        '''
+        :type options: dict
+        :type logger: logging.Logger
+        :type extended_attributes: list(str)
+        :type need_source_attributes: bool
+        '''
+        self.logger = logger
+        self.recognized_column_names = recognized_column_names = []
+
+        def get_column_name(key):
+            column_name = options[key]
+            recognized_column_names.append(column_name)
+            return column_name
+
+        self.email_column_name = get_column_name('email_column_name')
+        self.first_name_column_name = get_column_name('first_name_column_name')
+        self.last_name_column_name = get_column_name('last_name_column_name')
+        self.country_column_name = get_column_name('country_column_name')
+        self.groups_column_name = get_column_name('groups_column_name')
+        self.identity_type_column_name = get_column_name('identity_type_column_name')
+        self.username_column_name = get_column_name('username_column_name')
+        self.domain_column_name = get_column_name('domain_column_name')
+
+        # extended attributes appear after the standard ones (if no header row)
+        recognized_column_names += extended_attributes
+        self.source_attribute_layout = None
+        if (need_source_attributes):
+            self.source_attribute_layout = user_sync.connector.helper.SourceAttributeLayout([], recognized_column_names, get_column_value)
+
+    def create_user(self, email):
+        '''
+        :type email: str
+        :rtype dict
+        '''
+        user = user_sync.connector.helper.create_blank_user()
+        user['email'] = email
+        return user
+
+    def update_user(self, user, row):
+        '''
+        Sets the fields of user from the values of a row.
+        :type user: dict
+        :type row: dict
+        '''
+        logger = self.logger
+        email = user['email']
+
+        first_name = get_column_value(row, self.first_name_column_name)
+        if first_name is not None:
+            user['firstname'] = first_name
+        else:
+            logger.debug('No value firstname for: %s', email)
+            
+        last_name = get_column_value(row, self.last_name_column_name)
+        if last_name is not None:    
+            user['lastname'] = last_name
+        else:
+            logger.debug('No value lastname for: %s', email)
+
+        country = get_column_value(row, self.country_column_name)
+        if country is not None:    
+            user['country'] = country
+            
+        groups = get_column_value(row, self.groups_column_name)
+        if groups is not None:
+            user['groups'].extend(groups.split(','))
+            
+        username = get_column_value(row, self.username_column_name)
+        if username is None:
+            username = email
+        user['username'] = username
+            
+        identity_type = get_column_value(row, self.identity_type_column_name)
+        if identity_type is not None:
+            try:
+                user['identitytype'] = user_sync.identity_type.parse_identity_type(identity_type) 
+            except user_sync.error.AssertionException as e:
+                logger.error('%s for user: %s', e.message, username)
+                e.set_reported()
+                raise e
+
+        domain = get_column_value(row, self.domain_column_name)
+        if domain:
+            user['domain'] = domain
+        elif username != email:
+            user['domain'] = email[email.find('@')+1:]
+
+        if (self.source_attribute_layout != None):
+            user['source_attributes'] = user_sync.connector.helper.SourceAttributes(self.source_attribute_layout, row)
+
+def iter_sorted_email_rows(email_rows, run_length, logger = None):
+    '''
+    Yields the (email, line number, row) items of email_rows ordered by email, and by line number for the same
+    email.  At most run_length items are held in memory: when there are more, each run of that many is sorted
+    and written to a temporary file, and the runs are merged as they are read back.
+    :type email_rows: iterable(tuple)
+    :type run_length: int
+    :type logger: logging.Logger
+    :rtype iterable(tuple)
+    '''
+    run_files = []
+    try:
+        while True:
+            run = list(itertools.islice(email_rows, run_length))
+            run.sort(key = operator.itemgetter(0, 1))
+            if (len(run_files) == 0 and len(run) < run_length):
+                # everything fits in memory
+                for item in run:
+                    yield item
+                return
+            if (len(run) == 0):
+                break
+            run_file = tempfile.TemporaryFile()
+            for item in run:
+                cPickle.dump(item, run_file, cPickle.HIGHEST_PROTOCOL)
+            run_file.seek(0)
+            run_files.append(run_file)
+            run = None
+
+        if (logger != None):
+            logger.debug('Merging %d sorted runs of rows', len(run_files))
+        for item in heapq.merge(*[iter_pickled_items(run_file) for run_file in run_files]):
+            yield item
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+def iter_pickled_items(input_file):
+    '''
+    Yields the values pickled one after the other into a file.
+    :type input_file: file
+    '''
+    while True:
+        try:
+            yield cPickle.load(input_file)
+        except EOFError:
+            return
+
+def get_column_value(row, column_name):
+    '''
+    :type row: dict
+    :type column_name: str
+    '''
+    value = row.get(column_name)
+    if (value == ''):
+        value = None
+    return value
+
+def merge_user(user, later_user):
+    '''
+    Merges into user the fields of later_user, read from rows that come after the rows user was read from, as if
+    those rows had been applied to user.  Fields the rows never set, such as the source attributes when they
+    aren't needed, are not there at all.
+    :type user: dict
+    :type later_user: dict
+    '''
+    for field_name in ['firstname', 'lastname', 'country', 'username', 'identitytype', 'domain', 'source_attributes']:
+        value = later_user.get(field_name)
+        if (value is not None):
+            user[field_name] = value
+    user['groups'].extend(later_user['groups'])
+
+def can_start_worker_processes():
+    '''
+    On Windows, a worker process imports the main module of the program again from its file, which it can't do
+    when the program is run from a zip archive such as a pex.  Frozen programs instead call freeze_support.
+    :rtype bool
+    '''
+    if (os.name != 'nt' or getattr(sys, 'frozen', False)):
+        return True
+    main_path = getattr(sys.modules['__main__'], '__file__', None)
+    return main_path != None and os.path.isfile(main_path)
+
+def find_row_boundaries(input_file, start, end, range_count, block_size = 1024 * 1024):
+    '''
+    Splits the bytes of input_file from start to end into about range_count ranges that each hold whole rows.  A
+    range ends after a line break that is not inside a quoted value, which is one with an even number of quote
+    characters before it (an escaped quote is two quote characters, so it does not change the count).
+    :type input_file: file
+    :type start: int
+    :type end: int
+    :type range_count: int
+    :rtype list(int)
+    '''
+    range_size = (end - start) / range_count
+    boundaries = [start]
+    target = start + range_size
+    quote_count = 0
+    position = start
+    input_file.seek(start)
+    while (target < end):
+        block = input_file.read(block_size)
+        if (len(block) == 0):
+            break
+        block_end = position + len(block)
+        block_offset = 0
+        while (target < block_end):
+            index = block.find('\n', max(target - position, block_offset))
+            if (index < 0):
+                break
+            quote_count += block.count('"', block_offset, index)
+            block_offset = index
+            if (quote_count % 2 == 0):
+                boundaries.append(position + index + 1)
+                target = max(position + index + 1, target) + range_size
+            else:
+                # the line break is inside a quoted value; try the next one
+                target = position + index + 1
+        quote_count += block.count('"', block_offset)
+        position = block_end
+    if (boundaries[-1] < end):
+        boundaries.append(end)
+    return boundaries
+
+def parse_users_in_range(task):
+    '''
+    Runs in a worker process to read the users from a range of a users file.  Returns the users by email, the
+    number of rows read, and the indexes of the rows skipped because they have no valid email.
+    :type task: tuple
+    :rtype (dict, int, list(int))
+    '''
+    options, extended_attributes, need_source_attributes, file_path, fieldnames, delimiter, start, end = task
+    logger = user_sync.connector.helper.create_logger(options)
+    row_mapper = CSVUserRowMapper(options, logger, extended_attributes, need_source_attributes)
+    with user_sync.helper.open_file(file_path, 'rb') as input_file:
+        input_file.seek(start)
+        data = input_file.read(end - start)
+    rows = csv.DictReader(cStringIO.StringIO(data), fieldnames = fieldnames, delimiter = delimiter)
+
+    users = {}
+    invalid_row_indexes = []
+    row_count = 0
+    for row in rows:
+        row_count += 1
+        email = get_column_value(row, row_mapper.email_column_name)
+        if email is None or email.find('@') < 0:
+            invalid_row_indexes.append(row_count - 1)
+            continue
+        user = users.get(email)
+        if user is None:
+            user = row_mapper.create_user(email)
+            users[email] = user
+        row_mapper.update_user(user, row)
+    return (users, row_count, invalid_row_indexes)
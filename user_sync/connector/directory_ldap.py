@@ -18,12 +18,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import itertools
 import ldap.controls.libldap
+import ldap.filter
+import logging
+import Queue
+import re
 import string
+import sys
+import threading
+import time
+import types
 
 import user_sync.config
 import user_sync.connector.helper
 import user_sync.error
+import user_sync.helper
 import user_sync.identity_type
 
 def connector_metadata():
@@ -39,20 +50,24 @@ def connector_initialize(options):
     connector = LDAPDirectoryConnector(options)
     return connector
 
-def connector_load_users_and_groups(state, groups, extended_attributes):
+def connector_load_users_and_groups(state, groups, extended_attributes, directory_group_filter=None, need_source_attributes=True):
     '''
     :type state: LDAPDirectoryConnector
     :type groups: list(str)
     :type extended_attributes: list(str)
+    :type directory_group_filter: set(str)
+    :type need_source_attributes: bool
     :rtype (bool, iterable(dict))
     '''
-    return state.load_users_and_groups(groups, extended_attributes)
+    return state.load_users_and_groups(groups, extended_attributes, directory_group_filter, need_source_attributes)
 
 class LDAPDirectoryConnector(object):
     name = 'ldap'
     
     group_member_uid_attribute = "memberUid"
     group_member_attribute = "member"
+
+    failover_errors = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE, ldap.BUSY, ldap.CONNECT_ERROR)
     
     def __init__(self, caller_options):
         caller_config = user_sync.config.DictConfig('"%s options"' % LDAPDirectoryConnector.name, caller_options)
@@ -65,9 +80,29 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('user_domain_format', None)
         builder.set_string_value('user_identity_type', None)
         builder.set_int_value('search_page_size', 200)
+        builder.set_bool_value('search_page_size_adaptive', False)
+        builder.set_int_value('search_page_size_min', 50)
+        builder.set_int_value('search_page_size_max', 1000)
+        builder.set_list_value('search_bases', None)
+        builder.set_bool_value('search_split_base_dn', False)
+        builder.set_int_value('search_max_connections', 4)
+        builder.set_int_value('group_search_max_in_flight', 1)
+        builder.set_int_value('group_search_batch_size', 1)
+        builder.set_string_value('group_nesting', 'none')
+        builder.set_string_value('nested_group_filter', '(|(objectCategory=group)(objectClass=groupOfNames)(objectClass=groupOfUniqueNames)(objectClass=posixGroup))')
+        builder.set_string_value('nested_group_cache_path', None)
+        builder.set_int_value('nested_group_cache_max_age_hours', 24)
+        builder.set_string_value('user_group_membership_attribute', None)
+        builder.set_string_value('user_group_filter_attribute', None)
+        builder.set_bool_value('user_group_filter_in_chain', False)
+        builder.set_string_value('delta_sync_state_path', None)
+        builder.set_string_value('delta_sync_change_attribute', 'uSNChanged')
+        builder.set_int_value('delta_sync_full_interval_hours', 24)
+        builder.set_string_value('delta_sync_method', 'change_attribute')
+        builder.set_string_value('delta_sync_dirsync_filter', '(objectClass=user)')
         builder.set_string_value('logger_name', 'connector.' + LDAPDirectoryConnector.name)
         builder.set_dict_value('source_filters', {})
-        host = builder.require_string_value('host')
+        host = builder.require_value('host', (types.StringTypes, list))
         username = builder.require_string_value('username')
         builder.require_string_value('base_dn')
         options = builder.get_options()        
@@ -87,27 +122,59 @@ class LDAPDirectoryConnector(object):
             logger.error(e.message)
             e.set_reported()
             raise e
+
+        if (options['group_nesting'] not in ('none', 'expand', 'in_chain')):
+            raise user_sync.error.AssertionException('Unrecognized group_nesting: %s' % options['group_nesting'])
         
-        require_tls_cert = options['require_tls_cert']
         logger.debug('Initialized with options: %s', options)            
 
-        logger.info('Connecting to: %s using username: %s', host, username)            
-        if not require_tls_cert:
+        hosts = host if isinstance(host, list) else [host]
+        delta_sync_state_path = options['delta_sync_state_path']
+        if (delta_sync_state_path != None):
+            # a user's memberOf is a back-link, which changes without the user showing up as changed.
+            for option_name in ['user_group_membership_attribute', 'user_group_filter_attribute']:
+                if (options[option_name] != None):
+                    logger.warning('Ignoring %s with delta sync: group members are read from the groups instead', option_name)
+                    options[option_name] = None
+        if (len(hosts) > 1 and delta_sync_state_path != None and options['delta_sync_method'] == 'change_attribute' and
+                user_sync.helper.normalize_string(options['delta_sync_change_attribute']) == 'usnchanged'):
+            logger.warning('USNs differ between domain controllers; using only host: %s', hosts[0])
+            hosts = hosts[:1]
+
+        self.password = password
+        self.connection_pool = LDAPConnectionPool(self, hosts)
+        self.connection = self.connection_pool.borrow()
+
+        self.delta_sync = LDAPDeltaSync(self, delta_sync_state_path) if delta_sync_state_path != None else None
+        self.page_statistics = LDAPPageStatistics()
+        
+    def create_connection(self, host):
+        '''
+        Connect to the host, and bind with the configured username and password.
+        :type host: str
+        :rtype ldap.ldapobject.LDAPObject
+        '''
+        options = self.options
+        username = options['username']
+        self.logger.info('Connecting to: %s using username: %s', host, username)            
+        if not options['require_tls_cert']:
             ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
         connection = ldap.initialize(host)
         connection.protocol_version = ldap.VERSION3
         connection.set_option(ldap.OPT_REFERRALS, 0)
         try:
-            connection.simple_bind_s(username, password)
+            connection.simple_bind_s(username, self.password)
         except Exception as e:
             raise user_sync.error.AssertionException(repr(e))
-        self.connection = connection
-        logger.info('Connected')            
-        
-    def load_users_and_groups(self, groups, extended_attributes):
+        self.logger.info('Connected')            
+        return connection
+
+    def load_users_and_groups(self, groups, extended_attributes, directory_group_filter=None, need_source_attributes=True):
         '''
         :type groups: list(str)
         :type extended_attributes: list(str)
+        :type directory_group_filter: set(str)
+        :type need_source_attributes: bool
         :rtype (bool, iterable(dict))
         '''
         options = self.options
@@ -123,11 +190,27 @@ class LDAPDirectoryConnector(object):
         else:
             users_filter = all_users_filter
 
+        groups_by_dn = None
+        if (options['user_group_membership_attribute'] != None):
+            groups = list(groups)
+            groups_by_dn = self.find_groups_by_dn(groups)
+
+        if (directory_group_filter != None and options['user_group_filter_attribute'] != None):
+            group_filter = self.create_group_filter(directory_group_filter, groups_by_dn)
+            if (group_filter == None):
+                self.logger.warning('None of the filtered groups were found; no users loaded')
+                self.user_by_dn = {}
+                self.user_by_uid = {}
+                return (not is_using_source_filter, iter([]))
+            users_filter = "(&%s%s)" % (users_filter, group_filter)
+            self.logger.info('Applied group filter: %s', group_filter)
+
         self.logger.info('Loading users...')
+        self.page_statistics = LDAPPageStatistics()
 
         self.user_by_dn = user_by_dn = {}
         self.user_by_uid = user_by_uid = {}
-        for user_dn, user in self.iter_users(users_filter, extended_attributes):
+        for user_dn, user in self.iter_users(users_filter, extended_attributes, groups_by_dn, need_source_attributes):
             uid = user.get('uid')
             if (uid != None):
                 user_by_uid[uid] = user
@@ -135,10 +218,55 @@ class LDAPDirectoryConnector(object):
 
         self.logger.info('Total users loaded: %d', len(user_by_dn))
 
-        for group in groups:
+        if (groups_by_dn != None):
+            if (self.logger.isEnabledFor(logging.DEBUG)):
+                total_users_by_group = dict((group, 0) for group in groups)
+                for user in user_by_dn.itervalues():
+                    for group in user['groups']:
+                        total_users_by_group[group] += 1
+                for group in groups:
+                    self.logger.debug('Group %s users: %d', group, total_users_by_group[group])
+        else:
+            self.load_group_members(groups, user_by_dn, user_by_uid, users_filter)
+
+        self.page_statistics.log_summary(self.logger)
+        return (not is_using_source_filter, user_by_dn.itervalues())
+
+    def load_group_members(self, groups, user_by_dn, user_by_uid, users_filter=None):
+        '''
+        Add each group to the users that are its members.  With group_nesting expand, the members of
+        groups that are members are added too; with in_chain, the server finds all the users in the
+        group's chain of nested groups.
+        :type groups: iterable(str)
+        :type user_by_dn: dict(str, dict)
+        :type user_by_uid: dict(str, dict)
+        :type users_filter: str
+        '''
+        options = self.options
+        group_nesting = options['group_nesting']
+        expander = None
+        if (group_nesting == 'in_chain'):
+            group_members_by_group = self.iter_in_chain_group_members(list(groups), users_filter)
+        else:
+            group_tuple_by_group = None
+            if (options['group_search_batch_size'] > 1):
+                groups = list(groups)
+                group_tuple_by_group = self.find_ldap_groups(groups, [self.group_member_attribute, self.group_member_uid_attribute])
+
+            group_search_max_in_flight = options['group_search_max_in_flight']
+            if (group_search_max_in_flight > 1):
+                resolver = LDAPGroupMemberResolver(self, group_search_max_in_flight)
+                group_members_by_group = resolver.iter_group_members(groups, group_tuple_by_group)
+            else:
+                group_members_by_group = ((group, self.iter_ldap_group_members(group, group_tuple_by_group)) for group in groups)
+
+            if (group_nesting == 'expand'):
+                expander = LDAPNestedGroupExpander(self, user_by_dn)
+                group_members_by_group = ((group, expander.iter_expanded_members(group_members)) for group, group_members in group_members_by_group)
+
+        for group, group_members in group_members_by_group:
             total_group_members = 0
             total_group_users = 0            
-            group_members = self.iter_ldap_group_members(group)
             for group_member_attribute, group_member in group_members:
                 total_group_members += 1
                 if group_member_attribute == self.group_member_uid_attribute:
@@ -147,13 +275,81 @@ class LDAPDirectoryConnector(object):
                     user = user_by_dn.get(group_member)
                 if (user != None):
                     total_group_users += 1
-                    user_groups = user['groups']
-                    if not group in user_groups:
-                        user_groups.append(group)
+                    user['groups'].add(group)
             self.logger.debug('Group %s members: %d users: %d', group, total_group_members, total_group_users)
-        
-        return (not is_using_source_filter, user_by_dn.itervalues())    
-        
+
+        if (expander != None):
+            expander.save_non_group_cache()
+
+    def iter_in_chain_group_members(self, groups, users_filter):
+        '''
+        For each group, find the users that are members of it, directly or through nested groups,
+        with the AD in-chain matching rule (LDAP_MATCHING_RULE_IN_CHAIN) on memberOf.
+        :type groups: list(str)
+        :type users_filter: str
+        :rtype iterator(str, list(tuple(str, str)))
+        '''
+        groups_by_dn = self.find_groups_by_dn(groups)
+        for group_dn, dn_groups in groups_by_dn.iteritems():
+            in_chain_filter = '(memberOf:1.2.840.113556.1.4.1941:=%s)' % ldap.filter.escape_filter_chars(group_dn)
+            if (users_filter != None):
+                in_chain_filter = '(&%s%s)' % (users_filter, in_chain_filter)
+            group_members = [(self.group_member_attribute, dn) for dn, _record in self.iter_users_search_result(in_chain_filter, ['1.1']) if dn != None]
+            for group in dn_groups:
+                yield (group, group_members)
+
+    def find_groups_by_dn(self, groups):
+        '''
+        Look up the DNs of the groups, for matching them against the user_group_membership_attribute
+        values (e.g. memberOf) of users.  The returned keys are normalized DNs.
+        :type groups: list(str)
+        :rtype dict(str, list(str))
+        '''
+        group_tuple_by_group = None
+        if (self.options['group_search_batch_size'] > 1):
+            group_tuple_by_group = self.find_ldap_groups(groups, [])
+
+        groups_by_dn = {}
+        for group in groups:
+            if (group_tuple_by_group != None):
+                group_tuple = group_tuple_by_group.get(group)
+            else:
+                group_tuple = self.find_ldap_group(group, ['1.1'])
+            if (group_tuple == None):
+                self.logger.warning("No group found for: %s", group)
+            else:
+                groups_by_dn.setdefault(self.normalize_dn(group_tuple[0]), []).append(group)
+        return groups_by_dn
+
+    def create_group_filter(self, directory_group_filter, groups_by_dn=None):
+        '''
+        Build a filter clause matching the users that are members of any of the given groups,
+        for narrowing the users search on the server.  Returns None if none of the groups are found.
+        :type directory_group_filter: set(str)
+        :type groups_by_dn: dict(str, list(str))
+        :rtype str
+        '''
+        if (groups_by_dn == None):
+            groups_by_dn = self.find_groups_by_dn(list(directory_group_filter))
+        filter_attribute = self.options['user_group_filter_attribute']
+        if (self.options['user_group_filter_in_chain']):
+            filter_attribute += ':1.2.840.113556.1.4.1941:'
+        terms = []
+        for group_dn, dn_groups in groups_by_dn.iteritems():
+            if (any(group in directory_group_filter for group in dn_groups)):
+                terms.append('(%s=%s)' % (filter_attribute, ldap.filter.escape_filter_chars(group_dn)))
+        if (len(terms) == 0):
+            return None
+        return terms[0] if len(terms) == 1 else '(|%s)' % ''.join(terms)
+
+    @staticmethod
+    def normalize_dn(dn):
+        '''
+        :type dn: str
+        :rtype str
+        '''
+        return ','.join(user_sync.helper.normalize_string(part) for part in dn.split(','))
+
     def find_ldap_group(self, group, attribute_list=None):
         '''
         :type group: str
@@ -182,6 +378,54 @@ class LDAPDirectoryConnector(object):
         
         return group_tuple
 
+    def find_ldap_groups(self, groups, attribute_list):
+        '''
+        Look up many groups at once.  Rather than one search per group, the filters built from
+        group_filter_format are combined into OR filters of up to group_search_batch_size groups each,
+        and each batch is fetched with a paged search.  Groups that are not found are absent from the result.
+        Returns None if the groups cannot be looked up this way, because the attribute that holds
+        the group name cannot be determined from group_filter_format.
+        :type groups: list(str)
+        :type attribute_list: list(str)
+        :rtype dict(str, (str, dict))
+        '''
+        options = self.options
+        base_dn = options['base_dn']
+        group_filter_format = options['group_filter_format']
+        batch_size = options['group_search_batch_size']
+
+        name_attribute_match = re.search(r'\(\s*([\w.;-]+)\s*=\s*\{group\}\s*\)', group_filter_format)
+        if (name_attribute_match == None):
+            self.logger.warning('Cannot find the group name attribute in group_filter_format: %s; searching for each group separately', group_filter_format)
+            return None
+        name_attribute = name_attribute_match.group(1)
+        normalized_name_attribute = user_sync.helper.normalize_string(name_attribute)
+
+        groups_by_normalized_name = {}
+        for group in groups:
+            groups_by_normalized_name.setdefault(user_sync.helper.normalize_string(group), []).append(group)
+
+        group_tuple_by_group = {}
+        attributes = list(attribute_list)
+        attributes.append(name_attribute)
+        for batch_start in range(0, len(groups), batch_size):
+            batch = groups[batch_start:batch_start + batch_size]
+            filter_string = '(|%s)' % ''.join(group_filter_format.format(group=group) for group in batch)
+            for dn, group_attributes in self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, filter_string, attributes):
+                if (dn == None):
+                    continue
+                for attribute_name, attribute_values in group_attributes.iteritems():
+                    if (user_sync.helper.normalize_string(attribute_name) != normalized_name_attribute):
+                        continue
+                    for attribute_value in attribute_values:
+                        for group in groups_by_normalized_name.get(user_sync.helper.normalize_string(attribute_value), []):
+                            existing_tuple = group_tuple_by_group.get(group)
+                            if (existing_tuple != None and existing_tuple[0] != dn):
+                                raise user_sync.error.AssertionException("Multiple LDAP groups found for: %s" % group)
+                            group_tuple_by_group[group] = (dn, group_attributes)
+        self.logger.debug('Groups found: %d of: %d', len(group_tuple_by_group), len(groups))
+        return group_tuple_by_group
+
     def iter_attribute_values(self, dn, attribute_name, attributes=None):
         '''
         :type group_dn: str
@@ -236,13 +480,17 @@ class LDAPDirectoryConnector(object):
                     result = range_parts[1] 
         return result
 
-    def iter_ldap_group_members(self, group):
+    def iter_ldap_group_members(self, group, group_tuple_by_group=None):
         '''
         :type group: str
+        :type group_tuple_by_group: dict(str, (str, dict))
         :rtype iterator(str, str)
         '''
         attributes = [self.group_member_attribute, self.group_member_uid_attribute]
-        group_tuple = self.find_ldap_group(group, attributes)
+        if (group_tuple_by_group != None):
+            group_tuple = group_tuple_by_group.get(group)
+        else:
+            group_tuple = self.find_ldap_group(group, attributes)
         if (group_tuple == None):
             self.logger.warning("No group found for: %s", group)
         else:
@@ -252,9 +500,18 @@ class LDAPDirectoryConnector(object):
                 for attribute_value in attribute_values:
                     yield (attribute, attribute_value)
                     
-    def iter_users(self, users_filter, extended_attributes):
+    def iter_users(self, users_filter, extended_attributes, groups_by_dn=None, need_source_attributes=True):
+        '''
+        If groups_by_dn is given, the groups of each user are taken from the user's
+        user_group_membership_attribute values, which are looked up in groups_by_dn.
+        :type users_filter: str
+        :type extended_attributes: list(str)
+        :type groups_by_dn: dict(str, list(str))
+        :type need_source_attributes: bool
+        :rtype iterator(str, dict)
+        '''
         options = self.options
-        base_dn = options['base_dn']
+        membership_attribute = options['user_group_membership_attribute'] if groups_by_dn != None else None
 
         user_attribute_names = ["givenName", "sn", "c", "uid"]
         user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
@@ -263,108 +520,1230 @@ class LDAPDirectoryConnector(object):
 
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
+        source_attribute_layout = None
+        if (need_source_attributes):
+            source_attribute_layout = user_sync.connector.helper.SourceAttributeLayout(
+                ['email', 'username', 'domain'], ['givenName', 'sn', 'c', 'uid'] + extended_attributes, LDAPValueFormatter.get_attribute_value)
+        if (membership_attribute != None and membership_attribute not in user_attribute_names):
+            user_attribute_names.append(membership_attribute)
 
-        result_iter = self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, users_filter, user_attribute_names)
-        for dn, record in result_iter:
-            if (dn == None):
-                continue
-            
-            email, last_attribute_name = self.user_email_formatter.generate_value(record)
-            if (email == None):
-                if (last_attribute_name != None):
-                    self.logger.warn('No email attribute: %s for dn: %s', last_attribute_name, dn)
-                continue
+        if (self.delta_sync != None):
+            result_iter = self.delta_sync.iter_records(users_filter, user_attribute_names)
+        else:
+            result_iter = self.iter_users_search_result(users_filter, user_attribute_names)
+        search_page_size = self.options['search_page_size']
+        result_iter = iter(result_iter)
+        while True:
+            page = list(itertools.islice(result_iter, search_page_size))
+            if (len(page) == 0):
+                break
+            page = [item for item in page if item[0] != None]
+            records = [record for _dn, record in page]
+            generated_values = itertools.izip(
+                self.user_email_formatter.generate_values(records),
+                self.user_username_formatter.generate_values(records),
+                self.user_domain_formatter.generate_values(records))
+            for (dn, record), ((email, last_email_attribute_name), (username, last_username_attribute_name), (domain, last_domain_attribute_name)) in itertools.izip(page, generated_values):
+                if (email == None):
+                    if (last_email_attribute_name != None):
+                        self.logger.warn('No email attribute: %s for dn: %s', last_email_attribute_name, dn)
+                    continue
 
-            source_attributes = {}
-            
-            user = user_sync.connector.helper.create_blank_user()
-            source_attributes['email'] = email
-            user['email'] = email
-
-            username, last_attribute_name = self.user_username_formatter.generate_value(record)
-            source_attributes['username'] = username
-            if (username == None and last_attribute_name != None):
-                self.logger.info('No username attribute: %s for dn: %s', last_attribute_name, dn)    
-            user['username'] = username if username != None else email
-
-            domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
-            source_attributes['domain'] = domain
-            if (domain != None):
-                user['domain'] = domain
-            elif (last_attribute_name != None):
-                self.logger.info('No domain attribute: %s for dn: %s', last_attribute_name, dn)    
+                user = user_sync.connector.helper.create_blank_user()
+                user['email'] = email
+
+                if (username == None and last_username_attribute_name != None):
+                    self.logger.info('No username attribute: %s for dn: %s', last_username_attribute_name, dn)    
+                user['username'] = username if username != None else email
+
+                if (domain != None):
+                    user['domain'] = domain
+                elif (last_domain_attribute_name != None):
+                    self.logger.info('No domain attribute: %s for dn: %s', last_domain_attribute_name, dn)    
                                                 
-            given_name_value = LDAPValueFormatter.get_attribute_value(record, 'givenName')
-            source_attributes['givenName'] = given_name_value
-            if (given_name_value != None):
-                user['firstname'] = given_name_value
-            sn_value = LDAPValueFormatter.get_attribute_value(record, 'sn')
-            source_attributes['sn'] = sn_value
-            if sn_value != None:
-                user['lastname'] = sn_value
-            c_value = LDAPValueFormatter.get_attribute_value(record, 'c')
-            source_attributes['c'] = c_value
-            if c_value != None:
-                user['country'] = c_value
-
-            uid = LDAPValueFormatter.get_attribute_value(record, 'uid')
-            source_attributes['uid'] = uid
-            if (uid != None):
-                user['uid'] = uid
+                given_name_value = LDAPValueFormatter.get_attribute_value(record, 'givenName')
+                if (given_name_value != None):
+                    user['firstname'] = given_name_value
+                sn_value = LDAPValueFormatter.get_attribute_value(record, 'sn')
+                if sn_value != None:
+                    user['lastname'] = sn_value
+                c_value = LDAPValueFormatter.get_attribute_value(record, 'c')
+                if c_value != None:
+                    user['country'] = c_value
 
-            if extended_attributes is not None:
-                for extended_attribute in extended_attributes:
-                    extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
-                    source_attributes[extended_attribute] = extended_attribute_value
+                uid = LDAPValueFormatter.get_attribute_value(record, 'uid')
+                if (uid != None):
+                    user['uid'] = uid
 
-            # [TODO morr 2017-02-26]: Could be omitted if no hook; worth considering?
-            # [TODO morr 2017-02-28]: Is the copy necessary? Could just assign I think
-            user['source_attributes'] = source_attributes.copy()
+                if (source_attribute_layout != None):
+                    user['source_attributes'] = user_sync.connector.helper.SourceAttributes(source_attribute_layout, record, (email, username, domain))
 
-            yield (dn, user)
+                if (membership_attribute != None):
+                    user_groups = user['groups']
+                    for member_of_dn in self.iter_record_values(record, membership_attribute, dn):
+                        for group in groups_by_dn.get(self.normalize_dn(member_of_dn), []):
+                            user_groups.add(group)
+
+                yield (dn, user)
     
-    def iter_search_result(self, base_dn, scope, filter_string, attributes):
+    def iter_record_values(self, record, attribute_name, dn):
+        '''
+        Iterate the values of attribute_name in a search result record, matching the name without regard
+        to case.  Only the values returned with the record are used; further ranges are not fetched.
+        :type record: dict(str, list)
+        :type attribute_name: str
+        :type dn: str
         '''
+        normalized_attribute_name = user_sync.helper.normalize_string(attribute_name)
+        for current_attribute_name, current_attribute_values in record.iteritems():
+            current_attribute_name_parts = current_attribute_name.split(';')
+            if (user_sync.helper.normalize_string(current_attribute_name_parts[0]) != normalized_attribute_name):
+                continue
+            if (len(current_attribute_name_parts) > 1):
+                self.logger.warning('Only the first %d values of %s were returned for dn: %s', len(current_attribute_values), attribute_name, dn)
+            for current_attribute_value in current_attribute_values:
+                yield current_attribute_value
+
+    def iter_users_search_result(self, users_filter, attributes):
+        '''
+        Search for users under base_dn, or in each of the search partitions if any are configured.
+        :type users_filter: str
+        :type attributes: list(str)
+        '''
+        partitions = self.get_search_partitions(users_filter)
+        if (partitions == None):
+            return self.iter_search_result(self.options['base_dn'], ldap.SCOPE_SUBTREE, users_filter, attributes)
+        return self.iter_partitioned_search_result(partitions, users_filter, attributes)
+
+    def get_search_partitions(self, users_filter):
+        '''
+        Return the (base_dn, scope) pairs that the users search is split into, or None if it isn't split.
+        When base_dn is split, its direct children that are users are found with a one level search,
+        and each of the others is searched as a subtree of its own, so that together they cover the
+        same entries as a subtree search of base_dn.
+        :type users_filter: str
+        :rtype list(tuple(str, int))
+        '''
+        options = self.options
+        search_bases = options['search_bases']
+        if (search_bases != None):
+            return [(search_base, ldap.SCOPE_SUBTREE) for search_base in search_bases]
+        if (not options['search_split_base_dn']):
+            return None
+        base_dn = options['base_dn']
+        partitions = [(base_dn, ldap.SCOPE_ONELEVEL)]
+        for dn, _record in self.iter_search_result(base_dn, ldap.SCOPE_ONELEVEL, '(!%s)' % users_filter, ['1.1']):
+            if (dn != None):
+                partitions.append((dn, ldap.SCOPE_SUBTREE))
+        self.logger.info('Split users search into %d partitions', len(partitions))
+        return partitions
+
+    def iter_partitioned_search_result(self, partitions, filter_string, attributes):
+        '''
+        Search each of the partitions, using up to search_max_connections connections at once, and
+        iterate the results in the order that they arrive.
+        :type partitions: list(tuple(str, int))
+        :type filter_string: str
+        :type attributes: list(str)
+        '''
+        partition_queue = Queue.Queue()
+        for partition in partitions:
+            partition_queue.put(partition)
+        total_threads = max(1, min(self.options['search_max_connections'], len(partitions)))
+        result_queue = Queue.Queue(total_threads * 2)
+        stopped = threading.Event()
+        threads = []
+        for _i in xrange(total_threads):
+            thread = threading.Thread(target=self.run_partition_searches, args=(partition_queue, result_queue, stopped, filter_string, attributes))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            total_running = total_threads
+            while total_running > 0:
+                result_kind, result_value = result_queue.get()
+                if (result_kind == 'page'):
+                    for item in result_value:
+                        yield item
+                elif (result_kind == 'error'):
+                    raise result_value[0], result_value[1], result_value[2]
+                else:
+                    total_running -= 1
+        finally:
+            # the threads may be waiting to add a page, so keep taking them until they have all stopped.
+            stopped.set()
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    result_queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    def run_partition_searches(self, partition_queue, result_queue, stopped, filter_string, attributes):
+        '''
+        Take partitions from partition_queue until there are none left, and put the results of
+        searching them on result_queue, a page at a time, with a connection borrowed from the pool.
+        '''
+        try:
+            while not stopped.is_set():
+                try:
+                    base_dn, scope = partition_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                connection = self.connection_pool.borrow()
+                try:
+                    self.search_partition(connection, base_dn, scope, result_queue, stopped, filter_string, attributes)
+                finally:
+                    self.connection_pool.give_back(connection)
+        except Exception:
+            result_queue.put(('error', sys.exc_info()))
+        finally:
+            result_queue.put(('done', None))
+
+    def search_partition(self, connection, base_dn, scope, result_queue, stopped, filter_string, attributes):
+        '''
+        :type connection: ldap.ldapobject.LDAPObject
+        :type base_dn: str
+        :type scope: int
+        '''
+        search_page_size = self.options['search_page_size']
+        start_time = time.time()
+        total_entries = 0
+        page = []
+        for item in self.iter_search_result(base_dn, scope, filter_string, attributes, connection):
+            page.append(item)
+            if (item[0] != None):
+                total_entries += 1
+            if (len(page) >= search_page_size):
+                result_queue.put(('page', page))
+                page = []
+                if (stopped.is_set()):
+                    return
+        if (len(page) > 0):
+            result_queue.put(('page', page))
+        elapsed_seconds = time.time() - start_time
+        self.logger.info('Partition %s: %d entries in %.1f seconds (%.0f entries/sec)', base_dn, total_entries, elapsed_seconds,
+                         total_entries / elapsed_seconds if elapsed_seconds > 0 else 0)
+
+    def iter_search_result(self, base_dn, scope, filter_string, attributes, connection=None):
+        '''
+        If the server goes away during the search, it is carried on with a connection to another host:
+        first from the paged results cookie, and if the new server doesn't accept that, from the start,
+        skipping the entries that have already been returned.
         type: filter_string: str
         type: attributes: list(str)
+        type: connection: ldap.ldapobject.LDAPObject
         '''
-        connection = self.connection
-        search_page_size = self.options['search_page_size']
+        if (connection == None):
+            connection = self.connection
+        connection_pool = self.connection_pool
+        page_sizer = LDAPPageSizer(self.options)
         
-        lc = ldap.controls.libldap.SimplePagedResultsControl(True, size=search_page_size, cookie='')
+        lc = ldap.controls.libldap.SimplePagedResultsControl(True, size=page_sizer.page_size, cookie='')
 
+        returned_dns = set() if connection_pool.can_fail_over() else None
+        total_failovers = 0
+        is_resuming = False
+        is_replaced = False
         msgid = None
         try:
             has_next_page = True        
             while has_next_page:
-                response_data = None
-                result_type = None
-                if (msgid != None):
+                try:
+                    if (msgid == None):
+                        msgid = connection.search_ext(base_dn, scope, filterstr=filter_string, attrlist=attributes, serverctrls=[lc])
+                    # only the wait for the page is timed; the next page is requested before the entries of
+                    # this one are yielded, and the time the caller spends on them is not the server's.
+                    wait_time = time.time()
                     result_type, response_data, _rmsgid, serverctrls = connection.result3(msgid)
+                    page_latency = time.time() - wait_time
+                except ldap.LDAPError as e:
                     msgid = None
-                    pctrls = [c for c in serverctrls
-                              if c.controlType == ldap.controls.libldap.SimplePagedResultsControl.controlType]
-                    if not pctrls:
-                        self.logger.warn('Server ignored RFC 2696 control.')
+                    if (is_resuming and not isinstance(e, self.failover_errors)):
+                        self.logger.warning('Paged results cookie not accepted (%s); restarting search of: %s', e, base_dn)
+                        lc.cookie = ''
+                        is_resuming = False
+                        continue
+                    if (returned_dns == None or not isinstance(e, self.failover_errors) or total_failovers >= connection_pool.get_total_hosts()):
+                        raise
+                    total_failovers += 1
+                    previous_connection = connection
+                    connection = connection_pool.replace(previous_connection)
+                    if (previous_connection is self.connection):
+                        self.connection = connection
+                    else:
+                        is_replaced = True
+                    self.logger.warning('Search of: %s failed (%s); retrying with host: %s', base_dn, e, connection_pool.get_host(connection))
+                    is_resuming = lc.cookie != ''
+                    continue
+                msgid = None
+                is_resuming = False
+                requested_page_size = lc.size
+                pctrls = [c for c in serverctrls
+                          if c.controlType == ldap.controls.libldap.SimplePagedResultsControl.controlType]
+                if not pctrls:
+                    self.logger.warn('Server ignored RFC 2696 control.')
+                    has_next_page = False
+                else: 
+                    lc.cookie = cookie = pctrls[0].cookie
+                    if not cookie:
                         has_next_page = False
-                    else: 
-                        lc.cookie = cookie = pctrls[0].cookie
-                        if not cookie:
-                            has_next_page = False
+
+                total_entries, total_bytes = self.get_response_size(response_data)
+                self.page_statistics.add_page(total_entries, total_bytes, page_latency)
+                lc.size = page_sizer.add_page(requested_page_size, total_entries, page_latency, has_next_page)
                 
                 if (has_next_page):
-                    msgid = connection.search_ext(base_dn, scope, filterstr=filter_string, attrlist=attributes, serverctrls=[lc])
+                    try:
+                        msgid = connection.search_ext(base_dn, scope, filterstr=filter_string, attrlist=attributes, serverctrls=[lc])
+                    except self.failover_errors:
+                        # issued again, and failed over if need be, on the next pass.
+                        msgid = None
     
                 if ((result_type == ldap.RES_SEARCH_RESULT or result_type == ldap.RES_SEARCH_ENTRY) and (response_data != None)):
                     for item in response_data:
+                        if (returned_dns != None and item[0] != None):
+                            if (item[0] in returned_dns):
+                                continue
+                            returned_dns.add(item[0])
                         yield item        
         except GeneratorExit:
             if (msgid != None):
                 connection.abandon(msgid)
                 msgid = None
             raise
+        finally:
+            if (is_replaced):
+                connection_pool.give_back(connection)
+
+    @staticmethod
+    def get_response_size(response_data):
+        '''
+        Count the entries in a page of results, and estimate its size from the lengths of the DNs and values.
+        :type response_data: list(tuple(str, dict))
+        :rtype (int, int)
+        '''
+        total_entries = 0
+        total_bytes = 0
+        if (response_data != None):
+            for dn, record in response_data:
+                if (dn == None):
+                    continue
+                total_entries += 1
+                total_bytes += len(dn)
+                for values in record.itervalues():
+                    for value in values:
+                        total_bytes += len(value)
+        return (total_entries, total_bytes)
         
+class LDAPPageSizer(object):
+    '''
+    Chooses the size of each page of a paged search.  Unless search_page_size_adaptive is set, this is
+    always search_page_size.  Otherwise, the page size starts at search_page_size and is moved up or
+    down, between search_page_size_min and search_page_size_max, by climbing towards the size that
+    gives the most entries per second of round trip.  A full page that comes back smaller than was
+    asked for shows the server's own limit, which then becomes the largest size used.
+    '''
+    growth_factor = 1.5
+    min_growth_factor = 1.05
+
+    def __init__(self, options):
+        '''
+        :type options: dict
+        '''
+        self.is_adaptive = options['search_page_size_adaptive']
+        self.min_page_size = options['search_page_size_min']
+        self.max_page_size = max(self.min_page_size, options['search_page_size_max'])
+        self.page_size = options['search_page_size']
+        if (self.is_adaptive):
+            self.page_size = min(max(self.page_size, self.min_page_size), self.max_page_size)
+        self.growth_factor = LDAPPageSizer.growth_factor
+        self.direction = 1
+        self.previous_rate = None
+        self.best_rate = None
+        self.best_page_size = self.page_size
+
+    def add_page(self, requested_page_size, total_entries, latency, has_next_page):
+        '''
+        :type requested_page_size: int
+        :type total_entries: int
+        :type latency: float
+        :type has_next_page: bool
+        :rtype int
+        '''
+        if (not self.is_adaptive or not has_next_page or latency <= 0):
+            return self.page_size
+        if (total_entries < requested_page_size):
+            self.max_page_size = max(self.min_page_size, total_entries)
+        rate = total_entries / latency
+        if (self.best_rate == None or rate > self.best_rate):
+            self.best_rate = rate
+            self.best_page_size = total_entries
+        if (self.growth_factor < self.min_growth_factor):
+            # settled
+            return self.page_size
+        if (self.previous_rate != None and rate < self.previous_rate):
+            # gone past the best size: turn around, with smaller steps.
+            self.direction = -self.direction
+            self.growth_factor = 1 + (self.growth_factor - 1) / 2
+            if (self.growth_factor < self.min_growth_factor):
+                self.page_size = min(max(self.best_page_size, self.min_page_size), self.max_page_size)
+                return self.page_size
+        self.previous_rate = rate
+        page_size = int(round(self.page_size * (self.growth_factor ** self.direction)))
+        self.page_size = min(max(page_size, self.min_page_size), self.max_page_size)
+        return self.page_size
+
+class LDAPPageStatistics(object):
+    '''
+    Per page round trip time, estimated size and entry counts of the paged searches of a run.
+    Searches may run on several threads at once.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total_pages = 0
+        self.total_entries = 0
+        self.total_bytes = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.max_entries = 0
+
+    def add_page(self, total_entries, total_bytes, latency):
+        '''
+        :type total_entries: int
+        :type total_bytes: int
+        :type latency: float
+        '''
+        with self.lock:
+            self.total_pages += 1
+            self.total_entries += total_entries
+            self.total_bytes += total_bytes
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.max_entries = max(self.max_entries, total_entries)
+
+    def log_summary(self, logger):
+        '''
+        :type logger: logging.Logger
+        '''
+        if (self.total_pages == 0):
+            return
+        logger.info('Search pages: %d entries: %d (max per page: %d) bytes: %d round trip seconds: %.2f (mean: %.3f max: %.3f)',
+                    self.total_pages, self.total_entries, self.max_entries, self.total_bytes,
+                    self.total_latency, self.total_latency / self.total_pages, self.max_latency)
+        
+class LDAPConnectionPool(object):
+    '''
+    Bound connections to one or more replicas of the directory.  New connections are made to each of
+    the hosts in turn, so that concurrent searches are spread across them, and a connection that has
+    failed is replaced with one to a different host.
+    '''
+    def __init__(self, connector, hosts):
+        '''
+        :type connector: LDAPDirectoryConnector
+        :type hosts: list(str)
+        '''
+        self.connector = connector
+        self.hosts = hosts
+        self.lock = threading.Lock()
+        self.host_by_connection_id = {}
+        self.idle_connections = []
+        self.next_host_index = 0
+
+    def can_fail_over(self):
+        return len(self.hosts) > 1
+
+    def get_total_hosts(self):
+        return len(self.hosts)
+
+    def get_host(self, connection):
+        '''
+        :type connection: ldap.ldapobject.LDAPObject
+        :rtype str
+        '''
+        return self.host_by_connection_id.get(id(connection))
+
+    def borrow(self, excluded_host=None):
+        '''
+        Return an idle connection, or else bind a new one, to any host but excluded_host.
+        :type excluded_host: str
+        :rtype ldap.ldapobject.LDAPObject
+        '''
+        with self.lock:
+            for index, connection in enumerate(self.idle_connections):
+                if (self.get_host(connection) != excluded_host):
+                    del self.idle_connections[index]
+                    return connection
+            hosts = self.hosts
+            start_index = self.next_host_index
+            self.next_host_index = (start_index + 1) % len(hosts)
+        candidate_hosts = [hosts[(start_index + offset) % len(hosts)] for offset in xrange(len(hosts))]
+        candidate_hosts = [host for host in candidate_hosts if host != excluded_host] or candidate_hosts
+
+        last_error = None
+        for host in candidate_hosts:
+            try:
+                connection = self.connector.create_connection(host)
+            except user_sync.error.AssertionException as e:
+                self.connector.logger.warning('Failed to connect to: %s (%s)', host, e.message)
+                last_error = e
+                continue
+            with self.lock:
+                self.host_by_connection_id[id(connection)] = host
+            return connection
+        raise last_error
+
+    def give_back(self, connection):
+        '''
+        :type connection: ldap.ldapobject.LDAPObject
+        '''
+        with self.lock:
+            if (id(connection) in self.host_by_connection_id):
+                self.idle_connections.append(connection)
+
+    def replace(self, connection):
+        '''
+        Drop a connection that has failed, and return a new one to a different host.
+        :type connection: ldap.ldapobject.LDAPObject
+        :rtype ldap.ldapobject.LDAPObject
+        '''
+        with self.lock:
+            host = self.host_by_connection_id.pop(id(connection), None)
+        try:
+            connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+        return self.borrow(host)
+
+class LDAPDeltaSync(object):
+    '''
+    Keeps a local snapshot of the records returned by the users search, so that a run only has to fetch
+    the entries changed since the previous run.  How changes are found depends on delta_sync_method:
+    change_attribute: a high-water mark on delta_sync_change_attribute: uSNChanged (with the
+        highestCommittedUSN of the server) on AD, or modifyTimestamp on other servers.  Deleted entries
+        are only noticed by the periodic full search.
+    syncrepl: the RFC 4533 content synchronization control (refreshOnly), as provided by OpenLDAP.
+        The server sends the entries added, modified and deleted since the saved cookie.
+    dirsync: the AD DirSync control.  The objects changed or deleted since the saved cookie are read
+        with delta_sync_dirsync_filter, and the changed ones are then read again with the users filter.
+    A full search is still done when there is no usable snapshot, when the search itself has changed,
+    and every delta_sync_full_interval_hours.
+    Adding a user to a group or removing them from it changes the group, not the user: on AD, memberOf is
+    a back-link that leaves uSNChanged and modifyTimestamp as they are, and DirSync doesn't report it either.
+    So the snapshot can't be trusted for group membership, and with delta sync the connector ignores
+    user_group_membership_attribute and user_group_filter_attribute, and reads the members of the groups on
+    every run.
+    '''
+    state_version = 1
+    
+    dirsync_batch_size = 100
+
+    def __init__(self, connector, state_path):
+        '''
+        :type connector: LDAPDirectoryConnector
+        :type state_path: str
+        '''
+        options = connector.options
+        self.connector = connector
+        self.logger = connector.logger
+        self.state_path = state_path
+        self.method = method = options['delta_sync_method']
+        self.change_attribute = options['delta_sync_change_attribute']
+        self.dirsync_filter = options['delta_sync_dirsync_filter']
+        self.full_interval_seconds = options['delta_sync_full_interval_hours'] * 3600
+
+        if (method == 'syncrepl'):
+            try:
+                from ldap import syncrepl
+            except ImportError as e:
+                raise user_sync.error.AssertionException('delta_sync_method syncrepl requires the pyasn1 package: %s' % e)
+            self.syncrepl = syncrepl
+        elif (method == 'dirsync'):
+            try:
+                import pyasn1
+            except ImportError as e:
+                raise user_sync.error.AssertionException('delta_sync_method dirsync requires the pyasn1 package: %s' % e)
+        elif (method != 'change_attribute'):
+            raise user_sync.error.AssertionException('Unrecognized delta_sync_method: %s' % method)
+
+    def iter_records(self, users_filter, attribute_names):
+        '''
+        Iterate the (dn, record) pairs of the users search, as iter_search_result would.
+        The snapshot is saved once all the records have been read.
+        :type users_filter: str
+        :type attribute_names: list(str)
+        '''
+        options = self.connector.options
+        method = self.method
+        attribute_names = list(attribute_names)
+        if (method == 'change_attribute' and self.change_attribute not in attribute_names):
+            attribute_names.append(self.change_attribute)
+
+        search_key = (method, options['host'], options['base_dn'], options['search_bases'], users_filter, sorted(attribute_names))
+        state = user_sync.helper.read_state_file(self.state_path, self.logger)
+        now = time.time()
+        if (state == None or state.get('version') != self.state_version):
+            self.logger.info('Delta sync: no snapshot found; loading all users')
+            state = None
+        elif (state['search_key'] != search_key):
+            self.logger.info('Delta sync: users search has changed; loading all users')
+            state = None
+        elif (now - state['full_sync_time'] >= self.full_interval_seconds):
+            self.logger.info('Delta sync: full reconciliation is due; loading all users')
+            state = None
+
+        if (method == 'syncrepl'):
+            load_state = self.load_syncrepl_state
+        elif (method == 'dirsync'):
+            load_state = self.load_dirsync_state
+        else:
+            load_state = self.load_change_attribute_state
+
+        try:
+            new_state = load_state(users_filter, attribute_names, state)
+        except ldap.LDAPError as e:
+            # typically a cookie that the server no longer accepts.
+            if (state == None):
+                raise
+            self.logger.warning('Delta sync: incremental search failed (%s); loading all users', e)
+            state = None
+            new_state = load_state(users_filter, attribute_names, state)
+        new_state['version'] = self.state_version
+        new_state['search_key'] = search_key
+        new_state['full_sync_time'] = now if state == None else state['full_sync_time']
+
+        record_by_dn = new_state.get('record_by_dn')
+        if (record_by_dn != None):
+            for dn, record in record_by_dn.iteritems():
+                yield (dn, record)
+            user_sync.helper.write_state_file(self.state_path, new_state)
+            self.logger.info('Delta sync: saved snapshot of %d users at mark: %s', len(record_by_dn), new_state['high_water_mark'])
+        else:
+            record_by_id = new_state['record_by_id']
+            for dn, record in record_by_id.itervalues():
+                yield (dn, record)
+            user_sync.helper.write_state_file(self.state_path, new_state)
+            self.logger.info('Delta sync: saved snapshot of %d users', len(record_by_id))
+
+    def load_change_attribute_state(self, users_filter, attribute_names, state):
+        '''
+        :type users_filter: str
+        :type attribute_names: list(str)
+        :type state: dict
+        :rtype dict
+        '''
+        connector = self.connector
+        change_attribute = self.change_attribute
+        if (state != None and state['high_water_mark'] == None):
+            state = None
+
+        # read the server's mark before searching, so that changes made during the search are picked up next time.
+        high_water_mark = self.read_server_high_water_mark()
+        if (state == None):
+            record_by_dn = {}
+            for dn, record in connector.iter_users_search_result(users_filter, attribute_names):
+                if (dn != None):
+                    record_by_dn[dn] = record
+            previous_high_water_mark = None
+            changed_records = record_by_dn.itervalues()
+        else:
+            record_by_dn = state['record_by_dn']
+            previous_high_water_mark = state['high_water_mark']
+            change_filter = self.create_change_filter(previous_high_water_mark)
+            changed_record_by_dn = {}
+            changed_users_filter = '(&%s%s)' % (users_filter, change_filter)
+            for dn, record in connector.iter_users_search_result(changed_users_filter, attribute_names):
+                if (dn != None):
+                    changed_record_by_dn[dn] = record
+            # entries that have changed, but no longer match the users filter, are dropped from the snapshot.
+            total_dropped = 0
+            for dn, _record in connector.iter_users_search_result(change_filter, ['1.1']):
+                if (dn != None and dn not in changed_record_by_dn and record_by_dn.pop(dn, None) != None):
+                    total_dropped += 1
+            record_by_dn.update(changed_record_by_dn)
+            changed_records = changed_record_by_dn.itervalues()
+            self.logger.info('Delta sync: changed users: %d dropped users: %d', len(changed_record_by_dn), total_dropped)
+
+        if (high_water_mark == None):
+            high_water_mark = previous_high_water_mark
+            for record in changed_records:
+                value = LDAPValueFormatter.get_attribute_value(record, change_attribute)
+                if (value != None):
+                    value = self.parse_change_value(value)
+                    if (high_water_mark == None or value > high_water_mark):
+                        high_water_mark = value
+
+        return {
+            'high_water_mark': high_water_mark,
+            'record_by_dn': record_by_dn,
+        }
+
+    def load_syncrepl_state(self, users_filter, attribute_names, state):
+        '''
+        Run a refreshOnly content synchronization from the saved cookie, and apply what the server
+        sends to the snapshot, which is keyed by entryUUID.
+        :type users_filter: str
+        :type attribute_names: list(str)
+        :type state: dict
+        :rtype dict
+        '''
+        syncrepl = self.syncrepl
+        connection = self.connector.connection
+        if (state == None):
+            cookie = None
+            record_by_id = {}
+        else:
+            cookie = state['cookie']
+            record_by_id = state['record_by_id']
+
+        request_control = syncrepl.SyncRequestControl(cookie=cookie, mode='refreshOnly')
+        msgid = connection.search_ext(self.connector.options['base_dn'], ldap.SCOPE_SUBTREE, users_filter, attribute_names, serverctrls=[request_control])
+        present_ids = set()
+        delete_non_present = False
+        total_changed = 0
+        total_deleted = 0
+        try:
+            while msgid != None:
+                result_type, response_data, _rmsgid, serverctrls, _respoid, _respvalue = connection.result4(msgid, all=0, add_ctrls=1, add_intermediates=1)
+                if (result_type == ldap.RES_SEARCH_ENTRY):
+                    for dn, record, entry_controls in response_data:
+                        for control in entry_controls:
+                            if (not isinstance(control, syncrepl.SyncStateControl)):
+                                continue
+                            entry_id = control.entryUUID
+                            if (control.state == 'delete'):
+                                if (record_by_id.pop(entry_id, None) != None):
+                                    total_deleted += 1
+                            else:
+                                present_ids.add(entry_id)
+                                if (control.state != 'present'):
+                                    record_by_id[entry_id] = (dn, record)
+                                    total_changed += 1
+                            if (control.cookie != None):
+                                cookie = control.cookie
+                elif (result_type == ldap.RES_INTERMEDIATE):
+                    for response_name, response_value, _controls in response_data:
+                        if (response_name != syncrepl.SyncInfoMessage.responseName):
+                            continue
+                        info = syncrepl.SyncInfoMessage(response_value)
+                        info_cookie = None
+                        if (info.newcookie != None):
+                            info_cookie = info.newcookie
+                        elif (info.refreshPresent != None):
+                            # the end of the present phase: entries that were not mentioned are gone.
+                            delete_non_present = True
+                            info_cookie = info.refreshPresent['cookie']
+                        elif (info.refreshDelete != None):
+                            info_cookie = info.refreshDelete['cookie']
+                        elif (info.syncIdSet != None):
+                            if (info.syncIdSet['refreshDeletes']):
+                                for entry_id in info.syncIdSet['syncUUIDs']:
+                                    if (record_by_id.pop(entry_id, None) != None):
+                                        total_deleted += 1
+                            else:
+                                present_ids.update(info.syncIdSet['syncUUIDs'])
+                            info_cookie = info.syncIdSet['cookie']
+                        if (info_cookie != None):
+                            cookie = info_cookie
+                elif (result_type == ldap.RES_SEARCH_RESULT):
+                    msgid = None
+                    for control in serverctrls:
+                        if (not isinstance(control, syncrepl.SyncDoneControl)):
+                            continue
+                        if (not control.refreshDeletes):
+                            delete_non_present = True
+                        if (control.cookie != None):
+                            cookie = control.cookie
+        finally:
+            if (msgid != None):
+                connection.abandon(msgid)
+
+        if (delete_non_present):
+            for entry_id in [entry_id for entry_id in record_by_id if entry_id not in present_ids]:
+                del record_by_id[entry_id]
+                total_deleted += 1
+        self.logger.info('Delta sync: changed users: %d dropped users: %d', total_changed, total_deleted)
+        return {
+            'cookie': cookie,
+            'record_by_id': record_by_id,
+        }
+
+    def load_dirsync_state(self, users_filter, attribute_names, state):
+        '''
+        Read the objects changed since the saved cookie with the DirSync control, and then read those
+        that are still users again, with all of their attributes.  The snapshot is keyed by objectGUID.
+        :type users_filter: str
+        :type attribute_names: list(str)
+        :type state: dict
+        :rtype dict
+        '''
+        attribute_names = list(attribute_names)
+        attribute_names.append('objectGUID')
+        if (state == None):
+            # take the cookie before searching, so that changes made during the search are picked up next time.
+            cookie, _changed_ids, _deleted_ids = self.read_dirsync_changes('', ['objectGUID'])
+            record_by_id = {}
+            changed_ids = None
+        else:
+            cookie, changed_ids, deleted_ids = self.read_dirsync_changes(state['cookie'], attribute_names + ['isDeleted'])
+            record_by_id = state['record_by_id']
+            total_deleted = 0
+            for entry_id in deleted_ids:
+                if (record_by_id.pop(entry_id, None) != None):
+                    total_deleted += 1
+
+        if (changed_ids == None):
+            self.read_dirsync_records(users_filter, attribute_names, record_by_id)
+        else:
+            changed_ids = list(changed_ids)
+            found_ids = set()
+            batch_size = self.dirsync_batch_size
+            for start in xrange(0, len(changed_ids), batch_size):
+                id_filter = ''.join('(objectGUID=%s)' % self.escape_binary_value(entry_id) for entry_id in changed_ids[start:start + batch_size])
+                changed_users_filter = '(&%s(|%s))' % (users_filter, id_filter)
+                found_ids.update(self.read_dirsync_records(changed_users_filter, attribute_names, record_by_id))
+            # objects that have changed, but are no longer users, are dropped from the snapshot.
+            for entry_id in changed_ids:
+                if (entry_id not in found_ids and record_by_id.pop(entry_id, None) != None):
+                    total_deleted += 1
+            self.logger.info('Delta sync: changed users: %d dropped users: %d', len(found_ids), total_deleted)
+
+        return {
+            'cookie': cookie,
+            'record_by_id': record_by_id,
+        }
+
+    def read_dirsync_records(self, users_filter, attribute_names, record_by_id):
+        '''
+        Add the results of a users search to record_by_id, and return the ids found.
+        :type users_filter: str
+        :type attribute_names: list(str)
+        :type record_by_id: dict(str, tuple(str, dict))
+        :rtype set(str)
+        '''
+        connector = self.connector
+        found_ids = set()
+        for dn, record in connector.iter_users_search_result(users_filter, attribute_names):
+            entry_id = LDAPValueFormatter.get_attribute_value(record, 'objectGUID') if dn != None else None
+            if (entry_id != None):
+                record_by_id[entry_id] = (dn, record)
+                found_ids.add(entry_id)
+        return found_ids
+
+    def read_dirsync_changes(self, cookie, attribute_names):
+        '''
+        Read all the objects matching delta_sync_dirsync_filter that have changed since the cookie.
+        :type cookie: str
+        :type attribute_names: list(str)
+        :rtype (str, set(str), set(str))
+        '''
+        connection = self.connector.connection
+        base_dn = self.connector.options['base_dn']
+        response_control_classes = {LDAPDirSyncControl.controlType: LDAPDirSyncControl}
+        changed_ids = set()
+        deleted_ids = set()
+        has_more_results = True
+        while has_more_results:
+            request_control = LDAPDirSyncControl(cookie=cookie)
+            msgid = connection.search_ext(base_dn, ldap.SCOPE_SUBTREE, self.dirsync_filter, attribute_names, serverctrls=[request_control])
+            _result_type, response_data, _rmsgid, serverctrls = connection.result3(msgid, resp_ctrl_classes=response_control_classes)
+            for dn, record in response_data:
+                entry_id = LDAPValueFormatter.get_attribute_value(record, 'objectGUID') if dn != None else None
+                if (entry_id == None):
+                    continue
+                if (user_sync.helper.normalize_string(LDAPValueFormatter.get_attribute_value(record, 'isDeleted') or '') == 'true'):
+                    changed_ids.discard(entry_id)
+                    deleted_ids.add(entry_id)
+                else:
+                    changed_ids.add(entry_id)
+            response_controls = [c for c in serverctrls if c.controlType == LDAPDirSyncControl.controlType]
+            if not response_controls:
+                raise user_sync.error.AssertionException('Server ignored the DirSync control; base_dn must be the root of a domain')
+            cookie = response_controls[0].cookie
+            has_more_results = response_controls[0].more_results
+        return (cookie, changed_ids, deleted_ids)
+
+    def read_server_high_water_mark(self):
+        '''
+        For uSNChanged, return the server's highestCommittedUSN, if the root DSE provides one.
+        :rtype int
+        '''
+        if (user_sync.helper.normalize_string(self.change_attribute) != 'usnchanged'):
+            return None
+        res = self.connector.connection.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['highestCommittedUSN'])
+        for dn, attributes in res:
+            value = LDAPValueFormatter.get_attribute_value(attributes, 'highestCommittedUSN')
+            if (value != None):
+                return self.parse_change_value(value)
+        return None
+
+    def create_change_filter(self, high_water_mark):
+        '''
+        :rtype str
+        '''
+        if (isinstance(high_water_mark, (int, long))):
+            return '(%s>=%d)' % (self.change_attribute, high_water_mark + 1)
+        return '(%s>=%s)' % (self.change_attribute, ldap.filter.escape_filter_chars(high_water_mark))
+
+    @staticmethod
+    def parse_change_value(value):
+        '''
+        USNs are compared as numbers, and timestamps as strings.
+        :type value: str
+        '''
+        try:
+            return long(value)
+        except ValueError:
+            return value
+
+    @staticmethod
+    def escape_binary_value(value):
+        '''
+        Escape every byte of a binary attribute value, such as an objectGUID, for use in a filter.
+        :type value: str
+        :rtype str
+        '''
+        return ''.join('\\%02x' % ord(c) for c in value)
+
+class LDAPDirSyncControl(ldap.controls.RequestControl, ldap.controls.ResponseControl):
+    '''
+    The AD DirSync control (LDAP_SERVER_DIRSYNC_OID).  The same control type is sent with the
+    search, and returned with the new cookie.  The bind account needs the Replicating Directory
+    Changes right.
+    '''
+    controlType = '1.2.840.113556.1.4.841'
+
+    def __init__(self, criticality=True, flags=0, max_bytes=0, cookie=''):
+        self.criticality = criticality
+        self.flags = flags
+        self.max_bytes = max_bytes
+        self.cookie = cookie
+        self.more_results = False
+
+    def encodeControlValue(self):
+        from pyasn1.codec.ber import encoder
+        from pyasn1.type import namedtype, univ
+
+        class DirSyncRequestValue(univ.Sequence):
+            componentType = namedtype.NamedTypes(
+                namedtype.NamedType('flags', univ.Integer()),
+                namedtype.NamedType('maxBytes', univ.Integer()),
+                namedtype.NamedType('cookie', univ.OctetString()),
+            )
+
+        value = DirSyncRequestValue()
+        value.setComponentByName('flags', self.flags)
+        value.setComponentByName('maxBytes', self.max_bytes)
+        value.setComponentByName('cookie', self.cookie or '')
+        return encoder.encode(value)
+
+    def decodeControlValue(self, encodedControlValue):
+        from pyasn1.codec.ber import decoder
+
+        value, _rest = decoder.decode(encodedControlValue)
+        self.more_results = int(value[0]) != 0
+        self.cookie = str(value[2])
+
+class LDAPNestedGroupExpander(object):
+    '''
+    Expands the members of groups that are themselves groups.  A member DN that is not a loaded user
+    is looked up with nested_group_filter, and if it is a group, its members, and theirs in turn,
+    take its place.  The members of each group are worked out once per run, so subgroups shared by
+    many groups are only searched once, and a group that is (indirectly) a member of itself is
+    reported and not followed round again.  With nested_group_cache_path, the member DNs found not to be
+    groups (such as users that aren't loaded) are remembered for nested_group_cache_max_age_hours, so
+    that later runs don't search for them again.
+    '''
+    cache_version = 1
+
+    def __init__(self, connector, user_by_dn):
+        '''
+        :type connector: LDAPDirectoryConnector
+        :type user_by_dn: dict(str, dict)
+        '''
+        options = connector.options
+        self.connector = connector
+        self.user_by_dn = user_by_dn
+        self.members_by_group_key = {}
+        self.reported_cycle_keys = set()
+        self.cache_path = options['nested_group_cache_path']
+        self.cache_key = (options['host'], options['nested_group_filter'])
+        self.non_group_time_by_key = self.load_non_group_cache()
+        self.total_cached_non_groups = 0
+
+    def load_non_group_cache(self):
+        '''
+        :rtype dict(str, float)
+        '''
+        if (self.cache_path == None):
+            return {}
+        cache = user_sync.helper.read_state_file(self.cache_path, self.connector.logger)
+        if (cache == None or cache.get('version') != self.cache_version or cache.get('cache_key') != self.cache_key):
+            return {}
+        oldest_time = time.time() - self.connector.options['nested_group_cache_max_age_hours'] * 3600
+        return dict((key, found_time) for key, found_time in cache['non_group_time_by_key'].iteritems() if found_time >= oldest_time)
+
+    def save_non_group_cache(self):
+        if (self.cache_path == None):
+            return
+        cache = {
+            'version': self.cache_version,
+            'cache_key': self.cache_key,
+            'non_group_time_by_key': self.non_group_time_by_key,
+        }
+        user_sync.helper.write_state_file(self.cache_path, cache)
+        self.connector.logger.debug('Nested groups: %d lookups skipped; saved %d non-group members', self.total_cached_non_groups, len(self.non_group_time_by_key))
+
+    def iter_expanded_members(self, group_members):
+        '''
+        :type group_members: iterable(tuple(str, str))
+        :rtype iterator(tuple(str, str))
+        '''
+        member_attribute = self.connector.group_member_attribute
+        returned_members = set()
+        for member_tuple in group_members:
+            attribute, value = member_tuple
+            expanded_members = None
+            if (attribute == member_attribute and value not in self.user_by_dn):
+                expanded_members, _lowest_index = self.get_group_members(value, {})
+            if (expanded_members == None):
+                expanded_members = (member_tuple,)
+            for expanded_member_tuple in expanded_members:
+                if (expanded_member_tuple not in returned_members):
+                    returned_members.add(expanded_member_tuple)
+                    yield expanded_member_tuple
+
+    def get_group_members(self, dn, path_index_by_key):
+        '''
+        Return the members of the group, with those of its nested groups, or None if dn isn't a group.
+        Also returned is the lowest index in path_index_by_key (the groups being expanded) that the group
+        leads back to; the members of a group that leads back to one of the groups that contain it are
+        incomplete until that group is done, so they are not kept.
+        :type dn: str
+        :type path_index_by_key: dict(str, int)
+        :rtype (frozenset(tuple(str, str)), int)
+        '''
+        connector = self.connector
+        key = connector.normalize_dn(dn)
+        if (key in self.members_by_group_key):
+            return (self.members_by_group_key[key], sys.maxint)
+        path_index = path_index_by_key.get(key)
+        if (path_index != None):
+            if (key not in self.reported_cycle_keys):
+                self.reported_cycle_keys.add(key)
+                connector.logger.warning('Group is nested in itself: %s', dn)
+            return (frozenset(), path_index)
+        if (key in self.non_group_time_by_key):
+            self.total_cached_non_groups += 1
+            self.members_by_group_key[key] = None
+            return (None, sys.maxint)
+
+        group_tuple = self.find_group(dn, key)
+        if (group_tuple == None):
+            self.members_by_group_key[key] = None
+            return (None, sys.maxint)
+        group_dn, group_attributes = group_tuple
+
+        own_index = len(path_index_by_key)
+        lowest_index = own_index
+        path_index_by_key[key] = own_index
+        members = set()
+        try:
+            for attribute in [connector.group_member_attribute, connector.group_member_uid_attribute]:
+                for value in connector.iter_attribute_values(group_dn, attribute, group_attributes):
+                    if (attribute == connector.group_member_attribute and value not in self.user_by_dn):
+                        nested_members, nested_lowest_index = self.get_group_members(value, path_index_by_key)
+                        lowest_index = min(lowest_index, nested_lowest_index)
+                        if (nested_members != None):
+                            members.update(nested_members)
+                            continue
+                    members.add((attribute, value))
+        finally:
+            del path_index_by_key[key]
+
+        members = frozenset(members)
+        if (lowest_index >= own_index):
+            self.members_by_group_key[key] = members
+        return (members, lowest_index)
+
+    def find_group(self, dn, key):
+        '''
+        Look up the member DN with nested_group_filter.  A DN that can't be looked up is not a group as
+        far as the expansion goes; only the ones that the server answered for are remembered as non-groups.
+        :type dn: str
+        :type key: str
+        :rtype (str, dict)
+        '''
+        connector = self.connector
+        try:
+            res = connector.connection.search_s(dn, ldap.SCOPE_BASE, filterstr=connector.options['nested_group_filter'],
+                                                attrlist=[connector.group_member_attribute, connector.group_member_uid_attribute])
+        except ldap.NO_SUCH_OBJECT:
+            res = []
+        except ldap.REFERRAL:
+            connector.logger.debug('Not expanding member outside of the directory: %s', dn)
+            res = []
+        except ldap.LDAPError as e:
+            connector.logger.warning('Not expanding member: %s reason: %s', dn, e)
+            return None
+        for current_tuple in res:
+            if (current_tuple[0] != None):
+                return current_tuple
+        self.non_group_time_by_key[key] = time.time()
+        return None
+
+class LDAPGroupMemberResolver(object):
+    '''
+    Resolves the members of many groups at once.  Instead of waiting on each group search and each
+    member range in turn, up to max_in_flight asynchronous searches are kept outstanding on the
+    connection, and their results are processed in whatever order the server returns them.
+    '''
+    def __init__(self, connector, max_in_flight):
+        '''
+        :type connector: LDAPDirectoryConnector
+        :type max_in_flight: int
+        '''
+        self.connector = connector
+        self.connection = connector.connection
+        self.max_in_flight = max_in_flight
+        self.member_attributes = [connector.group_member_attribute, connector.group_member_uid_attribute]
+
+    def iter_group_members(self, groups, group_tuple_by_group=None):
+        '''
+        Yields each group together with its members once all of its member ranges have been fetched.
+        Groups are yielded in the order that they complete.  If group_tuple_by_group is given, the groups
+        have already been looked up and only the fetches of further member ranges are issued.
+        :type groups: iterable(str)
+        :type group_tuple_by_group: dict(str, (str, dict))
+        :rtype iterator(str, list((str, str)))
+        '''
+        connection = self.connection
+        options = self.connector.options
+        base_dn = options['base_dn']
+        group_filter_format = options['group_filter_format']
+        member_attributes = self.member_attributes
+
+        group_iter = iter(groups)
+        has_more_groups = True
+        range_requests = collections.deque()
+        request_by_msgid = {}
+        members_by_group = {}
+        total_outstanding_by_group = {}
+
+        try:
+            while True:
+                # ranged fetches go first, so that groups already started finish as soon as possible.
+                while (len(request_by_msgid) < self.max_in_flight):
+                    if (len(range_requests) > 0):
+                        group, dn, attribute_name, next_attribute_name = range_requests.popleft()
+                        msgid = connection.search_ext(dn, ldap.SCOPE_BASE, attrlist=[next_attribute_name])
+                        request_by_msgid[msgid] = (group, dn, attribute_name)
+                    elif (has_more_groups):
+                        group = next(group_iter, None)
+                        if (group == None):
+                            has_more_groups = False
+                            continue
+                        if (group_tuple_by_group != None):
+                            members = []
+                            group_tuple = group_tuple_by_group.get(group)
+                            entries = [] if group_tuple == None else [group_tuple]
+                            total_range_requests = len(range_requests)
+                            self.add_group_entries(group, entries, members, range_requests)
+                            if (len(range_requests) == total_range_requests):
+                                yield (group, members)
+                            else:
+                                members_by_group[group] = members
+                                total_outstanding_by_group[group] = len(range_requests) - total_range_requests
+                            continue
+                        msgid = connection.search_ext(
+                            base_dn,
+                            ldap.SCOPE_SUBTREE,
+                            filterstr=group_filter_format.format(group=group),
+                            attrlist=member_attributes
+                        )
+                        request_by_msgid[msgid] = (group, None, None)
+                        members_by_group[group] = []
+                        total_outstanding_by_group[group] = 1
+                    else:
+                        break
+
+                if (len(request_by_msgid) == 0):
+                    break
+
+                result_type, result_response, msgid, _serverctrls = connection.result3(ldap.RES_ANY, 1)
+                group, dn, attribute_name = request_by_msgid.pop(msgid)
+                members = members_by_group[group]
+                total_range_requests = len(range_requests)
+                entries = []
+                if ((result_type == ldap.RES_SEARCH_RESULT or result_type == ldap.RES_SEARCH_ENTRY) and result_response != None):
+                    entries = [current_tuple for current_tuple in result_response if current_tuple[0] != None]
+
+                if (dn == None):
+                    # this is the result of the group search itself
+                    self.add_group_entries(group, entries, members, range_requests)
+                elif (len(entries) > 0):
+                    self.add_attribute_values(group, dn, attribute_name, entries[0][1], members, range_requests)
+
+                # the request just processed is done, but it may have queued fetches for further ranges.
+                total_outstanding = total_outstanding_by_group[group] - 1 + len(range_requests) - total_range_requests
+                if (total_outstanding == 0):
+                    del total_outstanding_by_group[group]
+                    del members_by_group[group]
+                    yield (group, members)
+                else:
+                    total_outstanding_by_group[group] = total_outstanding
+        finally:
+            for msgid in request_by_msgid.iterkeys():
+                connection.abandon(msgid)
+
+    def add_group_entries(self, group, entries, members, range_requests):
+        '''
+        Collect the members of a group from the entries found when searching for it.
+        :type group: str
+        :type entries: list((str, dict))
+        :type members: list((str, str))
+        :type range_requests: collections.deque
+        '''
+        if (len(entries) > 1):
+            raise user_sync.error.AssertionException("Multiple LDAP groups found for: %s" % group)
+        if (len(entries) == 0):
+            self.connector.logger.warning("No group found for: %s", group)
+        else:
+            group_dn, group_attributes = entries[0]
+            for member_attribute in self.member_attributes:
+                self.add_attribute_values(group, group_dn, member_attribute, group_attributes, members, range_requests)
+
+    def add_attribute_values(self, group, dn, attribute_name, attributes, members, range_requests):
+        '''
+        Collect the values of attribute_name found in attributes, queueing a fetch of the next range if
+        the server only returned part of them.
+        :type group: str
+        :type dn: str
+        :type attribute_name: str
+        :type attributes: dict(str, list)
+        :type members: list((str, str))
+        :type range_requests: collections.deque
+        '''
+        for current_attribute_name, current_attribute_values in attributes.iteritems():
+            current_attribute_name_parts = current_attribute_name.split(';')
+            if (current_attribute_name_parts[0] != attribute_name):
+                continue
+            if (len(current_attribute_name_parts) > 1):
+                upper_bound = self.connector.get_range_upper_bound(current_attribute_name_parts[1])
+                if (upper_bound != None and upper_bound != '*'):
+                    next_attribute_name = "%s;range=%s-*" % (attribute_name, str(int(upper_bound) + 1))
+                    range_requests.append((group, dn, attribute_name, next_attribute_name))
+            for current_attribute_value in current_attribute_values:
+                members.append((attribute_name, current_attribute_value))
+
 class LDAPValueFormatter(object):
+    '''
+    Makes a value from the attributes of a search result record, following a format such as
+    {mail} or {givenName}.{sn}@example.com.  The format is compiled when the formatter is made:
+    a format that is just one attribute becomes a lookup of that attribute, and other formats
+    whose fields are plain attribute names become a fixed % template.  Anything else is left to
+    str.format.
+    '''
     def __init__(self, string_format):
         '''
         :type string_format: str
@@ -377,6 +1756,7 @@ class LDAPValueFormatter(object):
             
         self.string_format = string_format        
         self.attribute_names = attribute_names
+        self.generator = self.compile_generator(string_format, attribute_names)
         
     def get_attribute_names(self):
         '''
@@ -386,24 +1766,70 @@ class LDAPValueFormatter(object):
     
     def generate_value(self, record):
         '''
-        :type parameter_names: list(str)
         :type record: dict
-        :type logger: logging
         :rtype (str, str)
         ''' 
-        result = None
-        attribute_name = None
-        if (self.string_format != None):   
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_attribute_value(record, attribute_name)
-                if (value == None):
-                    values = None
-                    break
-                values[attribute_name] = value
-            if (values != None):
-                result = self.string_format.format(**values)
-        return (result, attribute_name)
+        return self.generator(record)
+
+    def generate_values(self, records):
+        '''
+        Generate the values for a page of search result records at once.
+        :type records: list(dict)
+        :rtype list(tuple(str, str))
+        '''
+        return map(self.generator, records)
+
+    @staticmethod
+    def compile_generator(string_format, attribute_names):
+        '''
+        Return a function of a record that returns the (value, name) pair that generate_value does:
+        the name is of the first attribute that is missing, or else of the last attribute.
+        :type string_format: str
+        :type attribute_names: list(str)
+        :rtype callable(dict)
+        '''
+        if (string_format == None):
+            return lambda record: (None, None)
+
+        parts = list(string.Formatter().parse(string_format))
+        is_simple = all((field_name == None or (re.match(r'^[\w-]+$', field_name) and not field_name.isdigit())) and
+                        not format_spec and not conversion
+                        for _literal_text, field_name, format_spec, conversion in parts)
+        last_attribute_name = attribute_names[-1] if len(attribute_names) > 0 else None
+
+        if (not is_simple):
+            def generate_formatted_value(record):
+                values = {}
+                for attribute_name in attribute_names:
+                    value = LDAPValueFormatter.get_attribute_value(record, attribute_name)
+                    if (value == None):
+                        return (None, attribute_name)
+                    values[attribute_name] = value
+                return (string_format.format(**values), last_attribute_name)
+            return generate_formatted_value
+
+        if (len(parts) == 1 and not parts[0][0] and parts[0][1]):
+            attribute_name = parts[0][1]
+            def generate_attribute_value(record):
+                attribute_value = record.get(attribute_name)
+                if (attribute_value):
+                    return (attribute_value[0], attribute_name)
+                return (None, attribute_name)
+            return generate_attribute_value
+
+        template = ''.join(literal_text.replace('%', '%%') + ('%s' if field_name else '') for literal_text, field_name, _format_spec, _conversion in parts)
+        if (len(attribute_names) == 0):
+            return lambda record: (template % (), None)
+
+        def generate_template_value(record):
+            values = []
+            for attribute_name in attribute_names:
+                attribute_value = record.get(attribute_name)
+                if (not attribute_value):
+                    return (None, attribute_name)
+                values.append(attribute_value[0])
+            return (template % tuple(values), last_attribute_name)
+        return generate_template_value
 
     @staticmethod
     def get_attribute_value(attributes, attribute_name):
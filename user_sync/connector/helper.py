@@ -31,17 +31,256 @@ def create_logger(options):
      
 def create_blank_user():
     '''
-    :rtype dict
-    '''
-    user = {
-        "identitytype": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
-    return user;
+    :rtype DirectoryUser
+    '''
+    return DirectoryUser()
+
+class DirectoryUserGroups(set):
+    '''
+    The directory groups of a user.  It is a set, but can still be added to as the list it used to be.
+    '''
+    __slots__ = ()
+
+    def append(self, group):
+        self.add(intern(group) if type(group) is str else group)
+
+    def extend(self, groups):
+        for group in groups:
+            self.append(group)
+
+class DirectoryUser(object):
+    '''
+    A user read from a directory.  All of the directory users are kept for the whole run, so instead
+    of a dict, each is a record with a slot for each of the fields.  It still supports the dict
+    operations that the rules and the hooks use.  Values that many users share, such as countries
+    and domains, are interned.  The source attributes, if the connector was asked for them, are
+    usually a SourceAttributes view.  Keys other than the fields are kept in a dict of their own.
+    '''
+    field_names = ('identitytype', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country', 'uid', 'source_attributes')
+    field_name_set = frozenset(field_names)
+    interned_field_names = frozenset(['identitytype', 'domain', 'country'])
+
+    __slots__ = field_names + ('other_values',)
+
+    def __init__(self):
+        self.identitytype = None
+        self.username = None
+        self.domain = None
+        self.firstname = None
+        self.lastname = None
+        self.email = None
+        self.groups = DirectoryUserGroups()
+        self.country = None
+
+    def __getitem__(self, key):
+        try:
+            if (key in DirectoryUser.field_name_set):
+                return getattr(self, key)
+            return self.other_values[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if (key in DirectoryUser.field_name_set):
+            if (key == 'groups'):
+                groups = DirectoryUserGroups()
+                groups.extend(value)
+                value = groups
+            elif (key in DirectoryUser.interned_field_names and type(value) is str):
+                value = intern(value)
+            setattr(self, key, value)
+        else:
+            try:
+                other_values = self.other_values
+            except AttributeError:
+                self.other_values = other_values = {}
+            other_values[key] = value
+
+    def __delitem__(self, key):
+        if (key not in self):
+            raise KeyError(key)
+        if (key in DirectoryUser.field_name_set):
+            delattr(self, key)
+        else:
+            del self.other_values[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [field_name for field_name in DirectoryUser.field_names if hasattr(self, field_name)]
+        if (hasattr(self, 'other_values')):
+            keys.extend(self.other_values.iterkeys())
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield (key, self[key])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def update(self, values):
+        '''
+        :type values: dict
+        '''
+        for key, value in values.iteritems():
+            self[key] = value
+
+    def copy(self):
+        '''
+        :rtype DirectoryUser
+        '''
+        user = DirectoryUser()
+        user.__setstate__(self.__getstate__())
+        return user
+
+    def __getstate__(self):
+        state = dict((name, getattr(self, name)) for name in DirectoryUser.__slots__ if hasattr(self, name))
+        source_attributes = state.get('source_attributes')
+        if (isinstance(source_attributes, SourceAttributes)):
+            # the view's record accessor may not be picklable, so its values are saved instead.
+            state['source_attributes'] = dict(source_attributes.iteritems())
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        if (isinstance(other, DirectoryUser)):
+            other = dict(other.iteritems())
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+class SourceAttributeLayout(object):
+    '''
+    The names of the source attributes that a connector provides, which are shared by all of its
+    SourceAttributes views.  The first of the names are for values that the connector computes,
+    and the rest are read from the directory record with get_record_value(record, name).
+    '''
+    def __init__(self, computed_names, record_names, get_record_value):
+        '''
+        :type computed_names: iterable(str)
+        :type record_names: iterable(str)
+        :type get_record_value: callable(dict, str)
+        '''
+        computed_names = tuple(computed_names)
+        self.names = computed_names + tuple(record_names)
+        self.total_computed = len(computed_names)
+        self.index_by_name = dict((name, index) for index, name in enumerate(self.names))
+        self.get_record_value = get_record_value
+
+class SourceAttributes(object):
+    '''
+    A read-only view of the source attributes of a user.  Rather than copying the attributes into
+    a dict for each user, values are read from the directory's record of the user when asked for.
+    '''
+    __slots__ = ('layout', 'record', 'computed_values')
+
+    def __init__(self, layout, record, computed_values=()):
+        '''
+        :type layout: SourceAttributeLayout
+        :type record: dict
+        :type computed_values: tuple
+        '''
+        self.layout = layout
+        self.record = record
+        self.computed_values = computed_values
+
+    def __getitem__(self, name):
+        layout = self.layout
+        index = layout.index_by_name[name]
+        if (index < layout.total_computed):
+            return self.computed_values[index]
+        return layout.get_record_value(self.record, name)
+
+    def __contains__(self, name):
+        return name in self.layout.index_by_name
+
+    has_key = __contains__
+
+    def get(self, name, default=None):
+        if (name not in self.layout.index_by_name):
+            return default
+        return self[name]
+
+    def keys(self):
+        return list(self.layout.names)
+
+    def __iter__(self):
+        return iter(self.layout.names)
+
+    def __len__(self):
+        return len(self.layout.names)
+
+    def iterkeys(self):
+        return iter(self.layout.names)
+
+    def iteritems(self):
+        for name in self.layout.names:
+            yield (name, self[name])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for name in self.layout.names:
+            yield self[name]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        '''
+        :rtype dict
+        '''
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if (isinstance(other, SourceAttributes)):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
 
+    def __repr__(self):
+        return repr(self.copy())
@@ -18,9 +18,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bz2
+import cPickle
 import csv
 import datetime
+import gzip
+import io
 import os
+import tempfile
 
 import user_sync.error
 
@@ -35,6 +40,136 @@ def open_file(name, mode, buffering = -1):
     except IOError as e:
         raise user_sync.error.AssertionException(str(e))
 
+compression_by_extension = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+}
+
+compressed_file_buffer_size = 1024 * 1024
+
+def get_file_compression(file_path, check_content = True):
+    '''
+    Returns the compression of a file: 'gzip', 'bz2' or 'xz', going by the extension of file_path, or else (if
+    check_content is set) by the first bytes of the file if it exists.  Returns None for a file that is not compressed.
+    :type file_path: str
+    :type check_content: bool
+    :rtype str
+    '''
+    _base_name, extension = os.path.splitext(str(file_path))
+    compression = compression_by_extension.get(normalize_string(extension))
+    if (compression != None or not check_content or not os.path.isfile(file_path)):
+        return compression
+    try:
+        with open(file_path, 'rb') as input_file:
+            magic = input_file.read(10)
+    except IOError:
+        return None
+    if (magic.startswith('\x1f\x8b')):
+        return 'gzip'
+    if (magic.startswith('BZh') and magic[3:4].isdigit() and magic[4:10] in ('1AY&SY', '\x17rE8P\x90')):
+        return 'bz2'
+    if (magic.startswith('\xfd7zXZ\x00')):
+        return 'xz'
+    return None
+
+def open_compressed_file(name, mode, buffering = -1):
+    '''
+    Opens a file that may be compressed, as found by get_file_compression, decompressing it as it is read or
+    compressing it as it is written.  Only the extension says whether a file being written is compressed.  A
+    compressed file is always opened in binary mode, with a buffer of at least compressed_file_buffer_size bytes.
+    Reading or writing xz files requires the backports.lzma package.
+    :type name: str
+    :type mode: str
+    :type buffering: int
+    '''
+    writing = mode.startswith('w')
+    compression = get_file_compression(name, check_content = not writing)
+    if (compression == None):
+        return open_file(name, mode, buffering)
+
+    buffer_size = max(buffering, compressed_file_buffer_size)
+    try:
+        if (compression == 'bz2'):
+            return bz2.BZ2File(str(name), 'w' if writing else 'r', buffer_size)
+        if (compression == 'gzip'):
+            compressed_file = gzip.GzipFile(str(name), 'wb' if writing else 'rb')
+        else:
+            try:
+                from backports import lzma
+            except ImportError:
+                try:
+                    import lzma
+                except ImportError as e:
+                    raise user_sync.error.AssertionException('Reading or writing xz files requires the backports.lzma package: %s' % e)
+            compressed_file = lzma.LZMAFile(str(name), 'wb' if writing else 'rb')
+    except IOError as e:
+        raise user_sync.error.AssertionException(str(e))
+    if (writing):
+        return io.BufferedWriter(compressed_file, buffer_size)
+    return io.BufferedReader(compressed_file, buffer_size)
+
+def read_state_file(file_path, logger = None):
+    '''
+    Read a value saved by write_state_file.  Returns None if the file does not exist or cannot be read.
+    :type file_path: str
+    :type logger: logging.Logger
+    '''
+    if (not os.path.isfile(file_path)):
+        return None
+    try:
+        with open_file(file_path, 'rb') as input_file:
+            return cPickle.load(input_file)
+    except Exception as e:
+        if (logger != None):
+            logger.warning('Ignoring unreadable state file: %s reason: %s', file_path, e)
+        return None
+
+def write_state_file(file_path, value):
+    '''
+    Save a value to a file.  The value is written to a temporary file in the same directory, which then
+    replaces file_path, so that a reader never sees a partially written file.
+    :type file_path: str
+    '''
+    output_file = AtomicFileWriter(file_path)
+    try:
+        cPickle.dump(value, output_file.file, cPickle.HIGHEST_PROTOCOL)
+        output_file.commit()
+    finally:
+        output_file.discard()
+
+class AtomicFileWriter(object):
+    '''
+    Writes a file through a temporary file in the same directory, which replaces the file on commit, so that a
+    reader never sees a partially written file, and of several concurrent writers the last to commit wins.
+    '''
+    def __init__(self, file_path):
+        '''
+        :type file_path: str
+        '''
+        self.file_path = file_path
+        directory = os.path.dirname(os.path.abspath(file_path))
+        handle, self.temp_path = tempfile.mkstemp(prefix = os.path.basename(file_path) + '.', suffix = '.tmp', dir = directory)
+        self.file = os.fdopen(handle, 'wb')
+
+    def commit(self):
+        self.file.close()
+        file_path = self.file_path
+        if (os.name == 'nt' and os.path.exists(file_path)):
+            os.remove(file_path)
+        os.rename(self.temp_path, file_path)
+        self.temp_path = None
+
+    def discard(self):
+        '''
+        Removes the temporary file if the writer was not committed.
+        '''
+        if (self.temp_path != None):
+            self.file.close()
+            if (os.path.exists(self.temp_path)):
+                os.remove(self.temp_path)
+            self.temp_path = None
+
 def normalize_string(string_value):
     '''
     :type string_value: str
@@ -46,7 +181,9 @@ def guess_delimiter_from_filename(filename):
     :type filename
     :rtype str
     '''
-    _base_name, extension = os.path.os.path.splitext(filename)
+    base_name, extension = os.path.splitext(filename)
+    if (normalize_string(extension) in compression_by_extension):
+        _base_name, extension = os.path.splitext(base_name)
     normalized_extension = normalize_string(extension)
     if (normalized_extension == '.csv'):
         return ','
@@ -54,26 +191,35 @@ def guess_delimiter_from_filename(filename):
         return '\t'
     return '\t'
 
-def iter_csv_rows(file_path, delimiter = None, recognized_column_names = None, logger = None):
+def iter_csv_rows(file_path, delimiter = None, recognized_column_names = None, logger = None, buffering = 1):
     '''
     :type file_path: str
     :type delimiter: str
     :type recognized_column_names: list(str)
     :type logger: logging.Logger
+    :type buffering: int
     '''
-    with open_file(file_path, 'r', 1) as input_file:
+    with open_compressed_file(file_path, 'r', buffering) as input_file:
         if (delimiter == None):
             delimiter = guess_delimiter_from_filename(file_path)
         reader = csv.DictReader(input_file, delimiter = delimiter)
 
         if (recognized_column_names != None):
-            unrecognized_column_names = [column_name for column_name in reader.fieldnames if column_name not in recognized_column_names] 
-            if (len(unrecognized_column_names) > 0 and logger != None):
-                logger.warn("Unrecognized column names: %s", unrecognized_column_names)
+            warn_unrecognized_column_names(reader.fieldnames, recognized_column_names, logger)
 
         for row in reader:
             yield row
             
+def warn_unrecognized_column_names(column_names, recognized_column_names, logger = None):
+    '''
+    :type column_names: list(str)
+    :type recognized_column_names: list(str)
+    :type logger: logging.Logger
+    '''
+    unrecognized_column_names = [column_name for column_name in column_names if column_name not in recognized_column_names] 
+    if (len(unrecognized_column_names) > 0 and logger != None):
+        logger.warn("Unrecognized column names: %s", unrecognized_column_names)
+
 class JobStats(object):
     line_left_count = 10
     line_width = 60
@@ -19,7 +19,12 @@
 # SOFTWARE.
 
 import csv
+import itertools
 import logging
+import multiprocessing.pool
+import Queue
+import sys
+import threading
 
 import user_sync.connector.dashboard
 import user_sync.error
@@ -60,6 +65,10 @@ class RuleProcessor(object):
 
             'after_mapping_hook': None,
             'extended_attributes': None,
+            'prefetch_dashboard_users': False,
+            'accessor_workers': 1,
+            'query_mapped_groups_only': False,
+            'query_mapped_groups_max_lookups': 100,
         }
         options.update(caller_options)        
         self.options = options        
@@ -67,6 +76,8 @@ class RuleProcessor(object):
         self.filtered_directory_user_by_user_key = {}
         self.organization_info_by_organization = {}
         self.adding_dashboard_user_key = set()
+        self.dashboard_user_prefetches = {}
+        self.thread_state = threading.local()
 
         remove_user_key_list = options['remove_user_key_list']
         remove_user_key_list = set(remove_user_key_list) if (remove_user_key_list != None) else set()
@@ -74,7 +85,12 @@ class RuleProcessor(object):
         
         self.need_to_process_orphaned_dashboard_users = options['remove_list_output_path'] != None or options['remove_nonexistent_users']
                 
-        self.logger = logger = logging.getLogger('processor')
+        self.base_logger = logger = logging.getLogger('processor')
+
+        self.query_mapped_groups_only = options['query_mapped_groups_only']
+        if (self.query_mapped_groups_only and (self.need_to_process_orphaned_dashboard_users or not options['manage_groups'])):
+            logger.warning('Ignoring query_mapped_groups_only: all the users are needed to manage users rather than groups')
+            self.query_mapped_groups_only = False
 
         # in/out variables for per-user after-mapping-hook code
         self.after_mapping_hook_scope = {
@@ -97,6 +113,13 @@ class RuleProcessor(object):
                 options_to_report['username_filter_regex'] = "%s: %s" % (type(username_filter_regex), username_filter_regex.pattern)
             logger.debug('Initialized with options: %s', options_to_report)
 
+    @property
+    def logger(self):
+        '''
+        The processor logger, or the buffering logger of the accessor organization processed by this thread.
+        '''
+        return getattr(self.thread_state, 'logger', None) or self.base_logger
+
     def run(self, directory_groups, directory_connector, dashboard_connectors):
         '''
         :type directory_groups: dict(str, list(DashboardGroup)
@@ -107,6 +130,9 @@ class RuleProcessor(object):
 
         self.prepare_organization_infos()
 
+        if (directory_connector != None and self.options['prefetch_dashboard_users']):
+            self.start_dashboard_user_prefetches(dashboard_connectors)
+
         if (directory_connector != None):
             load_directory_stats = user_sync.helper.JobStats("Load from Directory", divider = "-")
             load_directory_stats.log_start(logger)
@@ -143,6 +169,75 @@ class RuleProcessor(object):
             organization_info = self.get_organization_info(dashboard_group.get_organization_name())
             organization_info.add_mapped_group(create_target_group_from_config_group(dashboard_group))
 
+    def start_dashboard_user_prefetches(self, dashboard_connectors):
+        '''
+        Start downloading the users of the owning organization, and of the accessor organizations with mapped groups,
+        so that the download goes on while the directory users are loaded.
+        :type dashboard_connectors: DashboardConnectors
+        '''
+        self.logger.info('Downloading dashboard users while loading from directory...')
+        connectors = [(OWNING_ORGANIZATION_NAME, dashboard_connectors.get_owning_connector())]
+        for organization_name, dashboard_connector in dashboard_connectors.get_accessor_connectors().iteritems():
+            if (len(self.get_organization_info(organization_name).get_mapped_groups()) > 0):
+                connectors.append((organization_name, dashboard_connector))
+        for organization_name, dashboard_connector in connectors:
+            group_names = self.get_query_group_names(self.get_organization_info(organization_name))
+            self.dashboard_user_prefetches[dashboard_connector] = DashboardUserPrefetch(dashboard_connector, group_names)
+
+    def get_query_group_names(self, organization_info):
+        '''
+        Returns the names of the groups whose members are the dashboard users to sync, or None to sync all the users.
+        :type organization_info: OrganizationInfo
+        :rtype list(str)
+        '''
+        if (not self.query_mapped_groups_only):
+            return None
+        return sorted(target_group.group_name for target_group in organization_info.get_mapped_groups())
+
+    def iter_dashboard_users(self, dashboard_connector, group_names = None):
+        '''
+        Iterate the users of a dashboard connector, or the members of group_names if not None, from the download
+        started by start_dashboard_user_prefetches if there is one.
+        :type dashboard_connector: user_sync.connector.dashboard.DashboardConnector
+        :type group_names: list(str)
+        '''
+        prefetch = self.dashboard_user_prefetches.pop(dashboard_connector, None)
+        if (prefetch != None):
+            return prefetch.iter_users()
+        if (group_names != None):
+            return dashboard_connector.iter_group_users(group_names)
+        return dashboard_connector.iter_users()
+
+    def iter_looked_up_dashboard_users(self, dashboard_connector, user_to_group_map):
+        '''
+        Looks up, one at a time, the directory users still in user_to_group_map, and yields those found in the
+        dashboard, so that only the users that are not found are created.  The map is read once the users before
+        these have been matched, and so popped from it.  When there are more than query_mapped_groups_max_lookups
+        of them, all the users are read instead, which takes fewer calls.
+        :type dashboard_connector: user_sync.connector.dashboard.DashboardConnector
+        :type user_to_group_map: dict(str, set)
+        '''
+        email_by_user_key = {}
+        for user_key in user_to_group_map.iterkeys():
+            email = self.filtered_directory_user_by_user_key[user_key].get('email')
+            if (email != None):
+                email_by_user_key[user_key] = email
+        max_lookups = self.options['query_mapped_groups_max_lookups']
+        if (len(email_by_user_key) > max_lookups):
+            self.logger.info('Reading all users instead of looking up users not in mapped groups: %d', len(email_by_user_key))
+            for dashboard_user in dashboard_connector.iter_users():
+                user_key = self.get_dashboard_user_key(dashboard_user)
+                if (user_key in email_by_user_key and user_key in user_to_group_map):
+                    yield dashboard_user
+            return
+
+        self.logger.info('Looking up users not in mapped groups: %d', len(email_by_user_key))
+        for user_key, email in email_by_user_key.iteritems():
+            dashboard_user = dashboard_connector.get_user(email)
+            # a user found by email could be another identity type, which is not the directory user
+            if (dashboard_user != None and self.get_dashboard_user_key(dashboard_user) == user_key):
+                yield dashboard_user
+
     def read_desired_user_groups(self, mappings, directory_connector):
         '''
         :type mappings: dict(str, list(DashboardGroup))
@@ -163,7 +258,8 @@ class RuleProcessor(object):
         directory_group_names = set(mappings.iterkeys())
         if (directory_group_filter != None):
             directory_group_names.update(directory_group_filter)
-        all_loaded, directory_users = directory_connector.load_users_and_groups(directory_group_names, extended_attributes)
+        need_source_attributes = options['after_mapping_hook'] is not None
+        all_loaded, directory_users = directory_connector.load_users_and_groups(directory_group_names, extended_attributes, directory_group_filter, need_source_attributes)
         if (not all_loaded and self.need_to_process_orphaned_dashboard_users):
             self.logger.warn('Not all users loaded.  Cannot check orphaned users...')
             self.need_to_process_orphaned_dashboard_users = False
@@ -194,7 +290,7 @@ class RuleProcessor(object):
 
             # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
             if options['after_mapping_hook'] is not None:
-                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
+                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes']
 
                 target_attributes = dict()
                 target_attributes['email'] = directory_user.get('email')
@@ -263,17 +359,19 @@ class RuleProcessor(object):
         for user_key in owning_unprocessed_groups_by_user_key.iterkeys():
             self.add_dashboard_user(user_key, dashboard_connectors)
 
-        for organization_name, dashboard_connector in dashboard_connectors.get_accessor_connectors().iteritems():
+        def sync_accessor(organization_name, dashboard_connector):
             self.logger.info('Syncing accessor %s...', organization_name) 
             accessor_organization_info = self.get_organization_info(organization_name)
             if (len(accessor_organization_info.get_mapped_groups()) == 0):
                 self.logger.info('No mapped groups for accessor: %s', organization_name) 
-                continue
+                return
 
             accessor_unprocessed_groups_by_user_key = self.update_dashboard_users_for_connector(accessor_organization_info, dashboard_connector)
             if (manage_groups):
                 for user_key, desired_groups in accessor_unprocessed_groups_by_user_key.iteritems():
                     self.try_and_update_dashboard_user(accessor_organization_info, user_key, dashboard_connector, groups_to_add=desired_groups)
+
+        self.for_each_accessor_connector(dashboard_connectors, sync_accessor)
                     
     def iter_orphaned_dashboard_users(self, orphan_account_types):
         owning_organization_info = self.get_organization_info(OWNING_ORGANIZATION_NAME)
@@ -346,6 +444,8 @@ class RuleProcessor(object):
         total_waiting_by_user_key = {}
         for user_key in remove_user_key_list:
             total_waiting_by_user_key[user_key] = 0
+        # the accessor organizations may be cleaned by several threads
+        total_waiting_lock = threading.Lock()
 
         def try_and_remove_from_org(user_key):
             total_waiting = total_waiting_by_user_key[user_key]
@@ -359,24 +459,22 @@ class RuleProcessor(object):
                     dashboard_connectors.get_owning_connector().send_commands(commands)
 
         def on_remove_groups_callback(user_key):
-            total_waiting = total_waiting_by_user_key[user_key]     
-            total_waiting -= 1
-            total_waiting_by_user_key[user_key] = total_waiting
+            with total_waiting_lock:
+                total_waiting_by_user_key[user_key] -= 1
             if ready_to_remove_from_org:
                 try_and_remove_from_org(user_key)
 
         def create_remove_groups_callback(user_key):
-            total_waiting = total_waiting_by_user_key[user_key]     
-            total_waiting += 1
-            total_waiting_by_user_key[user_key] = total_waiting
+            with total_waiting_lock:
+                total_waiting_by_user_key[user_key] += 1
             return lambda response: on_remove_groups_callback(user_key)
         
-        for organization_name, dashboard_connector in dashboard_connectors.get_accessor_connectors().iteritems():
+        def clean_accessor(organization_name, dashboard_connector):
             organization_info = self.get_organization_info(organization_name)
             target_groups = organization_info.get_mapped_groups()
             if (len(target_groups) == 0):
                 self.logger.info('No mapped groups for accessor: %s', organization_name) 
-                continue
+                return
                             
             for user_key in remove_user_key_list:
                 dashboard_user = organization_info.get_dashboard_user(user_key)
@@ -396,10 +494,56 @@ class RuleProcessor(object):
                     commands.remove_groups(groups_to_remove)
                     dashboard_connector.send_commands(commands, create_remove_groups_callback(user_key))
 
+        self.for_each_accessor_connector(dashboard_connectors, clean_accessor)
+
         ready_to_remove_from_org = True
         for user_key in remove_user_key_list:
             try_and_remove_from_org(user_key)
      
+    def for_each_accessor_connector(self, dashboard_connectors, function):
+        '''
+        Call function(organization_name, dashboard_connector) for each accessor organization.
+        With more than one accessor worker the organizations are processed concurrently, each on its own
+        thread; the messages that the processor logs for an organization are held back and then logged in
+        organization order.  Those of the dashboard connectors are logged as they happen, so they can interleave.
+        The owning organization is not touched by the workers, so the callbacks for users being created in it
+        still run on this thread, after the accessor organizations have been processed.
+        :type dashboard_connectors: DashboardConnectors
+        :type function: (str, user_sync.connector.dashboard.DashboardConnector) -> None
+        '''
+        accessor_connectors = dashboard_connectors.get_accessor_connectors().items()
+        workers = min(self.options['accessor_workers'], len(accessor_connectors))
+        if (workers <= 1):
+            for organization_name, dashboard_connector in accessor_connectors:
+                function(organization_name, dashboard_connector)
+            return
+
+        def call_function(accessor_connector):
+            log_records = []
+            self.thread_state.logger = logger = logging.Logger(self.base_logger.name, self.base_logger.getEffectiveLevel())
+            logger.addHandler(LogRecordBuffer(log_records))
+            try:
+                function(*accessor_connector)
+                return log_records, None
+            except:
+                return log_records, sys.exc_info()
+            finally:
+                self.thread_state.logger = None
+
+        first_exc_info = None
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            for log_records, exc_info in pool.imap(call_function, accessor_connectors):
+                for log_record in log_records:
+                    self.base_logger.handle(log_record)
+                if (first_exc_info == None):
+                    first_exc_info = exc_info
+        finally:
+            pool.close()
+            pool.join()
+        if (first_exc_info != None):
+            raise first_exc_info[0], first_exc_info[1], first_exc_info[2]
+
     def get_user_attributes(self, directory_user):
         attributes = {}
         attributes['email'] = directory_user['email']
@@ -591,7 +735,11 @@ class RuleProcessor(object):
 
         # Walk all the dashboard users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
-        for dashboard_user in dashboard_connector.iter_users():
+        query_group_names = self.get_query_group_names(organization_info)
+        dashboard_users = self.iter_dashboard_users(dashboard_connector, query_group_names)
+        if (query_group_names != None and organization_info.get_name() == OWNING_ORGANIZATION_NAME):
+            dashboard_users = itertools.chain(dashboard_users, self.iter_looked_up_dashboard_users(dashboard_connector, user_to_group_map))
+        for dashboard_user in dashboard_users:
             # get the basic data about this user; initialize change markers to "no change"
             user_key = self.get_dashboard_user_key(dashboard_user)
             organization_info.add_dashboard_user(user_key, dashboard_user)
@@ -648,8 +796,9 @@ class RuleProcessor(object):
             # Finally, execute the attribute and group adjustments
             self.try_and_update_dashboard_user(organization_info, user_key, dashboard_connector, attribute_differences, groups_to_add, groups_to_remove, dashboard_user)
 
-        # mark the org's dashboard users as processed and return the remaining ones in the map
-        organization_info.set_dashboard_users_loaded()
+        # mark the org's dashboard users as processed, unless only some were queried, and return the remaining ones in the map
+        if (query_group_names == None):
+            organization_info.set_dashboard_users_loaded()
         return user_to_group_map
     
     @staticmethod
@@ -830,7 +979,7 @@ class RuleProcessor(object):
 
     def write_remove_list(self, file_path, dashboard_users):
         total_users = 0
-        with open(file_path, 'wb') as output_file:
+        with user_sync.helper.open_compressed_file(file_path, 'wb') as output_file:
             delimiter = user_sync.helper.guess_delimiter_from_filename(file_path)            
             writer = csv.DictWriter(output_file, fieldnames = ['type', 'user', 'domain'], delimiter = delimiter)
             writer.writeheader()
@@ -884,7 +1033,72 @@ class DashboardConnectors(object):
                     had_work = True
             if not had_work:
                 break
+        for connector in self.connectors:
+            connector.save_snapshot()
+        for rate_limiter in set(connector.get_rate_limiter() for connector in self.connectors):
+            rate_limiter.log_statistics()
     
+class LogRecordBuffer(logging.Handler):
+    '''
+    A log handler that keeps the records it is given, so they can be logged later.
+    '''
+    def __init__(self, log_records):
+        '''
+        :type log_records: list(logging.LogRecord)
+        '''
+        logging.Handler.__init__(self)
+        self.log_records = log_records
+
+    def emit(self, record):
+        self.log_records.append(record)
+
+class DashboardUserPrefetch(object):
+    '''
+    Downloads the users of a dashboard connector on a thread of its own.  The users are buffered until they are
+    read with iter_users, which can be called once.
+    '''
+    users_per_message = 1000
+
+    def __init__(self, dashboard_connector, group_names = None):
+        '''
+        :type dashboard_connector: user_sync.connector.dashboard.DashboardConnector
+        :type group_names: list(str), to download only the members of these groups
+        '''
+        self.dashboard_connector = dashboard_connector
+        self.group_names = group_names
+        self.result_queue = Queue.Queue()
+        self.thread = thread = threading.Thread(target = self.run, name = 'dashboard-users-prefetch')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        result_queue = self.result_queue
+        try:
+            if (self.group_names != None):
+                users = self.dashboard_connector.iter_group_users(self.group_names)
+            else:
+                users = self.dashboard_connector.iter_users()
+            while True:
+                message_users = list(itertools.islice(users, DashboardUserPrefetch.users_per_message))
+                if (len(message_users) == 0):
+                    break
+                result_queue.put(('users', message_users))
+            result_queue.put(('done', None))
+        except:
+            result_queue.put(('error', sys.exc_info()))
+
+    def iter_users(self):
+        result_queue = self.result_queue
+        while True:
+            message_type, message_value = result_queue.get()
+            if (message_type == 'users'):
+                for user in message_value:
+                    yield user
+            elif (message_type == 'error'):
+                raise message_value[0], message_value[1], message_value[2]
+            else:
+                return
+
 class DashboardGroup(object):
 
     index_map = {}